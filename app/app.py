@@ -1,24 +1,36 @@
 from fastapi import FastAPI, Body, Depends, HTTPException, status, File, UploadFile, Header, Request, Query
 from sqlalchemy.orm import Session
 from .auth import create_user, encode, decode, get_user_by_id, verify_email, login_user, refresh_tokens, logout_user
-from .models import Token, User, LoginRequest, EmailAccount, DBFile, TextEmbedding ,HeaderParams
-from .db import get_db
+from .models import Token, User, LoginRequest, EmailAccount, DBFile, TextEmbedding ,HeaderParams, IngestJob, Campaign, CampaignRecipient
+from .db import get_db, get_async_db, AsyncSessionLocal
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.middleware.cors import CORSMiddleware
 from jose import JWTError, jwt
 from .auth import SECRET_KEY, ALGORITHM
 import os
 from .auth import generate_verification_code, hashify, set_conf
 from .send_mail import send_email_async
+from .smtp_pool import close_all_pools
+from .campaigns import start_campaign, resume_campaigns
+from .token_cache import token_cache, validate_tokens
+from .pagination import keyset_page, next_cursor
+from .cleanup import delete_account_files, recompute_storage_used, start_cleanup
+from .embed_cache import query_cache
+from .vector_cache import vector_cache
+from .text_store import accepts_encoding, blob_info_query, iter_blob, iter_text, parse_range
+from .metrics import registry, Counter, Gauge, SEARCH_STAGE_SECONDS, SEARCH_REQUESTS
+from .profiling import QueryStatsMiddleware
 import json
-from typing import List
+from typing import List, Optional
 from datetime import timezone
-from .extract_text import extract_text_from_file
-from .rag import text_splitter, embeddings
-from langchain.schema import Document
+from .rag import get_text_splitter, CHUNK_TOKENS
+from .embed_service import embedding_service, EMBED_WARMUP
+from .ingest import ingest_worker, remove_uploads, store_upload
+from .search import most_similar_files_async, fused_files_async, choose_search_mode, SEARCH_MODE
 import os
 import numpy as np
-from sqlalchemy import select
-from fastapi.responses import StreamingResponse
+from sqlalchemy import select, insert, delete
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from sqlalchemy import func
 from .auth import start_google_oauth, google_callback, revoke_google_token
 
@@ -35,8 +47,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-DB-Queries", "X-DB-Time-ms"],
 )
 
+# SQL statements and DB time per request, query budgets and sampled profiles (see app/profiling.py)
+app.add_middleware(QueryStatsMiddleware)
+
+@app.on_event("startup")
+async def start_ingest_worker():
+    ingest_worker.start()
+
+@app.on_event("startup")
+async def restart_campaigns():
+    resume_campaigns()
+
+@app.on_event("startup")
+async def resume_cleanup():
+    start_cleanup()
+
+@app.on_event("startup")
+async def warm_up_model():
+    # In the background, so the app serves auth while the model loads
+    if EMBED_WARMUP:
+        embedding_service.start_warm_up()
+
+@app.on_event("shutdown")
+async def stop_ingest_worker():
+    await ingest_worker.stop()
+
+@app.on_event("shutdown")
+async def close_smtp_connections():
+    await close_all_pools()
+
 # Dependency to extract headers manually
 async def get_headers(request: Request) -> dict:
     authorization = request.headers.get("Authorization")
@@ -52,6 +94,31 @@ async def get_headers(request: Request) -> dict:
     )
 
 
+@app.get("/ready")
+async def readiness():
+    # Ready once the model has loaded; with EMBED_WARMUP=0 it loads on first use and does not gate readiness
+    if EMBED_WARMUP and not embedding_service.ready:
+        raise HTTPException(status_code=503, detail="Embedding model is loading")
+    return {"ready": True, "model_loaded": embedding_service.ready}
+
+
+# The token and query caches keep their own counts, exported as they are when /metrics is scraped
+_caches = {"token": token_cache, "query": query_cache, "vector": vector_cache}
+
+def _cache_stats(key):
+    return {(name,): cache.stats()[key] for name, cache in _caches.items()}
+
+Counter("cache_hits_total", "Cache lookups answered from the cache", ("cache",), callback=lambda: _cache_stats("hits"))
+Counter("cache_misses_total", "Cache lookups that missed", ("cache",), callback=lambda: _cache_stats("misses"))
+Gauge("cache_entries", "Entries held per cache", ("cache",), callback=lambda: _cache_stats("entries"))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text format; scraped from inside the deployment, like /ready
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/create_user")
 async def register_page(body: dict, db: Session = Depends(get_db)):
     return await create_user(body, db)
@@ -69,18 +136,22 @@ async def login_for_access_token(body: LoginRequest, db=Depends(get_db)):
 
 @app.post("/auth/refresh", response_model=Token)
 async def refresh_access(header_params: HeaderParams = Depends(get_headers), db=Depends(get_db)):
-    print(header_params)
     return await refresh_tokens(header_params, db)
 
 @app.post("/auth/logout/{user_id}")
 async def logout(user_id:int, header_params: HeaderParams = Depends(get_headers), db=Depends(get_db)):
-    await refresh_access(header_params, db)
-    return await logout_user(user_id, db)
+    await validate_tokens(header_params, db)
+    response = await logout_user(user_id, db)
+    # The access token stays valid until it expires, so it is refused from the revocation list instead
+    if header_params.access_token:
+        token_cache.revoke(header_params.access_token, db)
+    token_cache.revoke_user(user_id, db)
+    return response
 
 @app.get("/auth/start-google-oauth")
 async def oauth_initiate( header_params: HeaderParams = Depends(get_headers), user_id: str = Query(...), db=Depends(get_db)):
     # Refresh tokens if necessary
-    tokens = await refresh_tokens(header_params, db)
+    tokens = await validate_tokens(header_params, db)
 
     # Start Google OAuth
     response = await start_google_oauth(user_id, db)
@@ -88,43 +159,57 @@ async def oauth_initiate( header_params: HeaderParams = Depends(get_headers), us
     # Include refreshed tokens in the response
     response.update(tokens)
 
-    print(response)
     return response
 @app.get("/auth/google-callback")
 async def google_ask( code: str, state: str, db=Depends(get_db)):
-    print("CODE IS: ", code)
-    print("STATE IS: ", state)
     return await google_callback(code, state, db)
 
+@app.get("/app/cache_stats")
+async def cache_stats(header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
+    tokens = await validate_tokens(header_params, db)
+    payload = {"token_cache": token_cache.stats(), "query_cache": query_cache.stats(), "vector_cache": vector_cache.stats()}
+    payload.update(tokens)
+    return payload
+
 #######################################################################
 
 @app.post("/app/dashboard/{user_id}")
 async def get_dashboard(
     user_id: int,
+    cursor: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None),
     header_params: HeaderParams = Depends(get_headers),  # Use the get_headers dependency
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    adb: AsyncSession = Depends(get_async_db),
 ):
-    tokens = await refresh_tokens(header_params, db)  # Decode and validate the token
+    tokens = await validate_tokens(header_params, db)  # Decode and validate the token
     
-    user = get_user_by_id(user_id, db)
-    if user.biz_emails == 0:
+    user = await adb.get(User, user_id)
+    if user is None or user.biz_emails == 0:
         raise HTTPException(status_code=404, detail="Data not found")
-    else:
-        user_emails = db.query(EmailAccount).filter(user.id == EmailAccount.user_id).all()
-        if user_emails == []:
-            user.biz_emails = 0
-            db.commit()
-            db.refresh(user)
-            raise HTTPException(status_code=404, detail="Data not found")
-        else:
-            user.biz_emails = len(user_emails)
-            user_emails_json = [email.__get_json__() for email in user_emails]
-            db.commit()
-            db.refresh(user)
-            payload = {"message": "Connected to biz emails"}
-            payload["all_emails"] = user_emails_json
-            payload.update(tokens)
-            return payload
+
+    total_emails = await adb.scalar(select(func.count(EmailAccount.id)).where(EmailAccount.user_id == user.id))
+    if user.biz_emails != total_emails:
+        # biz_emails is a maintained counter, only written back when it drifted
+        user.biz_emails = total_emails
+        await adb.commit()
+    if total_emails == 0:
+        raise HTTPException(status_code=404, detail="Data not found")
+
+    # Columns of EmailAccount.__get_json__ only, one keyset page at a time
+    stmt, limit = keyset_page(
+        select(EmailAccount.id, EmailAccount.user_id, EmailAccount.email_address, EmailAccount.verified, EmailAccount.date_added)
+        .where(EmailAccount.user_id == user.id),
+        EmailAccount.date_added, EmailAccount.id, cursor, limit,
+    )
+    user_emails_json, next_page = next_cursor([row._asdict() for row in await adb.execute(stmt)], limit, "date_added")
+
+    payload = {"message": "Connected to biz emails"}
+    payload["all_emails"] = user_emails_json
+    payload["total_emails"] = total_emails
+    payload["next_cursor"] = next_page
+    payload.update(tokens)
+    return payload
 
 
 @app.post("/app/add_user_biz/{user_id}")
@@ -134,7 +219,7 @@ async def add_user_biz(
     header_params: HeaderParams = Depends(get_headers),  # Use the get_headers dependency
     db: Session = Depends(get_db)
 ):
-    tokens = await refresh_tokens(header_params, db)  # Decode and validate the token
+    tokens = await validate_tokens(header_params, db)  # Decode and validate the token
     
     user = get_user_by_id(user_id, db)
     
@@ -195,7 +280,7 @@ async def delete_email(
     db: Session = Depends(get_db)
 ):
    
-    tokens = await refresh_tokens(header_params, db)  # Decode and validate the token
+    tokens = await validate_tokens(header_params, db)  # Decode and validate the token
 
     email_account = db.query(EmailAccount).filter(EmailAccount.id == email_id).first()
 
@@ -208,8 +293,16 @@ async def delete_email(
     if email_account.access:    
         revoke_google_token(decode(email_account.access))
 
+    # Uploads still waiting for the ingest worker, their rows go with the account
+    raw_paths = db.scalars(
+        select(DBFile.raw_path).where(DBFile.email_account_id == email_account.id, DBFile.raw_path.isnot(None))
+    ).all()
     db.delete(email_account)
+    db.flush()  # The session does not autoflush, the recompute must not count this account's files
+    recompute_storage_used(db, email_account.user_id)
     db.commit()
+    remove_uploads(raw_paths)
+    vector_cache.invalidate(email_id, remove_files=True)
     
     payload = {"message": "Email account deleted"}
     payload.update(tokens)
@@ -221,7 +314,7 @@ async def delete_email(
 @app.post("/app/resend_verification_email/{email_id}")
 async def resend_verification_email(email_id: int, header_params:HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
 
-    tokens = await refresh_tokens(header_params, db)
+    tokens = await validate_tokens(header_params, db)
 
     email_account = db.query(EmailAccount).filter(EmailAccount.id == email_id).first()
 
@@ -279,6 +372,7 @@ async def upload_files(
     files: List[UploadFile] = File(...),
     header_params: HeaderParams = Depends(get_headers),
     db: Session = Depends(get_db),
+    adb: AsyncSession = Depends(get_async_db),
 ):
     ALLOWED_CONTENT_TYPES = {
         "application/pdf": "PDF",
@@ -287,186 +381,304 @@ async def upload_files(
         "text/plain": "TXT",
     }
 
-    tokens = await refresh_tokens(header_params, db)
-    user = db.query(User).filter(User.id == tokens["user_id"]).first()
+    tokens = await validate_tokens(header_params, db)
+    user = await adb.get(User, tokens["user_id"])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    email_account = db.query(EmailAccount).filter(EmailAccount.id == email_id).first()
+    email_account = await adb.get(EmailAccount, email_id)
     if not email_account or not email_account.verified:
         raise HTTPException(status_code=403, detail="Invalid or unverified email account")
 
     total_file_size = 0
+    existing_names = set((await adb.scalars(
+        select(DBFile.file_name)
+        .where(DBFile.email_account_id == email_account.id)
+        .where(DBFile.file_name.in_([file.filename for file in files]))
+    )).all())
 
     for file in files:
         file_size = os.fstat(file.file.fileno()).st_size
         total_file_size += file_size
-        if db.query(DBFile).filter(DBFile.email_account_id == email_account.id, DBFile.file_name == file.filename).first():
+        if file.filename in existing_names:
             raise HTTPException(status_code=400, detail=f"File '{file.filename}' already exists")
         if file.content_type not in ALLOWED_CONTENT_TYPES:
             raise HTTPException(status_code=400, detail=f"File type of '{file.filename}' is not allowed")
         if total_file_size + user.storage_used > 1000000000:  # Replace with realistic limit
             raise HTTPException(status_code=413, detail="Total file size exceeds limit")
 
-    for file in files:
-        try:
-            DB_file = DBFile(
+    job = IngestJob(user_id=user.id, email_account_id=email_account.id)
+    adb.add(job)
+    await adb.flush()
+
+    # Store the raw uploads and queue them, the ingest worker does extract -> split -> embed -> insert
+    stored = []
+    try:
+        for file in files:
+            raw_path, content_hash = await store_upload(file)
+            stored.append(raw_path)
+            adb.add(DBFile(
                 email_account_id=email_account.id,
                 file_name=file.filename,
                 file_size=os.fstat(file.file.fileno()).st_size,
                 content_type=ALLOWED_CONTENT_TYPES[file.content_type],
-            )
-            db.add(DB_file)
-            db.commit()
-            db.refresh(DB_file)
+                job_id=job.id,
+                status="queued",
+                raw_path=raw_path,
+                content_hash=content_hash,
+            ))
+
+        user.storage_used += total_file_size
+        await adb.commit()
+    except Exception as e:
+        # Nothing is queued: the job and its files are rolled back and the bytes already written removed
+        await adb.rollback()
+        remove_uploads(stored)
+        print(f"Error storing file '{file.filename}': {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error storing file '{file.filename}'")
+    ingest_worker.notify()
+
+    return {"message": "Files queued for processing", "job_id": job.id, "tokens": tokens}
+
+
+@app.post("/app/campaigns/{email_id}")
+async def create_campaign(email_id: int, body: dict, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
+    tokens = await validate_tokens(header_params, db)
 
-            file_text = await extract_text_from_file(file, file.content_type)
-            documents = text_splitter.split_documents([Document(page_content=file_text)])
+    email_account = db.query(EmailAccount).filter(EmailAccount.id == email_id).first()
+    if not email_account or not email_account.verified:
+        raise HTTPException(status_code=403, detail="Invalid or unverified email account")
+
+    if email_account.user_id != tokens["user_id"]:
+        raise HTTPException(status_code=403, detail="You are not authorized to send from this email account")
+
+    subject = body.get("subject")
+    recipients = body.get("recipients")
+    if not subject or not recipients:
+        raise HTTPException(status_code=400, detail="A subject and at least one recipient are required")
+    if not isinstance(recipients, list) or not all(
+        isinstance(recipient, dict)
+        and isinstance(recipient.get("email"), str) and recipient["email"]
+        and isinstance(recipient.get("variables", {}), dict)
+        for recipient in recipients
+    ):
+        raise HTTPException(status_code=400, detail="Each recipient needs an email and optional variables object")
+
+    campaign = Campaign(
+        user_id=email_account.user_id,
+        email_account_id=email_account.id,
+        subject=subject,
+        template_body=body.get("template", {}),
+    )
+    db.add(campaign)
+    db.flush()
+
+    # Recipients are written with one executemany insert, not one ORM object each
+    db.execute(insert(CampaignRecipient), [
+        {"campaign_id": campaign.id, "email": recipient["email"], "variables": recipient.get("variables", {})}
+        for recipient in recipients
+    ])
+    db.commit()
 
-            all_embeddings = []
-            for doc in documents:
-                # Generate embedding
-                embedding = list(embeddings.embed([doc.page_content]))
-                all_embeddings.append((embedding[0], doc.page_content))  # Pair embedding with text
+    start_campaign(campaign.id)
 
-            print(f"Generated {len(all_embeddings)} embeddings for {file.filename}")
+    payload = {"message": "Campaign queued", "campaign_id": campaign.id, "recipients": len(recipients)}
+    payload.update(tokens)
+    return payload
 
-            # Insert embeddings into the database
-            for embedding, content in all_embeddings:
-                print(len(embedding))
-                embed = TextEmbedding(
-                    filename=file.filename,
-                    embedding=embedding,
-                    text=content,
-                    file_id=DB_file.id,
-                    email_account_id=email_account.id,
-                )
-                db.add(embed)
 
-            db.commit()  # Commit all at once for better performance
-            print(f"Inserted {len(all_embeddings)} embeddings for {file.filename} into the database.")
+@app.get("/app/campaigns/{campaign_id}")
+async def get_campaign(campaign_id: int, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
+    tokens = await validate_tokens(header_params, db)
 
-        except Exception as e:
-            print(f"Error processing file '{file.filename}': {str(e)}")
-            return {"error": f"Error processing file '{file.filename}': {str(e)}"}
+    campaign = db.query(Campaign).filter(Campaign.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
 
-    return {"message": "Files processed successfully", "tokens": tokens}
+    if campaign.user_id != tokens["user_id"]:
+        raise HTTPException(status_code=403, detail="You are not authorized to see this campaign")
+
+    counts = dict(
+        db.query(CampaignRecipient.status, func.count(CampaignRecipient.id))
+        .filter(CampaignRecipient.campaign_id == campaign.id)
+        .group_by(CampaignRecipient.status)
+        .all()
+    )
+    payload = {
+        "id": campaign.id,
+        "status": campaign.status,
+        "created_at": campaign.created_at,
+        "finished_at": campaign.finished_at,
+        "pending": counts.get("pending", 0),
+        "sending": counts.get("sending", 0),
+        "sent": counts.get("sent", 0),
+        "failed": counts.get("failed", 0),
+    }
+    payload.update(tokens)
+    return payload
+
+
+@app.get("/app/jobs/{job_id}")
+async def get_job(job_id: int, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
+    tokens = await validate_tokens(header_params, db)
+
+    job = db.query(IngestJob).filter(IngestJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if job.user_id != tokens["user_id"]:
+        raise HTTPException(status_code=403, detail="You are not authorized to see this job")
+
+    payload = {
+        "id": job.id,
+        "status": job.status,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "files": [file.progress_json() for file in job.files],
+    }
+    chunks_done = sum(file.chunks_done or 0 for file in job.files)
+    chunks_reused = sum(file.chunks_reused or 0 for file in job.files)
+    payload["dedup_ratio"] = chunks_reused / chunks_done if chunks_done else 0.0
+    payload.update(tokens)
+    return payload
 
 
 
 @app.get("/app/see_files/{email_account_id}")
-async def see_files(email_account_id: int, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
-    tokens = await refresh_tokens(header_params, db)
-    email_account = db.query(EmailAccount).filter(EmailAccount.id == email_account_id).first()
+async def see_files(
+    email_account_id: int,
+    cursor: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None),
+    header_params: HeaderParams = Depends(get_headers),
+    db: Session = Depends(get_db),
+    adb: AsyncSession = Depends(get_async_db),
+):
+    tokens = await validate_tokens(header_params, db)
+    email_account = await adb.scalar(select(EmailAccount.id).where(EmailAccount.id == email_account_id))
 
     if not email_account:
         raise HTTPException(status_code=404, detail="Email account not found")
-    
-    files = email_account.files
 
-    if files == []:
-        raise HTTPException(status_code=404, detail="Data not found")
-    
-    else:
-        files_json = [file. __get_json__() for file in files]
+    # Columns of DBFile.__get_json__ only, one keyset page at a time
+    stmt, limit = keyset_page(
+        select(DBFile.id, DBFile.file_name, DBFile.file_size, DBFile.content_type, DBFile.uploaded_at, DBFile.status)
+        .where(DBFile.email_account_id == email_account_id, DBFile.deleting.isnot(True)),
+        DBFile.uploaded_at, DBFile.id, cursor, limit,
+    )
+    files_json, next_page = next_cursor([row._asdict() for row in await adb.execute(stmt)], limit, "uploaded_at")
 
-        payload= {"all_files": files_json}
-        payload.update(tokens)
+    if files_json == [] and cursor is None:
+        raise HTTPException(status_code=404, detail="Data not found")
 
-        return payload
+    payload = {"all_files": files_json, "next_cursor": next_page}
+    if cursor is None:
+        # Counted on the first page only, later pages cost the same however many files there are
+        payload["total_files"] = await adb.scalar(
+            select(func.count(DBFile.id)).where(DBFile.email_account_id == email_account_id, DBFile.deleting.isnot(True))
+        )
+    payload.update(tokens)
+    return payload
 
 @app.delete("/app/delete_file/{email_account_id}/{file_id}")
 async def delete_file(email_account_id: int, file_id: int, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
-    tokens = await refresh_tokens(header_params, db)
+    tokens = await validate_tokens(header_params, db)
     
     email_account = db.query(EmailAccount).filter(EmailAccount.id == email_account_id).first()
-    user = email_account.user
     if not email_account:
         raise HTTPException(status_code=404, detail="Email account not found")
-    
-    files = email_account.files
-    if files == []:
-        raise HTTPException(status_code=404, detail="Data not found")
-    
-    else:
-        file = db.query(DBFile).filter(DBFile.id == file_id).first()
-        if not file:
-            raise HTTPException(status_code=404, detail="File not found")
-        else:
-            db.delete(file)
-            user.storage_used -= file.file_size
-            db.commit()
-            db.refresh(user)
-            payload = {"message": "File deleted successfully"}
-            payload.update(tokens)
-            return payload
+
+    # One DELETE, ON DELETE CASCADE removes the chunks in the same statement
+    deleted = db.execute(
+        delete(DBFile)
+        .where(DBFile.id == file_id, DBFile.email_account_id == email_account.id, DBFile.deleting.isnot(True))
+        .returning(DBFile.id, DBFile.raw_path)
+    ).first()
+    if deleted is None:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="File not found")
+
+    recompute_storage_used(db, email_account.user_id)
+    db.commit()
+    remove_uploads([deleted.raw_path])
+    vector_cache.drop_files(email_account.id, [file_id])
+    payload = {"message": "File deleted successfully"}
+    payload.update(tokens)
+    return payload
 
 
 @app.delete("/app/delete_all_files/{email_account_id}")
 async def delete_all_files(email_account_id: int, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
-    tokens = await refresh_tokens(header_params, db)
+    tokens = await validate_tokens(header_params, db)
 
     
     email_account = db.query(EmailAccount).filter(EmailAccount.id == email_account_id).first()
-    user = email_account.user
 
     if not email_account:
         raise HTTPException(status_code=404, detail="Email account not found")
-    
-    files = email_account.files
-    if files == []:
+
+    has_files = db.scalar(
+        select(DBFile.id).where(DBFile.email_account_id == email_account.id, DBFile.deleting.isnot(True)).limit(1)
+    )
+    if has_files is None:
         raise HTTPException(status_code=404, detail="Data not found")
-    else:
-        for file in files:
-            db.delete(file)
-            db.commit()
-            db.refresh(user)
 
-        user.storage_used = 0
-        payload = {"message": "All files deleted successfully"}
-        payload.update(tokens)
-        return payload
+    # Set-based delete; for large accounts the files are hidden now and their chunks removed in the background
+    if delete_account_files(db, email_account):
+        start_cleanup()
+    vector_cache.invalidate(email_account.id, remove_files=True)
+
+    payload = {"message": "All files deleted successfully"}
+    payload.update(tokens)
+    return payload
 
         
 @app.post("/app/most_relevant_files/{email_account_id}")
-async def most_relevant_files(email_account_id: int,  body: dict, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
-    tokens = await refresh_tokens(header_params, db)
+async def most_relevant_files(email_account_id: int,  body: dict, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db), adb: AsyncSession = Depends(get_async_db)):
+    tokens = await validate_tokens(header_params, db)
     
-    email_account = db.query(EmailAccount).filter(EmailAccount.id == email_account_id).first()
+    email_account = await adb.get(EmailAccount, email_account_id)
    
     if not email_account:     #need this to only return values files that are linked to this account
         raise HTTPException(status_code=404, detail="Email account not found") 
-    
-    if len(body["query"]) > 1000:
 
-        documents = text_splitter.split_documents([Document(page_content=body["query"])])
-        generators = embeddings.embed([doc.page_content for doc in documents])
-        vectors = [list(generator) for generator in generators]
-    
-    else:
-        vectors = list(embeddings.embed([body["query"]]))
-
-    added_files = set()
-    files = []
-    files_to_embeddings = {}
-    for vector in vectors:
-        closest_embeddings = db.scalars(
-            select(TextEmbedding)
-            .where(TextEmbedding.embedding.l2_distance(vector) <= .8)  # Distance threshold, adjust as needed
-            .where(TextEmbedding.email_account_id == email_account_id)
-            .order_by(TextEmbedding.embedding.l2_distance(vector))  # Order by smallest distance (most accurate matches)
-            .limit(2)  # Limit to 2 closest embeddings
-        )
-
-        for emb in closest_embeddings:
-            if emb.file_id not in added_files:
-                added_files.add(emb.file_id)
-                files.append(emb.file.__get_json__())
-                files_to_embeddings[emb.file_id] = [emb.text]
+    try:
+        requested_mode = body.get("mode")
+        mode = choose_search_mode(body["query"], requested_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if mode == "lexical":
+        # Trigram matching only, no model inference
+        with SEARCH_STAGE_SECONDS.time(stage="db_search", mode=mode):
+            files, files_to_embeddings = await fused_files_async(adb, email_account_id, body["query"])
+        if not files and (requested_mode or SEARCH_MODE) == "auto":
+            mode = "hybrid"  # Nothing matched the words themselves, fall back to meaning
+
+    if mode != "lexical":
+        with SEARCH_STAGE_SECONDS.time(stage="query_embed", mode=mode):
+            # Every token covers at least one character, so only longer queries can overflow the model's window
+            if len(body["query"]) > CHUNK_TOKENS:
+                vectors = await embedding_service.embed_queries(get_text_splitter().split_text(body["query"]))
             else:
-                files_to_embeddings[emb.file_id].append(emb.text)
+                vectors = await embedding_service.embed_queries([body["query"]])
+
+        # One round trip for all query vectors, with the matching files joined in
+        found = None
+        if mode == "vector" and body.get("ef_search") is None:
+            # Hot accounts are searched in memory, the texts still come from the database
+            with SEARCH_STAGE_SECONDS.time(stage="cache_search", mode=mode):
+                found = await vector_cache.search(adb, email_account_id, vectors)
+        if found is not None:
+            files, files_to_embeddings = found
+        else:
+            with SEARCH_STAGE_SECONDS.time(stage="db_search", mode=mode):
+                if mode == "hybrid":
+                    files, files_to_embeddings = await fused_files_async(adb, email_account_id, body["query"], vectors, ef_search=body.get("ef_search"))
+                else:
+                    files, files_to_embeddings = await most_similar_files_async(adb, email_account_id, vectors, ef_search=body.get("ef_search"))
+    SEARCH_REQUESTS.inc(mode=mode)
 
    
-    if len(added_files) == 0:
+    if len(files) == 0:
         payload={"message": "No files found"}
         
     else:
@@ -476,31 +688,65 @@ async def most_relevant_files(email_account_id: int,  body: dict, header_params:
     return payload
 
 @app.get("/app/get_file/{file_id}")
-async def get_file(file_id: int, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db)):
+async def get_file(file_id: int, request: Request, header_params: HeaderParams = Depends(get_headers), db: Session = Depends(get_db), adb: AsyncSession = Depends(get_async_db)):
     try:
-        tokens = await refresh_tokens(header_params, db)
+        tokens = await validate_tokens(header_params, db)
     except HTTPException as e:
         raise e  
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
     
-    file = db.query(DBFile).filter(DBFile.id == file_id).first()
+    file = (await adb.execute(blob_info_query(file_id))).first()
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
 
+    if file.text_encoding is not None:
+        return text_blob_response(file_id, file, request)
+
+    # Files ingested before the text was stored are rebuilt from their chunks
     async def file_text_generator():
-        query = (
-            db.query(TextEmbedding.text)
-            .filter(TextEmbedding.file_id == file_id)
-            .order_by(TextEmbedding.id)
-        )
-        # Use the query iterator
-        for row in query.yield_per(50):  # Fetch rows in chunks of 100
-            yield row.text + "\n"
+        # The request's session is closed before the body is streamed, so the stream gets its own
+        async with AsyncSessionLocal() as stream_db:
+            rows = await stream_db.stream_scalars(
+                select(TextEmbedding.text)
+                .where(TextEmbedding.file_id == file_id)
+                .order_by(TextEmbedding.id)
+                .execution_options(yield_per=500)  # Server side cursor, fetched 500 rows at a time
+            )
+            async for text in rows:
+                yield text + "\n"
 
     return StreamingResponse(file_text_generator(), media_type="text/plain")
 
 
+def text_blob_response(file_id, file, request):
+    """The stored text, sent compressed when the client accepts the stored encoding; one byte range if asked."""
+    encoded = accepts_encoding(request.headers.get("accept-encoding"), file.text_encoding)
+    size = file.blob_length if encoded else file.text_length
+    try:
+        byte_range = parse_range(request.headers.get("range"), size)
+    except ValueError as e:
+        raise HTTPException(status_code=416, detail=str(e), headers={"Content-Range": f"bytes */{size}"})
+    start, end = byte_range or (0, size)
+
+    headers = {"Accept-Ranges": "bytes", "Vary": "Accept-Encoding", "Content-Length": str(end - start)}
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    if encoded:
+        # Ranges then count bytes of the compressed body, as HTTP defines them
+        headers["Content-Encoding"] = file.text_encoding
+
+    async def blob_generator():
+        async with AsyncSessionLocal() as stream_db:
+            blocks = iter_blob(stream_db, file_id, start, end) if encoded else iter_text(stream_db, file_id, file.text_encoding, start, end)
+            async for block in blocks:
+                yield block
+
+    return StreamingResponse(
+        blob_generator(), status_code=206 if byte_range else 200, media_type="text/plain; charset=utf-8", headers=headers
+    )
+
+
 
 
 
@@ -0,0 +1,123 @@
+import struct
+
+import numpy as np
+from sqlalchemy import insert, text
+
+from .models import TextEmbedding, EMBEDDING_FORMAT
+
+# Rows per COPY statement; each statement is streamed, this only bounds how many ids are reserved at once
+COPY_BATCH_ROWS = 10000
+
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_COPY_TRAILER = struct.pack(">h", -1)
+_NULL_FIELD = struct.pack(">i", -1)
+_COPY_COLUMNS = ("id", "filename", "text", "chunk_hash", "embedding", "email_account_id", "file_id", "start_offset", "end_offset")
+# Element type of the embedding column in COPY binary format, big-endian float4 or float2 for halfvec
+_VECTOR_DTYPE = ">f2" if EMBEDDING_FORMAT == "halfvec" else ">f4"
+
+
+def _text_field(value):
+    data = value.encode("utf-8")
+    return struct.pack(">i", len(data)) + data
+
+
+def _nullable_text_field(value):
+    return _NULL_FIELD if value is None else _text_field(value)
+
+
+def _int_field(value):
+    return struct.pack(">ii", 4, value)
+
+
+def _nullable_int_field(value):
+    return _NULL_FIELD if value is None else _int_field(value)
+
+
+def _vector_field(vector, dtype=_VECTOR_DTYPE):
+    # pgvector binary format: int16 dim, int16 unused, dim x big-endian float4 (float2 for halfvec).
+    # The numpy buffer is written as is, vectors read back from the database (HalfVector) are unwrapped first
+    if hasattr(vector, "to_numpy"):
+        vector = vector.to_numpy()
+    values = np.asarray(vector, dtype=dtype)
+    return struct.pack(">iHH", 4 + values.nbytes, values.shape[0], 0) + values.tobytes()
+
+
+class _CopyStream:
+    """File-like object that encodes rows into COPY binary format as psycopg2 reads from it."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = bytearray(_COPY_HEADER)
+        self._done = False
+
+    def _encode(self, row_id, row):
+        return b"".join((
+            struct.pack(">h", len(_COPY_COLUMNS)),
+            _int_field(row_id),
+            _text_field(row["filename"]),
+            _text_field(row["text"]),
+            _nullable_text_field(row.get("chunk_hash")),
+            _vector_field(row["embedding"]),
+            _int_field(row["email_account_id"]),
+            _int_field(row["file_id"]),
+            _nullable_int_field(row.get("start_offset")),
+            _nullable_int_field(row.get("end_offset")),
+        ))
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            try:
+                self._buffer += self._encode(*next(self._rows))
+            except StopIteration:
+                self._buffer += _COPY_TRAILER
+                self._done = True
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _copy_insert(db, rows):
+    cursor = db.connection().connection.cursor()
+    ids = []
+    try:
+        for start in range(0, len(rows), COPY_BATCH_ROWS):
+            batch = rows[start:start + COPY_BATCH_ROWS]
+            # COPY cannot return generated ids, so reserve them from the sequence up front
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence('text_embeddings', 'id')) FROM generate_series(1, %s)",
+                (len(batch),),
+            )
+            batch_ids = [row[0] for row in cursor.fetchall()]
+            cursor.copy_expert(
+                f"COPY text_embeddings ({', '.join(_COPY_COLUMNS)}) FROM STDIN WITH (FORMAT binary)",
+                _CopyStream(zip(batch_ids, batch)),
+            )
+            ids.extend(batch_ids)
+    finally:
+        cursor.close()
+    return ids
+
+
+def _executemany_insert(db, rows):
+    table = TextEmbedding.__table__
+    rows = [{"chunk_hash": None, "start_offset": None, "end_offset": None, **row} for row in rows]
+    result = db.execute(insert(table).returning(table.c.id), rows)
+    return [row[0] for row in result]
+
+
+def bulk_insert_embeddings(db, rows):
+    """Insert TextEmbedding rows without creating ORM objects and return their ids in input order.
+
+    Each row is a dict with filename, text, embedding, email_account_id and file_id, optionally with chunk_hash,
+    start_offset and end_offset. On PostgreSQL the rows are streamed with COPY in binary format, other backends
+    use an executemany insert.
+    Runs inside the session's transaction, the caller commits.
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    if db.get_bind().dialect.name == "postgresql" and db.get_bind().dialect.driver == "psycopg2":
+        return _copy_insert(db, rows)
+    return _executemany_insert(db, rows)
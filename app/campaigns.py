@@ -0,0 +1,354 @@
+import asyncio
+import datetime
+import os
+import random
+import socket
+import time
+import uuid
+
+import aiosmtplib
+from sqlalchemy import or_, select, update
+
+from .db import SessionLocal, engine
+from .models import Campaign, CampaignRecipient, EmailAccount
+from .mail_templates import prepare_template
+from .profiling import background_task
+from .send_mail import build_message, send_message_async, set_conf
+
+# Messages in flight at once for one sender account
+CAMPAIGN_SENDER_CONCURRENCY = int(os.getenv("CAMPAIGN_SENDER_CONCURRENCY", "4"))
+# Messages in flight at once towards one SMTP server, across all senders of this process
+CAMPAIGN_SERVER_CONCURRENCY = int(os.getenv("CAMPAIGN_SERVER_CONCURRENCY", "16"))
+# Sustained messages per second per sender and the burst allowed above it, to stay within provider caps
+CAMPAIGN_RATE_PER_SECOND = float(os.getenv("CAMPAIGN_RATE_PER_SECOND", "10"))
+CAMPAIGN_RATE_BURST = int(os.getenv("CAMPAIGN_RATE_BURST", "20"))
+CAMPAIGN_MAX_ATTEMPTS = int(os.getenv("CAMPAIGN_MAX_ATTEMPTS", "4"))
+CAMPAIGN_BACKOFF_SECONDS = float(os.getenv("CAMPAIGN_BACKOFF_SECONDS", "2"))
+# Recipients claimed per query; if the sending process dies, at most this many are left unsent instead of sent twice
+CAMPAIGN_PAGE_SIZE = int(os.getenv("CAMPAIGN_PAGE_SIZE", "100"))
+# Delivery statuses written per UPDATE
+CAMPAIGN_STATUS_FLUSH = int(os.getenv("CAMPAIGN_STATUS_FLUSH", "200"))
+# A campaign "sending" without a heartbeat for this long belongs to a dead process and is taken over
+CAMPAIGN_STALE_SECONDS = float(os.getenv("CAMPAIGN_STALE_SECONDS", "120"))
+
+# Owner of the campaigns this process sends, unique across the API workers of every host
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_sender_buckets = {}
+_server_limits = {}
+
+def _limits_for(conf):
+    sender = (conf.MAIL_SERVER, conf.MAIL_USERNAME)
+    if sender not in _sender_buckets:
+        _sender_buckets[sender] = TokenBucket(CAMPAIGN_RATE_PER_SECOND, CAMPAIGN_RATE_BURST)
+    if conf.MAIL_SERVER not in _server_limits:
+        _server_limits[conf.MAIL_SERVER] = asyncio.Semaphore(CAMPAIGN_SERVER_CONCURRENCY)
+    return _sender_buckets[sender], _server_limits[conf.MAIL_SERVER]
+
+
+def is_permanent(error):
+    # 5xx replies and refused recipients will fail the same way on every retry
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, aiosmtplib.SMTPResponseException) and 500 <= error.code < 600
+
+
+async def send_with_retry(conf, message, bucket, server_limit,
+                          max_attempts=CAMPAIGN_MAX_ATTEMPTS, backoff=CAMPAIGN_BACKOFF_SECONDS):
+    """Send one message, retrying transient failures with exponential backoff. Returns (attempts, error)."""
+    for attempt in range(1, max_attempts + 1):
+        await bucket.acquire()
+        try:
+            async with server_limit:
+                await send_message_async(conf, message)
+            return attempt, None
+        except Exception as e:
+            if is_permanent(e) or attempt == max_attempts:
+                return attempt, e
+            await asyncio.sleep(backoff * 2 ** (attempt - 1) * (0.5 + random.random()))
+
+
+async def dispatch(conf, recipients, on_result, concurrency=CAMPAIGN_SENDER_CONCURRENCY):
+    """Send to (recipient_id, email, subject, html) tuples from an (async) iterable with bounded concurrency.
+
+    on_result(recipient_id, attempts, error) is called once per recipient, error is None on success.
+    """
+    bucket, server_limit = _limits_for(conf)
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            recipient_id, email, subject, html = item
+            message = build_message(conf, email, subject, html)
+            attempts, error = await send_with_retry(conf, message, bucket, server_limit)
+            on_result(recipient_id, attempts, error)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        if hasattr(recipients, "__aiter__"):
+            async for item in recipients:
+                await queue.put(item)
+        else:
+            for item in recipients:
+                await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def ensure_campaign_columns():
+    """Add the owner and heartbeat of campaigns to a database created before them."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE campaigns ADD COLUMN IF NOT EXISTS owner varchar")
+        conn.exec_driver_sql("ALTER TABLE campaigns ADD COLUMN IF NOT EXISTS heartbeat_at timestamp")
+
+
+def _claimable():
+    stale_before = datetime.datetime.now() - datetime.timedelta(seconds=CAMPAIGN_STALE_SECONDS)
+    return or_(
+        Campaign.status == "queued",
+        (Campaign.status == "sending") & or_(Campaign.heartbeat_at.is_(None), Campaign.heartbeat_at < stale_before),
+    )
+
+
+def claim_campaign(campaign_id):
+    """Make this process the campaign's owner, or return False when another live process already is."""
+    db = SessionLocal()
+    try:
+        claimed = db.execute(
+            update(Campaign)
+            .where(Campaign.id == campaign_id, _claimable())
+            .values(status="sending", owner=WORKER_ID, heartbeat_at=datetime.datetime.now())
+            .returning(Campaign.id)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        if claimed is None:
+            db.rollback()
+            return False
+        # Recipients the previous owner claimed may already have their message, they are not sent twice
+        db.execute(
+            update(CampaignRecipient)
+            .where(CampaignRecipient.campaign_id == campaign_id, CampaignRecipient.status == "sending")
+            .values(status="failed", last_error="Interrupted while sending, not retried to avoid a duplicate")
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+def _touch_campaign(campaign_id):
+    """Refresh the heartbeat; False once the campaign was taken over or finished by someone else."""
+    db = SessionLocal()
+    try:
+        touched = db.execute(
+            update(Campaign)
+            .where(Campaign.id == campaign_id, Campaign.owner == WORKER_ID, Campaign.status == "sending")
+            .values(heartbeat_at=datetime.datetime.now())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return touched == 1
+    finally:
+        db.close()
+
+
+def _claim_pending(campaign_id):
+    """Mark the next page of pending recipients as sending, committed before any of them is sent."""
+    db = SessionLocal()
+    try:
+        page = (
+            select(CampaignRecipient.id)
+            .where(CampaignRecipient.campaign_id == campaign_id, CampaignRecipient.status == "pending")
+            .order_by(CampaignRecipient.id)
+            .limit(CAMPAIGN_PAGE_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        rows = db.execute(
+            update(CampaignRecipient)
+            .where(CampaignRecipient.id.in_(page))
+            .values(status="sending")
+            .returning(CampaignRecipient.id, CampaignRecipient.email, CampaignRecipient.variables)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.commit()
+        return sorted(rows)  # RETURNING order is not guaranteed
+    finally:
+        db.close()
+
+
+def _write_statuses(rows):
+    db = SessionLocal()
+    try:
+        db.execute(update(CampaignRecipient), rows)  # One executemany UPDATE by primary key
+        db.commit()
+    finally:
+        db.close()
+
+
+def _load_campaign(campaign_id):
+    from .auth import decode
+
+    db = SessionLocal()
+    try:
+        campaign = db.get(Campaign, campaign_id)
+        email_account = db.get(EmailAccount, campaign.email_account_id)
+        conf = set_conf({
+            "sender": f"Dripity on behalf of {email_account.email_address}",
+            "sender_email": email_account.email_address,
+            "sender_password": decode(email_account.credentials),
+            "visible_tag": campaign.template_body.get("visible_tag", email_account.email_address),
+        })
+        return conf, campaign.subject, dict(campaign.template_body)
+    finally:
+        db.close()
+
+
+def _finish_campaign(campaign_id):
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Campaign)
+            .where(Campaign.id == campaign_id, Campaign.owner == WORKER_ID)
+            .values(status="done", finished_at=datetime.datetime.now())
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def keep_alive(campaign_id, owned):
+    """Refresh the campaign's heartbeat until cancelled; clears owned[0] when another process took it over."""
+    while owned[0]:
+        await asyncio.sleep(CAMPAIGN_STALE_SECONDS / 3)
+        try:
+            owned[0] = await asyncio.to_thread(_touch_campaign, campaign_id)
+        except Exception as e:
+            print(f"Could not refresh the heartbeat of campaign {campaign_id}: {str(e)}")
+
+
+async def run_campaign(campaign_id):
+    """Deliver every pending recipient of a campaign; safe to call again after a restart and from every worker."""
+    if not await asyncio.to_thread(claim_campaign, campaign_id):
+        return  # Sent by another process
+    owned = [True]
+    heartbeat = asyncio.create_task(keep_alive(campaign_id, owned))
+    try:
+        await _deliver(campaign_id, owned)
+    finally:
+        heartbeat.cancel()
+    if owned[0]:
+        await asyncio.to_thread(_finish_campaign, campaign_id)
+
+
+async def _deliver(campaign_id, owned):
+    conf, subject, template_body = await asyncio.to_thread(_load_campaign, campaign_id)
+    results = []
+
+    async def flush():
+        rows, results[:] = list(results), []
+        if rows:
+            await asyncio.to_thread(_write_statuses, rows)
+
+    def on_result(recipient_id, attempts, error):
+        results.append({
+            "id": recipient_id,
+            "status": "sent" if error is None else "failed",
+            "attempts": attempts,
+            "last_error": None if error is None else str(error)[:1000],
+            "sent_at": datetime.datetime.now() if error is None else None,
+        })
+
+    async def recipients():
+        # The shared parts are rendered once per set of per-recipient fields, recipients only fill the slots
+        templates = {}
+        # Stops claiming once the campaign was taken over, the recipients already claimed are still sent
+        while owned[0] and (page := await asyncio.to_thread(_claim_pending, campaign_id)):
+            for recipient_id, email, variables in page:
+                variables = variables or {}
+                fields = frozenset(variables)
+                if fields not in templates:
+                    templates[fields] = prepare_template("email.html", {**template_body, "title": subject}, fields)
+                template = templates[fields]
+                yield recipient_id, email, variables.get("title", subject), template.render(variables)
+                if len(results) >= CAMPAIGN_STATUS_FLUSH:
+                    await flush()
+
+    try:
+        await dispatch(conf, recipients(), on_result)
+    finally:
+        await flush()
+
+
+_running = {}
+
+def start_campaign(campaign_id):
+    if campaign_id in _running and not _running[campaign_id].done():
+        return
+    task = background_task(run_campaign(campaign_id))
+    task.add_done_callback(_report_failure)
+    _running[campaign_id] = task
+
+    def forget(task):
+        # A newer run may already have replaced this one before the callback ran
+        if _running.get(campaign_id) is task:
+            del _running[campaign_id]
+
+    task.add_done_callback(forget)
+
+
+def _report_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Campaign failed: {task.exception()}")
+
+
+def _claimable_ids():
+    db = SessionLocal()
+    try:
+        return [row.id for row in db.query(Campaign.id).filter(_claimable())]
+    finally:
+        db.close()
+
+
+async def _resume_loop():
+    while True:
+        try:
+            for campaign_id in await asyncio.to_thread(_claimable_ids):
+                start_campaign(campaign_id)  # The claim in the database decides which worker sends it
+        except Exception as e:
+            print(f"Could not look for campaigns to resume: {str(e)}")
+        await asyncio.sleep(CAMPAIGN_STALE_SECONDS)
+
+
+# Campaigns interrupted by a restart, or whose process died, continue with their pending recipients
+def resume_campaigns():
+    task = background_task(_resume_loop())
+    task.add_done_callback(_report_failure)
@@ -0,0 +1,114 @@
+import asyncio
+import os
+
+from sqlalchemy import delete, func, select, update
+
+from .db import SessionLocal, engine
+from .ingest import remove_uploads
+from .models import DBFile, EmailAccount, TextEmbedding, User
+from .profiling import background_task
+
+# Accounts holding fewer chunks than this are deleted in the request with one cascading DELETE,
+# larger ones are hidden at once and their chunks removed in the background
+CLEANUP_INLINE_MAX_CHUNKS = int(os.getenv("CLEANUP_INLINE_MAX_CHUNKS", "20000"))
+# Chunks deleted per transaction by the background cleanup, keeps each lock and WAL burst short
+CLEANUP_BATCH_SIZE = int(os.getenv("CLEANUP_BATCH_SIZE", "5000"))
+# Pause between cleanup batches so searches and uploads are not starved
+CLEANUP_PAUSE_SECONDS = float(os.getenv("CLEANUP_PAUSE_SECONDS", "0.05"))
+
+
+def ensure_cleanup_columns():
+    """Add files.deleting to a database created before the background cleanup."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS deleting boolean DEFAULT false")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_files_deleting ON files (deleting)")
+
+
+def recompute_storage_used(db, user_id):
+    """Set storage_used to the size of the user's remaining files, in one UPDATE."""
+    used = (
+        select(func.coalesce(func.sum(DBFile.file_size), 0))
+        .join(EmailAccount, EmailAccount.id == DBFile.email_account_id)
+        .where(EmailAccount.user_id == user_id, DBFile.deleting.isnot(True))
+        .scalar_subquery()
+    )
+    db.execute(update(User).where(User.id == user_id).values(storage_used=used))
+
+
+def delete_account_files(db, email_account):
+    """Delete every file of an account. Returns True when chunks are left to the background cleanup."""
+    chunks = db.scalar(
+        select(func.coalesce(func.sum(DBFile.chunks_done), 0)).where(DBFile.email_account_id == email_account.id)
+    )
+    if chunks < CLEANUP_INLINE_MAX_CHUNKS:
+        # ON DELETE CASCADE removes the chunks in the same statement
+        raw_paths = db.scalars(
+            delete(DBFile).where(DBFile.email_account_id == email_account.id).returning(DBFile.raw_path)
+        ).all()
+        deferred = False
+    else:
+        db.execute(
+            update(DBFile).where(DBFile.email_account_id == email_account.id).values(deleting=True)
+        )
+        # Uploads of files not ingested yet are removed with the rows, by delete_chunk_batch
+        raw_paths = []
+        deferred = True
+    recompute_storage_used(db, email_account.user_id)
+    db.commit()
+    remove_uploads(raw_paths)
+    return deferred
+
+
+def delete_chunk_batch(batch_size=CLEANUP_BATCH_SIZE):
+    """Delete up to batch_size chunks of files marked deleting, then the files left without chunks."""
+    db = SessionLocal()
+    try:
+        doomed_files = select(DBFile.id).where(DBFile.deleting.is_(True))
+        batch = (
+            select(TextEmbedding.id)
+            .where(TextEmbedding.file_id.in_(doomed_files))
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        deleted = db.execute(delete(TextEmbedding).where(TextEmbedding.id.in_(batch))).rowcount
+        raw_paths = []
+        if deleted < batch_size:
+            raw_paths = db.scalars(delete(DBFile).where(DBFile.deleting.is_(True)).returning(DBFile.raw_path)).all()
+        db.commit()
+        remove_uploads(raw_paths)
+        return deleted
+    finally:
+        db.close()
+
+
+_cleanup_task = None
+_rerun = False
+
+async def run_cleanup():
+    global _rerun
+    deleted = 0
+    while True:
+        _rerun = False
+        while (batch := await asyncio.to_thread(delete_chunk_batch)) > 0:
+            deleted += batch
+            await asyncio.sleep(CLEANUP_PAUSE_SECONDS)
+        # Files marked while the last batch ran are picked up by another pass
+        if not _rerun:
+            break
+    if deleted:
+        print(f"Cleanup removed {deleted} chunks of deleted files")
+
+
+def start_cleanup():
+    """Run the background cleanup unless it is already running; also resumes one cut short by a restart."""
+    global _cleanup_task, _rerun
+    if _cleanup_task is not None and not _cleanup_task.done():
+        _rerun = True
+        return
+    _cleanup_task = background_task(run_cleanup())
+    _cleanup_task.add_done_callback(_report_failure)
+
+
+def _report_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Cleanup failed: {task.exception()}")
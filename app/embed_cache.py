@@ -0,0 +1,131 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# In-process entries kept before the least recently used one is evicted
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+# Seconds an entry stays valid
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "86400"))
+# Optional SQLite file so warm entries survive a restart, e.g. /var/cache/emailauto/queries.sqlite
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH")
+# Entries kept in the SQLite file
+QUERY_CACHE_DISK_SIZE = int(os.getenv("QUERY_CACHE_DISK_SIZE", "100000"))
+
+
+def cache_key(text):
+    # bge-large-en is uncased, so case and whitespace differences give the same embedding
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class SQLiteVectorStore:
+    """On-disk backend for QueryEmbeddingCache, vectors stored as raw float32 bytes."""
+
+    def __init__(self, path, max_entries=QUERY_CACHE_DISK_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS query_embeddings_used_at ON query_embeddings (used_at)")
+        self._writes = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, created_at FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE query_embeddings SET used_at = ? WHERE key = ?", (time.time(), key))
+        return np.frombuffer(row[0], dtype=np.float32), row[1]
+
+    def put(self, key, vector, created_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, vector, created_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, np.asarray(vector, dtype=np.float32).tobytes(), created_at, created_at),
+            )
+            self._writes += 1
+            # Trim the least recently used rows every so often rather than on every write
+            if self._writes % 1000 == 0:
+                self._conn.execute(
+                    "DELETE FROM query_embeddings WHERE key IN ("
+                    "SELECT key FROM query_embeddings ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM query_embeddings WHERE key = ?", (key,))
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU cache of query embeddings with a TTL, optionally backed by a SQLite file."""
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, path=QUERY_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = SQLiteVectorStore(path) if path else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (vector, created_at)
+        self._lock = threading.Lock()
+
+    def get(self, text):
+        key = cache_key(text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[1] < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                if now - entry[1] < self.ttl:
+                    self._remember(key, entry[0], entry[1])
+                    self.hits += 1
+                    return entry[0]
+                self.disk.delete(key)
+
+        self.misses += 1
+        return None
+
+    def put(self, text, vector):
+        key = cache_key(text)
+        created_at = time.time()
+        self._remember(key, vector, created_at)
+        if self.disk is not None:
+            self.disk.put(key, vector, created_at)
+
+    def _remember(self, key, vector, created_at):
+        with self._lock:
+            self._entries[key] = (vector, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+query_cache = QueryEmbeddingCache()
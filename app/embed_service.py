@@ -0,0 +1,133 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from .embed_cache import query_cache
+from .model_server import ModelServerClient
+from .models import N_DIM
+from .rag import get_embedding_model, MODEL_NAME
+
+# Number of chunks handed to the model per forward pass
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# Sort texts by length before batching: the model pads every text to the longest one in its batch
+EMBED_LENGTH_BUCKETS = os.getenv("EMBED_LENGTH_BUCKETS", "1") == "1"
+# Number of batches that may be embedded at the same time
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "2"))
+# "thread" shares the model loaded in app/rag.py, "process" loads one model per worker process
+EMBED_EXECUTOR = os.getenv("EMBED_EXECUTOR", "thread")
+# Unix socket of a model server shared by the workers (python -m app.model_server), empty to embed in this process
+EMBED_SOCKET = os.getenv("EMBED_SOCKET", "")
+# Load the model (or reach the model server) at startup; 0 for workers that only serve auth, the model then loads on first use
+EMBED_WARMUP = os.getenv("EMBED_WARMUP", "1") == "1"
+
+
+# Model used inside worker processes when EMBED_EXECUTOR=process
+_process_model = None
+
+def _init_process_worker():
+    global _process_model
+    from fastembed import TextEmbedding
+    _process_model = TextEmbedding(model_name=MODEL_NAME)
+
+
+def _embed_batch_in_process(texts):
+    return np.stack(list(_process_model.embed(texts, batch_size=len(texts))))
+
+
+def _embed_batch(texts):
+    # onnxruntime releases the GIL while it runs, so batches on different threads run in parallel
+    return np.stack(list(get_embedding_model().embed(texts, batch_size=len(texts))))
+
+
+class EmbeddingService:
+    """Runs the embedding model on a worker pool so the event loop is never blocked by inference."""
+
+    def __init__(self, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS, executor=EMBED_EXECUTOR, socket_path=EMBED_SOCKET,
+                 length_buckets=EMBED_LENGTH_BUCKETS):
+        self.batch_size = batch_size
+        self.length_buckets = length_buckets
+        self.workers = workers
+        self.executor_kind = executor
+        self.remote = ModelServerClient(socket_path) if socket_path else None
+        self.ready = False  # Set once a batch has gone through the model
+        self._executor = None
+        self._warm_up_task = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_process_worker)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="embed")
+        return self._executor
+
+    def _batch_fn(self):
+        return _embed_batch_in_process if self.executor_kind == "process" else _embed_batch
+
+    async def embed(self, texts, batch_size=None):
+        """Embed a list of texts, returning a float32 array of shape (len(texts), N_DIM) in input order."""
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, N_DIM), dtype=np.float32)
+
+        batch_size = batch_size or self.batch_size
+        # Characters stand in for tokens, close enough to group texts of similar length without tokenizing twice
+        order = np.argsort([len(text) for text in texts], kind="stable") if self.length_buckets else np.arange(len(texts))
+        batches = [[texts[i] for i in order[start:start + batch_size]] for start in range(0, len(texts), batch_size)]
+        if self.remote is not None:
+            futures = [self.remote.embed(batch) for batch in batches]
+        else:
+            loop = asyncio.get_running_loop()
+            executor = self._get_executor()
+            batch_fn = self._batch_fn()
+            futures = [loop.run_in_executor(executor, batch_fn, batch) for batch in batches]
+        batched = np.concatenate(await asyncio.gather(*futures))
+        vectors = np.empty_like(batched)
+        vectors[order] = batched  # Back to input order
+        self.ready = True
+        return vectors
+
+    async def embed_one(self, text):
+        return (await self.embed([text]))[0]
+
+    async def embed_queries(self, texts):
+        """Like embed(), but served from the query cache where possible; only misses reach the model."""
+        texts = list(texts)
+        vectors = [query_cache.get(text) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = await self.embed([texts[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                query_cache.put(texts[i], vector)
+                vectors[i] = vector
+        return np.stack(vectors)
+
+    async def warm_up(self):
+        """Load the model, or check the model server is up, before the first request needs it."""
+        if self.remote is not None:
+            await self.remote.embed([])
+            self.ready = True
+        else:
+            await self.embed(["warm up"])
+
+    def start_warm_up(self):
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self.warm_up())
+            self._warm_up_task.add_done_callback(_report_warm_up_failure)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self.remote is not None:
+            self.remote.close()
+
+
+def _report_warm_up_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Embedding model warm-up failed: {task.exception()}")
+
+
+embedding_service = EmbeddingService()
@@ -1,54 +1,97 @@
-from fastapi import HTTPException, UploadFile
 from docx import Document
 import pdfplumber
-import io
-import asyncio
-
-# Function to read a file asynchronously in chunks
-async def read_file_in_chunks(file: UploadFile, chunk_size=1024*1024):  # 1 MB per chunk
-    """Asynchronously read the file in chunks to minimize blocking"""
-    content = b''
-    while chunk := await file.read(chunk_size):
-        content += chunk
-    return content
-
-# Extract text from PDF file using pdfplumber
-async def extract_text_from_pdf(file: UploadFile):
-    # Read the file in chunks
-    file_content = await read_file_in_chunks(file)
-    file_like_obj = io.BytesIO(file_content)
-    text = ""
-
-    # Use pdfplumber to extract text
-    with pdfplumber.open(file_like_obj) as pdf:
+import codecs
+import collections
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Bytes read per block when spooling or decoding
+READ_BLOCK = 1024 * 1024
+# Processes used to extract PDF pages, 1 extracts serially in the calling thread
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "1"))
+# Smaller PDFs are extracted serially, shipping them to other processes would cost more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))
+# Pages extracted by one worker task
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+
+# Yield the text of a PDF page by page, releasing each page's parsed objects once it is read
+def iter_pdf_text_serial(path: str):
+    with pdfplumber.open(path) as pdf:
         for page in pdf.pages:
-            text += page.extract_text() or ""  # Avoid appending None if no text is found
-    return text
-
-# Extract text from DOCX file
-async def extract_text_from_docx(file: UploadFile):
-    # Read the file in chunks
-    file_content = await read_file_in_chunks(file)
-    file_like_obj = io.BytesIO(file_content)
-    doc = Document(file_like_obj)
-    text = ""
+            yield page.extract_text() or ""  # Avoid yielding None if no text is found
+            page.close()
+
+def pdf_page_count(path: str):
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+# Runs in a worker process: extract pages [start, end) of the PDF at path
+def extract_pdf_pages(path: str, start: int, end: int):
+    texts = []
+    with pdfplumber.open(path, pages=list(range(start + 1, end + 1))) as pdf:  # pdfplumber numbers pages from 1
+        for page in pdf.pages:
+            texts.append(page.extract_text() or "")
+            page.close()
+    return texts
+
+_pdf_executors = {}
+
+def _get_pdf_executor(workers: int):
+    if workers not in _pdf_executors:
+        _pdf_executors[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _pdf_executors[workers]
+
+# Yield the text of a PDF page by page, page ranges are extracted on a process pool
+def iter_pdf_text_parallel(path: str, workers: int = PDF_WORKERS, pages_per_task: int = PDF_PAGES_PER_TASK, page_count: int = None):
+    if page_count is None:
+        page_count = pdf_page_count(path)
+    executor = _get_pdf_executor(workers)
+    ranges = ((start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task))
+
+    # Only a couple of ranges per worker are in flight, so finished pages never pile up in memory
+    pending = collections.deque(
+        executor.submit(extract_pdf_pages, path, start, end)
+        for start, end in itertools.islice(ranges, workers * 2)
+    )
+    try:
+        while pending:
+            texts = pending.popleft().result()
+            for start, end in itertools.islice(ranges, 1):
+                pending.append(executor.submit(extract_pdf_pages, path, start, end))
+            yield from texts  # Ranges are consumed in submission order, so page order is preserved
+    finally:
+        for future in pending:
+            future.cancel()
+
+def iter_pdf_text(path: str, workers: int = PDF_WORKERS):
+    if workers > 1:
+        page_count = pdf_page_count(path)
+        if page_count >= PDF_PARALLEL_MIN_PAGES:
+            return iter_pdf_text_parallel(path, workers, page_count=page_count)
+    return iter_pdf_text_serial(path)
+
+# Yield the text of a DOCX paragraph by paragraph
+def iter_docx_text(path: str):
+    doc = Document(path)
     for para in doc.paragraphs:
-        text += para.text + "\n"  # Add new lines for separation of paragraphs
-    return text
-
-# Extract text from TXT file (simple text decoding)
-async def extract_text_from_txt(file: UploadFile):
-    # Read the file in chunks
-    file_content = await read_file_in_chunks(file)
-    return file_content.decode('utf-8')  # Assuming the file is UTF-8 encoded
-
-# Main function to extract text based on file type
-async def extract_text_from_file(file: UploadFile, content_type: str):
-    if content_type == 'application/pdf':
-        return await extract_text_from_pdf(file)
-    elif content_type == 'text/plain':
-        return await extract_text_from_txt(file)
-    elif content_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-        return await extract_text_from_docx(file)
+        yield para.text + "\n"  # Add new lines for separation of paragraphs
+
+# Yield the text of a TXT file block by block, a character split across blocks is decoded once complete
+def iter_txt_text(path: str):
+    decoder = codecs.getincrementaldecoder('utf-8')()  # Assuming the file is UTF-8 encoded
+    with open(path, 'rb') as f:
+        while block := f.read(READ_BLOCK):
+            yield decoder.decode(block)
+    yield decoder.decode(b'', final=True)
+
+# Text of a file stored on disk, as a stream of pieces (used by the ingestion worker, see app/ingest.py)
+def iter_text_from_path(path: str, file_type: str):
+    if file_type == 'PDF':
+        return iter_pdf_text(path)
+    elif file_type == 'TXT':
+        return iter_txt_text(path)
+    elif file_type in ['DOC', 'DOCX']:
+        return iter_docx_text(path)
     else:
-        raise HTTPException(status_code=415, detail=f"Unsupported file type: {content_type}")
+        raise ValueError(f"Unsupported file type: {file_type}")
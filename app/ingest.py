@@ -0,0 +1,468 @@
+import asyncio
+import datetime
+import hashlib
+import itertools
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+from fastapi import UploadFile
+from sqlalchemy import or_, select, literal, insert, update
+
+from .bulk_insert import bulk_insert_embeddings
+from .db import SessionLocal, engine
+from .embed_service import embedding_service
+from .extract_text import iter_text_from_path
+from .metrics import INGEST_STAGE_SECONDS, INGEST_BATCH_SIZE, INGEST_CHUNKS, INGEST_CHUNKS_PER_SECOND, INGEST_FILES
+from .models import DBFile, TextEmbedding
+from .profiling import background_task
+from .rag import iter_chunk_spans
+from .text_store import TextRecorder
+from .vector_cache import vector_cache
+from .vector_index import ensure_account_index
+
+# Where uploads wait until the worker has ingested them
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(__file__), "uploads"))
+# Number of files ingested at the same time by this process
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+# Chunks embedded and committed together; a restart resumes after the last committed batch
+INGEST_COMMIT_BATCH = int(os.getenv("INGEST_COMMIT_BATCH", "256"))
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "5"))
+# A file still "processing" without a heartbeat for this long belongs to a dead worker and is picked up again
+INGEST_STALE_SECONDS = int(os.getenv("INGEST_STALE_SECONDS", "300"))
+# Heartbeats per INGEST_STALE_SECONDS while a file is worked on, also during extraction and copies
+INGEST_HEARTBEATS = 3
+
+
+class FileTakenOver(Exception):
+    """Another worker committed progress on the file since this one read it; this worker's batch is dropped."""
+
+
+def ensure_ingest_columns():
+    """Add the ingestion state of files to an existing database; files already there count as done."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS job_id integer REFERENCES ingest_jobs (id) ON DELETE SET NULL")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS status varchar DEFAULT 'done'")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS raw_path varchar")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS chunks_total integer")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS chunks_done integer")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS embed_seconds double precision DEFAULT 0")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS heartbeat_at timestamp")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS error varchar")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_files_job_id ON files (job_id)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_files_status ON files (status)")
+        # Progress of files ingested before, from the chunks they already have
+        conn.exec_driver_sql(
+            "UPDATE files SET chunks_done = counts.chunks, chunks_total = counts.chunks "
+            "FROM (SELECT file_id, count(*) AS chunks FROM text_embeddings "
+            "WHERE file_id IN (SELECT id FROM files WHERE chunks_done IS NULL) GROUP BY file_id) counts "
+            "WHERE files.id = counts.file_id"
+        )
+
+
+def ensure_dedup_columns():
+    """Add the content and chunk hashes used to reuse work across files; rows already there have none."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS content_hash varchar(64)")
+        conn.exec_driver_sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS chunks_reused integer DEFAULT 0")
+        conn.exec_driver_sql("ALTER TABLE text_embeddings ADD COLUMN IF NOT EXISTS chunk_hash varchar(64)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_files_content_hash ON files (content_hash)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_text_embeddings_chunk_hash ON text_embeddings (chunk_hash)")
+
+
+# Copy an upload to UPLOAD_DIR and return its path and the sha256 of its bytes
+async def store_upload(file: UploadFile):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_DIR, uuid.uuid4().hex)
+    await file.seek(0)
+
+    def copy():
+        digest = hashlib.sha256()
+        with open(path, "wb") as out:
+            while chunk := file.file.read(1024 * 1024):
+                digest.update(chunk)
+                out.write(chunk)
+        return digest.hexdigest()
+
+    content_hash = await asyncio.to_thread(copy)
+    return path, content_hash
+
+
+def remove_uploads(paths):
+    """Remove stored uploads, once the rows pointing at them are committed as ingested or deleted."""
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+# Lock the next file that needs work, including files left half-finished by a dead worker
+def claim_next_file(db):
+    stale_before = datetime.datetime.now() - datetime.timedelta(seconds=INGEST_STALE_SECONDS)
+    file = (
+        db.query(DBFile)
+        .filter(or_(
+            DBFile.status == "queued",
+            (DBFile.status == "processing") & (DBFile.heartbeat_at < stale_before),
+        ))
+        .filter(DBFile.deleting.isnot(True))
+        .order_by(DBFile.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if file is None:
+        db.rollback()
+        return None
+
+    file.status = "processing"
+    file.heartbeat_at = datetime.datetime.now()
+    if file.job is not None and file.job.status == "queued":
+        file.job.status = "processing"
+    db.commit()
+    return file.id
+
+
+def touch_heartbeat(file_id):
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(DBFile)
+            .where(DBFile.id == file_id, DBFile.status == "processing")
+            .values(heartbeat_at=datetime.datetime.now())
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def keep_alive(file_id):
+    """Refresh the file's heartbeat until cancelled, so a long extraction or copy is not taken for a dead worker."""
+    while True:
+        await asyncio.sleep(INGEST_STALE_SECONDS / INGEST_HEARTBEATS)
+        try:
+            await asyncio.to_thread(touch_heartbeat, file_id)
+        except Exception as e:
+            print(f"Could not refresh the heartbeat of file {file_id}: {str(e)}")
+
+
+def locked_progress(db, file_id, start):
+    """Lock the file's row and return it, raising FileTakenOver when its progress is no longer `start`."""
+    row = db.execute(
+        select(DBFile.status, DBFile.chunks_done, DBFile.chunks_reused, DBFile.embed_seconds, DBFile.summary_embedding)
+        .where(DBFile.id == file_id)
+        .with_for_update()
+    ).one()
+    if row.status != "processing" or (row.chunks_done or 0) != start:
+        db.rollback()
+        raise FileTakenOver(f"File {file_id} is at chunk {row.chunks_done} ({row.status}), this worker is at {start}")
+    return row
+
+
+def take(iterator, n):
+    return list(itertools.islice(iterator, n))
+
+
+def timed_iter(iterator, elapsed):
+    """Yield from `iterator`, adding the time spent producing each item to elapsed[0]."""
+    iterator = iter(iterator)
+    while True:
+        began = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            elapsed[0] += time.perf_counter() - began
+        yield item
+
+
+def take_timed(chunks, n, extracting):
+    """take() a batch of chunks, recording extraction and splitting time separately."""
+    began = time.perf_counter()
+    extracted_before = extracting[0]
+    batch = take(chunks, n)
+    extract = extracting[0] - extracted_before
+    if batch:
+        INGEST_STAGE_SECONDS.observe(extract, stage="extract")
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - began - extract, stage="split")
+    return batch
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# A fully ingested file with the same bytes, from any account
+def find_identical_file(db, file):
+    if not file.content_hash:
+        return None
+    return (
+        db.query(DBFile)
+        .filter(
+            DBFile.content_hash == file.content_hash,
+            DBFile.status == "done",
+            DBFile.deleting.isnot(True),
+            DBFile.id != file.id,
+        )
+        .order_by(DBFile.id)
+        .first()
+    )
+
+
+# Copy every chunk of an identical file server side, skipping extraction and embedding entirely.
+# Returns False, with nothing copied, when the source was marked for deletion since it was found
+def copy_file_chunks(db, file, source):
+    # Held until the commit, a second worker copying the same file waits and then finds the chunks there
+    locked_progress(db, file.id, 0)
+    # A shared lock on the source keeps the cleanup from marking or deleting it until the copy is committed
+    still_there = db.scalar(
+        select(DBFile.id)
+        .where(DBFile.id == source.id, DBFile.status == "done", DBFile.deleting.isnot(True))
+        .with_for_update(read=True)
+    )
+    if still_there is None:
+        db.rollback()
+        return False
+    columns = ("filename", "text", "chunk_hash", "embedding", "email_account_id", "file_id", "start_offset", "end_offset")
+    rows = (
+        select(
+            literal(file.file_name),
+            TextEmbedding.text,
+            TextEmbedding.chunk_hash,
+            TextEmbedding.embedding,
+            literal(file.email_account_id),
+            literal(file.id),
+            TextEmbedding.start_offset,
+            TextEmbedding.end_offset,
+        )
+        .where(TextEmbedding.file_id == source.id)
+        .order_by(TextEmbedding.id)
+    )
+    copied = db.execute(insert(TextEmbedding).from_select(columns, rows)).rowcount
+    file.chunks_total = copied
+    file.chunks_done = copied
+    file.chunks_reused = copied
+    file.summary_embedding = source.summary_embedding
+    # Copied inside the database, the blob is not loaded into the worker
+    source_row = DBFile.__table__.alias("source")
+    file.text_blob = select(source_row.c.text_blob).where(source_row.c.id == source.id).scalar_subquery()
+    file.text_encoding = source.text_encoding
+    file.text_length = source.text_length
+    db.commit()
+    # The copied ids are not returned, so a cached account is reloaded
+    vector_cache.invalidate(file.email_account_id)
+    return True
+
+
+# Embeddings already stored for any of these chunk hashes
+def find_known_vectors(db, hashes):
+    rows = db.execute(
+        select(TextEmbedding.chunk_hash, TextEmbedding.embedding)
+        .where(TextEmbedding.chunk_hash.in_(set(hashes)))
+        .distinct(TextEmbedding.chunk_hash)
+    )
+    return {row.chunk_hash: row.embedding for row in rows}
+
+
+async def embed_with_reuse(db, texts):
+    """Embed a batch of chunks, reusing stored vectors for known chunk hashes. Returns (hashes, vectors, reused)."""
+    hashes = [chunk_hash(text) for text in texts]
+    known = await asyncio.to_thread(find_known_vectors, db, hashes)
+    # Identical chunks inside the batch are embedded once
+    missing = list(dict.fromkeys(h for h in hashes if h not in known))
+    reused = len(hashes) - len(missing)
+    if missing:
+        text_by_hash = dict(zip(hashes, texts))
+        began = time.perf_counter()
+        computed = await embedding_service.embed([text_by_hash[h] for h in missing])
+        seconds = time.perf_counter() - began
+        known.update(zip(missing, computed))
+        INGEST_STAGE_SECONDS.observe(seconds, stage="embed")
+        INGEST_BATCH_SIZE.observe(len(missing))
+        INGEST_CHUNKS_PER_SECOND.set(len(missing) / seconds if seconds else 0.0)
+
+    return hashes, [known[h] for h in hashes], reused
+
+
+def as_array(vector):
+    # Vectors read back from the database may be HalfVector objects
+    return vector.to_numpy() if hasattr(vector, "to_numpy") else np.asarray(vector)
+
+
+def updated_summary(summary, count, vectors):
+    """Mean of `count` chunks summarised by `summary` and of `vectors`."""
+    total = np.sum([as_array(vector) for vector in vectors], axis=0, dtype=np.float64)
+    if summary is not None and count:
+        total += as_array(summary).astype(np.float64) * count
+    return (total / (count + len(vectors))).astype(np.float32)
+
+
+def commit_batch(db, file, start, spans, hashes, vectors, reused, seconds):
+    """Insert a batch of (start_offset, end_offset, text) chunks with their vectors and record the file's progress."""
+    began = time.perf_counter()
+    # Locked, so a worker that took over a stale file cannot interleave its batches with this one
+    row = locked_progress(db, file.id, start)
+    ids = bulk_insert_embeddings(db, [
+        {
+            "filename": file.file_name,
+            "embedding": vector,
+            "text": text,
+            "chunk_hash": h,
+            "file_id": file.id,
+            "email_account_id": file.email_account_id,
+            "start_offset": start_offset,
+            "end_offset": end_offset,
+        }
+        for vector, (start_offset, end_offset, text), h in zip(vectors, spans, hashes)
+    ])
+    # Progress is committed together with the chunks, so chunks_done never counts uncommitted rows
+    file.chunks_done = start + len(spans)
+    summary = updated_summary(row.summary_embedding, start, vectors)
+    file.summary_embedding = summary
+    file.chunks_reused = (row.chunks_reused or 0) + reused
+    file.embed_seconds = (row.embed_seconds or 0.0) + seconds
+    file.heartbeat_at = datetime.datetime.now()
+    db.commit()
+    vector_cache.add_chunks(
+        file.email_account_id, file.id, ids, [as_array(vector) for vector in vectors], summary
+    )
+    INGEST_STAGE_SECONDS.observe(time.perf_counter() - began, stage="insert")
+    INGEST_CHUNKS.inc(len(spans) - reused, source="embedded")
+    INGEST_CHUNKS.inc(reused, source="reused")
+
+
+def finish_file(db, file, status, error=None):
+    file.status = status
+    file.error = error
+    remove_uploads([file.raw_path])
+    file.raw_path = None
+    db.commit()
+
+    job = file.job
+    if job is not None and all(f.status in ("done", "failed") for f in job.files):
+        job.status = "done"
+        job.finished_at = datetime.datetime.now()
+        db.commit()
+
+
+# Large accounts get a partial HNSW index, built concurrently so uploads and searches carry on
+def build_account_index(email_account_id):
+    db = SessionLocal()
+    try:
+        if ensure_account_index(db, email_account_id):
+            print(f"Built HNSW index for email account {email_account_id}")
+    except Exception as e:
+        print(f"Error building HNSW index for email account {email_account_id}: {str(e)}")
+    finally:
+        db.close()
+
+
+async def process_file(file_id):
+    db = SessionLocal()
+    heartbeat = asyncio.create_task(keep_alive(file_id))
+    try:
+        file = await asyncio.to_thread(db.get, DBFile, file_id)
+        try:
+            source = await asyncio.to_thread(find_identical_file, db, file) if not file.chunks_done else None
+            if source is not None and await asyncio.to_thread(copy_file_chunks, db, file, source):
+                await asyncio.to_thread(finish_file, db, file, "done")
+                INGEST_CHUNKS.inc(file.chunks_done, source="copied")
+                INGEST_FILES.inc(status="copied")
+                return
+
+            # Text is extracted, split and embedded a batch at a time, so memory does not grow with the file
+            extracting = [0.0]
+            # The whole text goes through the recorder, also on a resumed run, and is stored compressed once it is read
+            recorder = TextRecorder()
+            chunks = iter_chunk_spans(recorder.record(
+                timed_iter(iter_text_from_path(file.raw_path, file.content_type), extracting)
+            ))
+            try:
+                # Splitting is deterministic, so skipping chunks_done resumes exactly where the last run stopped
+                start = file.chunks_done or 0
+                await asyncio.to_thread(take, chunks, start)
+
+                while batch := await asyncio.to_thread(take_timed, chunks, INGEST_COMMIT_BATCH, extracting):
+                    began = time.perf_counter()
+                    hashes, vectors, reused = await embed_with_reuse(db, [text for _, _, text in batch])
+                    await asyncio.to_thread(
+                        commit_batch, db, file, start, batch, hashes, vectors, reused, time.perf_counter() - began
+                    )
+                    start += len(batch)
+            finally:
+                chunks.close()
+
+            file.chunks_total = start
+            file.text_blob = recorder.finish()
+            file.text_encoding = recorder.encoding
+            file.text_length = recorder.length
+            await asyncio.to_thread(finish_file, db, file, "done")
+            INGEST_FILES.inc(status="done")
+            background_task(asyncio.to_thread(build_account_index, file.email_account_id))
+        except FileTakenOver as e:
+            # The other worker finishes the file, nothing of this run was committed
+            db.rollback()
+            print(f"Stopped ingesting file '{file.file_name}': {str(e)}")
+        except Exception as e:
+            db.rollback()
+            print(f"Error processing file '{file.file_name}': {str(e)}")
+            await asyncio.to_thread(finish_file, db, file, "failed", str(e))
+            INGEST_FILES.inc(status="failed")
+    finally:
+        heartbeat.cancel()
+        db.close()
+
+
+class IngestWorker:
+    """In-process asyncio worker that drains the DBFile queue stored in the database."""
+
+    def __init__(self, workers=INGEST_WORKERS):
+        self.workers = workers
+        self._tasks = []
+        self._wake = asyncio.Event()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                file_id = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                print(f"Ingest worker could not claim a file: {str(e)}")
+                file_id = None
+
+            if file_id is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), INGEST_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await process_file(file_id)
+            except Exception as e:
+                # e.g. the file was deleted while it was being ingested
+                print(f"Ingest worker failed on file {file_id}: {str(e)}")
+
+    @staticmethod
+    def _claim():
+        db = SessionLocal()
+        try:
+            return claim_next_file(db)
+        finally:
+            db.close()
+
+
+ingest_worker = IngestWorker()
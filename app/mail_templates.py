@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+
+from jinja2 import Environment, FileSystemLoader, nodes
+
+TEMPLATE_FOLDER = os.path.join(os.path.dirname(__file__), "templates")
+# How often a cached template's file is stat'ed for changes
+TEMPLATE_CHECK_SECONDS = float(os.getenv("TEMPLATE_CHECK_SECONDS", "2"))
+
+
+class TemplateCache:
+    """Compiles each template once and recompiles it only when its file's mtime changes."""
+
+    def __init__(self, folder=TEMPLATE_FOLDER, check_seconds=TEMPLATE_CHECK_SECONDS):
+        self.folder = folder
+        self.check_seconds = check_seconds
+        # Same settings as fastapi-mail's template_engine(), so rendered output does not change
+        self.env = Environment(loader=FileSystemLoader(folder))
+        self._templates = {}  # name -> (template, mtime, checked_at)
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        now = time.monotonic()
+        entry = self._templates.get(name)
+        if entry is not None and now - entry[2] < self.check_seconds:
+            return entry[0]
+
+        mtime = os.stat(os.path.join(self.folder, name)).st_mtime_ns
+        with self._lock:
+            entry = self._templates.get(name)
+            if entry is None or entry[1] != mtime:
+                # loader.load compiles from source, bypassing the environment's own cache
+                template = self.env.loader.load(self.env, name)
+            else:
+                template = entry[0]
+            self._templates[name] = (template, mtime, now)
+        return template
+
+    def render(self, name, context):
+        return self.get(name).render(**context)
+
+
+def slots_only(source, env, fields):
+    """Whether every use of the fields in a template source is a plain {{ field }} output.
+
+    Anything else (a filter, an if or for, an attribute, a set) changes with the value and needs a full
+    render, as do templates pulling in other files, whose uses cannot be seen here.
+    """
+    tree = env.parse(source)
+    if any(tree.find_all((nodes.Extends, nodes.Include, nodes.Import, nodes.FromImport))):
+        return False
+    fields = set(fields)
+    plain = {
+        id(child)
+        for output in tree.find_all(nodes.Output)
+        for child in output.nodes
+        if isinstance(child, nodes.Name) and child.name in fields
+    }
+    return all(id(name) in plain for name in tree.find_all(nodes.Name) if name.name in fields)
+
+
+class PreparedTemplate:
+    """A template rendered once with the shared values, leaving slots for the per-recipient fields.
+
+    Rendering for a recipient is then a join of static strings and that recipient's values. If a
+    per-recipient field is used other than as a plain {{ field }} (see slots_only), the template
+    falls back to a full render per recipient.
+    """
+
+    def __init__(self, cache, name, shared, fields):
+        self.cache = cache
+        self.name = name
+        self.shared = dict(shared)
+        self.fields = tuple(fields)
+        self.template = cache.get(name)
+
+        self._parts = None
+        source = cache.env.loader.get_source(cache.env, name)[0]
+        if not slots_only(source, cache.env, self.fields):
+            return
+        markers = {field: f"\x00{i}\x00" for i, field in enumerate(self.fields)}
+        rendered = self.template.render({**self.shared, **markers})
+        if all(marker in rendered for marker in markers.values()):
+            parts = rendered.split("\x00")
+            # Odd positions hold the field index of a slot
+            self._parts = [part if i % 2 == 0 else self.fields[int(part)] for i, part in enumerate(parts)]
+
+    def render(self, values):
+        if self._parts is None:
+            return self.cache.render(self.name, {**self.shared, **values})
+        return "".join(
+            part if i % 2 == 0 else str(values.get(part, ""))
+            for i, part in enumerate(self._parts)
+        )
+
+
+template_cache = TemplateCache()
+
+_prepared = {}
+
+def prepare_template(name, shared, fields):
+    """PreparedTemplate for these shared values and per-recipient fields, reused while the file is unchanged."""
+    key = (name, tuple(sorted((k, str(v)) for k, v in shared.items())), tuple(sorted(fields)))
+    prepared = _prepared.get(key)
+    if prepared is None or prepared.template is not template_cache.get(name):
+        prepared = PreparedTemplate(template_cache, name, shared, sorted(fields))
+        if len(_prepared) > 256:
+            _prepared.clear()
+        _prepared[key] = prepared
+    return prepared
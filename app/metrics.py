@@ -0,0 +1,165 @@
+"""Counters, gauges and histograms for the API and the ingest worker, served in the Prometheus text format on /metrics.
+
+Recording is a dict update under a per-metric lock, cheap enough for every request and every batch;
+values owned elsewhere (pool checkouts, cache hit counts) are read through callbacks only when scraped.
+"""
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a cached query embedding up to extracting a large file
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    """With `callback` the values are read only when /metrics is scraped.
+
+    The callback returns a number, or a dict of label value tuples to numbers.
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple([labels[name] for name in self.labelnames]) if labels else ()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.callback is not None:
+            values = self.callback()
+            items = list(values.items()) if isinstance(values, dict) else [((), values)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# Ingest
+INGEST_STAGE_SECONDS = Histogram(
+    "ingest_stage_seconds", "Time spent per ingest stage and batch (extract, split, embed, insert)", ("stage",)
+)
+INGEST_BATCH_SIZE = Histogram(
+    "ingest_embed_batch_size", "Chunks sent to the model per ingest batch, after reuse by hash", buckets=(1, 8, 16, 32, 64, 128, 256, 512, 1024)
+)
+INGEST_CHUNKS = Counter(
+    "ingest_chunks_total", "Chunks stored, by whether their embedding was computed, reused by hash or copied from an identical file", ("source",)
+)
+INGEST_CHUNKS_PER_SECOND = Gauge("ingest_embed_chunks_per_second", "Embedding throughput of the last ingested batch")
+INGEST_FILES = Counter("ingest_files_total", "Files finished by the ingest worker (done, copied, failed)", ("status",))
+
+# Search
+SEARCH_STAGE_SECONDS = Histogram(
+    "search_stage_seconds", "Time spent per relevance search stage (query_embed, db_search)", ("stage", "mode")
+)
+SEARCH_REQUESTS = Counter("search_requests_total", "Relevance searches, by mode", ("mode",))
+
+# SMTP
+SMTP_SEND_SECONDS = Histogram("smtp_send_seconds", "Time to deliver one message to the SMTP server", ("result",))
+SMTP_CONNECTIONS_OPENED = Counter("smtp_connections_opened_total", "SMTP connections opened (connect, STARTTLS, AUTH)")
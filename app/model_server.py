@@ -0,0 +1,136 @@
+"""One embedding model shared by every API worker on the host, served over a Unix socket.
+
+Run it next to the API and point the workers at the same socket:
+    python -m app.model_server --socket /run/emailauto/embed.sock
+    EMBED_SOCKET=/run/emailauto/embed.sock uvicorn app.app:app --workers 4
+
+Each request is a length-prefixed JSON list of texts, each reply a length-prefixed block of
+int32 rows, int32 dim and rows x dim little-endian float32, so vectors travel as raw numpy buffers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .rag import get_embedding_model
+
+# Batches embedded at the same time by the server
+MODEL_SERVER_WORKERS = int(os.getenv("MODEL_SERVER_WORKERS", "2"))
+
+_LENGTH = struct.Struct(">I")
+# rows == -1 means the rest of the reply is an error message
+_SHAPE = struct.Struct(">ii")
+
+
+async def read_frame(reader):
+    size, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return await reader.readexactly(size)
+
+
+def frame(payload):
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def encode_vectors(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype="<f4")
+    return _SHAPE.pack(*vectors.shape) + vectors.tobytes()
+
+
+def decode_vectors(payload):
+    rows, dim = _SHAPE.unpack_from(payload)
+    if rows < 0:
+        raise RuntimeError(f"Model server error: {payload[_SHAPE.size:].decode('utf-8')}")
+    return np.frombuffer(payload, dtype="<f4", offset=_SHAPE.size).reshape(rows, dim)
+
+
+def _embed_batch(texts):
+    return np.stack(list(get_embedding_model().embed(texts, batch_size=len(texts))))
+
+
+class ModelServerClient:
+    """Embeds through a model server, reusing its socket connections between requests."""
+
+    def __init__(self, path):
+        self.path = path
+        self._idle = []  # (reader, writer)
+
+    async def embed(self, texts):
+        """Embed a list of texts on the server; an empty list only checks that the server is up."""
+        payload = frame(json.dumps(list(texts)).encode("utf-8"))
+        while True:
+            reused = bool(self._idle)
+            reader, writer = self._idle.pop() if reused else await asyncio.open_unix_connection(self.path)
+            try:
+                writer.write(payload)
+                await writer.drain()
+                reply = await read_frame(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue  # The server restarted since this connection was last used, try another one
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            self._idle.append((reader, writer))
+            return decode_vectors(reply)
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+
+class ModelServer:
+    def __init__(self, workers=MODEL_SERVER_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed")
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    texts = json.loads(await read_frame(reader))
+                except asyncio.IncompleteReadError:
+                    break  # Client closed the connection
+                try:
+                    if texts:
+                        vectors = await loop.run_in_executor(self._executor, _embed_batch, texts)
+                    else:
+                        vectors = np.empty((0, 0), dtype=np.float32)
+                    reply = encode_vectors(vectors)
+                except Exception as e:
+                    reply = _SHAPE.pack(-1, 0) + str(e).encode("utf-8")
+                writer.write(frame(reply))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(path, workers=MODEL_SERVER_WORKERS):
+    # Loaded before listening, so once a client can connect the model is ready
+    get_embedding_model()
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(ModelServer(workers).handle, path=path)
+    print(f"Model server listening on {path}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=os.getenv("EMBED_SOCKET") or "/tmp/emailauto-embed.sock")
+    parser.add_argument("--workers", type=int, default=MODEL_SERVER_WORKERS)
+    args = parser.parse_args()
+    asyncio.run(serve(args.socket, args.workers))
+
+
+if __name__ == "__main__":
+    main()
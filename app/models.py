@@ -1,15 +1,47 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, LargeBinary
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, LargeBinary, Float, JSON, Index
+from sqlalchemy.orm import relationship, deferred
 import datetime
 from sqlalchemy.ext.declarative import declarative_base
 from pydantic import BaseModel
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import Vector, HALFVEC
 from typing import Optional, Dict
 from fastapi import Header
 import pgvector
+import os
 # Number of dimensions for embeddings
 N_DIM = 1024
 
+# How TextEmbedding.embedding is stored:
+#   "vector"  float32, 4 KB per chunk
+#   "halfvec" float16, 2 KB per chunk and a half-size HNSW index
+#   "binary"  float32, searched through an HNSW index on the sign bits (128 bytes per chunk) and re-ranked at full precision
+# Switching an existing database needs vector_index.convert_embedding_storage()
+EMBEDDING_FORMATS = ("vector", "halfvec", "binary")
+EMBEDDING_FORMAT = os.getenv("EMBEDDING_FORMAT", "vector")
+if EMBEDDING_FORMAT not in EMBEDDING_FORMATS:
+    raise ValueError(f"Unknown embedding format: {EMBEDDING_FORMAT}")
+
+
+class _NumpyBindMixin:
+    # asyncpg connections have pgvector's binary codec registered (see db.py), so numpy arrays are
+    # handed to it as they are instead of being formatted as text first
+    def bind_processor(self, dialect):
+        if dialect.driver == "asyncpg":
+            return None
+        return super().bind_processor(dialect)
+
+
+class EmbeddingVector(_NumpyBindMixin, Vector):
+    cache_ok = True
+
+
+class EmbeddingHalfVector(_NumpyBindMixin, HALFVEC):
+    cache_ok = True
+
+
+def embedding_type(fmt=EMBEDDING_FORMAT):
+    return EmbeddingHalfVector(N_DIM) if fmt == "halfvec" else EmbeddingVector(N_DIM)
+
 
 # Base class for models
 Base = declarative_base()
@@ -60,7 +92,7 @@ class User(Base):
     biz_emails = Column(Integer, default=0)
     session_active = Column(Boolean, default= False)
     # Relationship to EmailAccount (Multiple email accounts per user)
-    email_accounts = relationship("EmailAccount", back_populates="user", cascade="all, delete-orphan")
+    email_accounts = relationship("EmailAccount", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
    
     def __repr__(self):
         return f"<User(name='{self.first_name}', email='{self.email}')>"
@@ -81,8 +113,12 @@ class EmailAccount(Base):
     
     # Relationships
     user = relationship("User", back_populates="email_accounts")
-    files = relationship("DBFile", back_populates="email_account", cascade="all, delete-orphan")
-    embeddings = relationship("TextEmbedding", back_populates="email_account", cascade="all, delete-orphan")
+    # passive_deletes leaves the children to ON DELETE CASCADE instead of loading and deleting them one by one
+    files = relationship("DBFile", back_populates="email_account", cascade="all, delete-orphan", passive_deletes=True)
+    embeddings = relationship("TextEmbedding", back_populates="email_account", cascade="all, delete-orphan", passive_deletes=True)
+
+    # Keyset pagination of a user's accounts, see app/pagination.py
+    __table_args__ = (Index("ix_email_accounts_user_date_added", "user_id", "date_added", "id"),)
 
     def __repr__(self):
         return f"<EmailAccount(email_address='{self.email_address}')>"
@@ -106,13 +142,36 @@ class DBFile(Base):
     uploaded_at = Column(DateTime, default=datetime.datetime.now)
     file_size = Column(Integer) # in bytes 
     content_type = Column(String)  # e.g., "text/plain"
+
+    # Ingestion state, see app/ingest.py
+    job_id = Column(Integer, ForeignKey("ingest_jobs.id", ondelete="SET NULL"), index=True)
+    status = Column(String, default="done", index=True)  # queued, processing, done, failed
+    raw_path = Column(String)  # Uploaded bytes waiting to be ingested, removed once done
+    content_hash = Column(String(64), index=True)  # sha256 of the uploaded bytes
+    chunks_total = Column(Integer)
+    chunks_done = Column(Integer, default=0)  # Chunks whose embeddings are committed
+    chunks_reused = Column(Integer, default=0)  # Chunks whose embedding was copied instead of computed
+    embed_seconds = Column(Float, default=0.0)
+    heartbeat_at = Column(DateTime)
+    error = Column(String)
+    deleting = Column(Boolean, default=False, index=True)  # Hidden, its chunks are being removed by app/cleanup.py
+    # Mean of the file's chunk embeddings, updated with every committed batch; search ranks files by it first
+    summary_embedding = Column(embedding_type())
+    # Extracted text, compressed once for the whole file (see app/text_store.py); NULL for files ingested before it
+    text_blob = deferred(Column(LargeBinary))
+    text_encoding = Column(String)  # HTTP content coding of text_blob, "zstd" or "deflate"
+    text_length = Column(BigInteger)  # UTF-8 bytes once decompressed
    
 
     #text = Column(String) 
 
     # Relationship
     email_account = relationship("EmailAccount", back_populates="files")
-    embeddings = relationship("TextEmbedding", back_populates="file", cascade="all, delete-orphan")
+    embeddings = relationship("TextEmbedding", back_populates="file", cascade="all, delete-orphan", passive_deletes=True)
+    job = relationship("IngestJob", back_populates="files")
+
+    # Keyset pagination of an account's files, see app/pagination.py
+    __table_args__ = (Index("ix_files_account_uploaded_at", "email_account_id", "uploaded_at", "id"),)
 
     def __repr__(self):
         return f"<File(filename='{self.filename}', email_account_id='{self.email_account_id}')>"
@@ -122,9 +181,39 @@ class DBFile(Base):
             "file_name": self.file_name,
             "file_size": self.file_size,
             "content_type": self.content_type,
-            "uploaded_at": self.uploaded_at
+            "uploaded_at": self.uploaded_at,
+            "status": self.status,
         }
 
+    def progress_json(self):
+        return {
+            "id": self.id,
+            "file_name": self.file_name,
+            "status": self.status,
+            "chunks_done": self.chunks_done or 0,
+            "chunks_total": self.chunks_total,
+            "chunks_per_second": (self.chunks_done or 0) / self.embed_seconds if self.embed_seconds else 0.0,
+            "chunks_reused": self.chunks_reused or 0,
+            "dedup_ratio": (self.chunks_reused or 0) / self.chunks_done if self.chunks_done else 0.0,
+            "error": self.error,
+        }
+
+# IngestJob Model - One per upload request, its files are processed in the background
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    email_account_id = Column(Integer, ForeignKey("email_accounts.id", ondelete="CASCADE"), nullable=False)
+    status = Column(String, default="queued")  # queued, processing, done
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    finished_at = Column(DateTime)
+
+    files = relationship("DBFile", back_populates="job")
+
+    def __repr__(self):
+        return f"<IngestJob(id='{self.id}', status='{self.status}')>"
+
         
 
 # TextEmbedding Model
@@ -134,7 +223,11 @@ class TextEmbedding(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     filename = Column(String, nullable=False)  
     text = Column(String, nullable=False)
-    embedding = Column(Vector(N_DIM))
+    chunk_hash = Column(String(64), index=True)  # sha256 of text, used to reuse embeddings across files
+    # Characters start..end of the file's extracted text (DBFile.text_blob) this chunk was split from
+    start_offset = Column(Integer)
+    end_offset = Column(Integer)
+    embedding = Column(embedding_type())
     email_account_id = Column(Integer, ForeignKey("email_accounts.id", ondelete="CASCADE"), nullable=False)
     file_id = Column(Integer, ForeignKey("files.id", ondelete="CASCADE"), nullable=False)  #Duplicat ? since we can access fil_id from TextEmbedding.file.id
 
@@ -142,6 +235,11 @@ class TextEmbedding(Base):
     email_account = relationship("EmailAccount", back_populates="embeddings")
     file = relationship("DBFile", back_populates="embeddings")
 
+    # Trigram index for the lexical search, see search.lexical_candidates
+    __table_args__ = (
+        Index("text_embeddings_text_trgm", "text", postgresql_using="gin", postgresql_ops={"text": "gin_trgm_ops"}),
+    )
+
     def as_dict(self):
         return {
             "id": self.id,
@@ -150,6 +248,53 @@ class TextEmbedding(Base):
             "embedding": self.embedding,
         }
 
+# Campaign Model - A bulk send from one email account, see app/campaigns.py
+class Campaign(Base):
+    __tablename__ = "campaigns"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    email_account_id = Column(Integer, ForeignKey("email_accounts.id", ondelete="CASCADE"), nullable=False, index=True)
+    subject = Column(String(255), nullable=False)
+    template_body = Column(JSON, nullable=False)  # Values shared by every recipient, see templates/email.html
+    status = Column(String, default="queued")  # queued, sending, done
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    finished_at = Column(DateTime)
+    # Process sending the campaign and its last sign of life, see campaigns.claim_campaign
+    owner = Column(String)
+    heartbeat_at = Column(DateTime)
+
+    recipients = relationship("CampaignRecipient", back_populates="campaign", cascade="all, delete-orphan", passive_deletes=True)
+
+    def __repr__(self):
+        return f"<Campaign(id='{self.id}', status='{self.status}')>"
+
+# CampaignRecipient Model - Delivery status of one recipient of a campaign
+class CampaignRecipient(Base):
+    __tablename__ = "campaign_recipients"
+
+    id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey("campaigns.id", ondelete="CASCADE"), nullable=False)
+    email = Column(String(255), nullable=False)
+    variables = Column(JSON)  # Per-recipient template values
+    status = Column(String, default="pending")  # pending, sending (claimed, may be in flight), sent, failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    sent_at = Column(DateTime)
+
+    campaign = relationship("Campaign", back_populates="recipients")
+
+    __table_args__ = (Index("ix_campaign_recipients_campaign_status", "campaign_id", "status", "id"),)
+
+# TokenRevocation Model - Logouts, read by every API worker to update its token cache, see app/token_cache.py
+class TokenRevocation(Base):
+    __tablename__ = "token_revocations"
+
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String(64))  # sha256 of a revoked access token
+    user_id = Column(Integer)  # Every cached token of this user is dropped
+    expires_at = Column(DateTime, nullable=False, index=True)  # After this the row no longer matters
+
 # # EmailData Model - Stores email data for each email account
 # class EmailData(Base):
 #     __tablename__ = "email_data"
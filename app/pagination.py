@@ -0,0 +1,53 @@
+import base64
+import datetime
+import json
+import os
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+# Rows per page when the client does not ask for a size, and the most it may ask for
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+
+
+def encode_cursor(sort_value, row_id):
+    raw = json.dumps([sort_value.isoformat() if sort_value is not None else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.datetime.fromisoformat(sort_value), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def page_size(limit):
+    if limit is None:
+        return PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def keyset_page(stmt, sort_column, id_column, cursor=None, limit=None):
+    """Newest first page of `stmt` after `cursor`, as (statement, limit).
+
+    Rows are ordered by (sort_column, id_column) descending and the cursor is compared as a row
+    value, so with an index on (..., sort_column, id_column) every page costs the same however deep
+    it is. The statement fetches one extra row, pass the result to next_cursor to trim it.
+    """
+    limit = page_size(limit)
+    if cursor:
+        stmt = stmt.where(tuple_(sort_column, id_column) < decode_cursor(cursor))
+    stmt = stmt.order_by(sort_column.desc(), id_column.desc()).limit(limit + 1)
+    return stmt, limit
+
+
+def next_cursor(rows, limit, sort_key, id_key="id"):
+    """Trim the extra row fetched by keyset_page; returns (rows, cursor of the next page or None)."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[sort_key], last[id_key])
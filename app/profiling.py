@@ -0,0 +1,204 @@
+"""Per-request SQL statement counts and DB time, query budgets and a sampled profiler for slow requests.
+
+Every statement run on either engine while a request is handled is counted, including lazy loads and
+refreshes that never show up in the handler's code:
+    X-DB-Queries: 3
+    X-DB-Time-ms: 4.2
+"""
+import asyncio
+import cProfile
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import event
+
+from .db import engine, async_engine
+from .metrics import Histogram
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # cProfile is used instead
+    Profiler = None
+
+# Add X-DB-Queries / X-DB-Time-ms to every response
+QUERY_STATS_HEADERS = os.getenv("QUERY_STATS_HEADERS", "1") == "1"
+# Statements a request may run before it is reported, 0 for no budget; a handler can set its own with @query_budget
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "0"))
+# Fail requests over budget with an AssertionError instead of printing a warning, for the test suite
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "0") == "1"
+# Fraction of requests run under the profiler, 0 to disable
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Profiled requests slower than this are written to PROFILE_DIR
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "SQL statements run per request", ("route",), buckets=(1, 2, 3, 5, 10, 20, 50, 100, 250)
+)
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent in SQL statements per request", ("route",))
+
+
+class QueryStats:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements = []  # To name the repeated statements when a request goes over budget
+
+
+_current = contextvars.ContextVar("query_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("query_started")
+    if not started:
+        return
+    # Popped even outside a request, the connection is pooled and the entry must not outlive the statement
+    seconds = time.perf_counter() - started.pop()
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.seconds += seconds
+    stats.statements.append(statement)
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute does not run for a failed statement
+    conn = exception_context.connection
+    if exception_context.statement is not None and conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+
+# Async sessions run their statements in a greenlet that shares the request's context, so one listener covers both
+for _engine in (engine, async_engine.sync_engine):
+    event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(_engine, "handle_error", _handle_error)
+
+
+def background_task(coro):
+    """asyncio.create_task for work that outlives the request, so its statements are not counted on the request.
+
+    A task copies the context it is created in, the request's QueryStats included.
+    """
+    token = _current.set(None)
+    try:
+        return asyncio.create_task(coro)
+    finally:
+        _current.reset(token)
+
+
+def query_budget(limit):
+    """Set the statement budget of one endpoint, overriding QUERY_BUDGET."""
+    def decorate(endpoint):
+        endpoint.query_budget = limit
+        return endpoint
+    return decorate
+
+
+def check_budget(stats, scope):
+    budget = getattr(scope.get("endpoint"), "query_budget", QUERY_BUDGET)
+    if not budget or stats.queries <= budget:
+        return
+    repeated = "; ".join(f"{count}x {statement.splitlines()[0][:120]}" for statement, count in Counter(stats.statements).most_common(3))
+    message = f"{scope['method']} {scope['path']} ran {stats.queries} SQL statements, budget is {budget}: {repeated}"
+    if QUERY_BUDGET_STRICT:
+        raise AssertionError(message)
+    print(message)
+
+
+class _SampledProfiler:
+    """pyinstrument when installed (speedscope flame graph), otherwise cProfile (.prof, e.g. for snakeviz)."""
+
+    # cProfile allows one active profiler per process and records the whole event loop thread, other requests
+    # included; pyinstrument follows the request's task only. Either way one request is profiled at a time
+    _busy = threading.Lock()
+
+    def __init__(self):
+        self.profiler = None
+
+    def start(self):
+        if not self._busy.acquire(blocking=False):
+            return False
+        if Profiler is not None:
+            self.profiler = Profiler(async_mode="enabled")
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return True
+
+    def stop(self, scope, elapsed_ms):
+        try:
+            if Profiler is not None:
+                self.profiler.stop()
+            else:
+                self.profiler.disable()
+            if elapsed_ms >= PROFILE_SLOW_MS:
+                self.dump(scope, elapsed_ms)
+        finally:
+            self._busy.release()
+
+    def dump(self, scope, elapsed_ms):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        route = scope["path"].strip("/").replace("/", "_") or "root"
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{route}-{elapsed_ms:.0f}ms")
+        if Profiler is not None:
+            from pyinstrument.renderers import SpeedscopeRenderer
+            path += ".speedscope.json"
+            with open(path, "w") as out:
+                out.write(self.profiler.output(renderer=SpeedscopeRenderer()))
+        else:
+            path += ".prof"
+            self.profiler.dump_stats(path)
+        print(f"Slow request profile written to {path}")
+
+
+class QueryStatsMiddleware:
+    """ASGI middleware: counts SQL statements per request, adds the debug headers, checks budgets and samples profiles.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so the handler runs in the same context as the counter.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats()
+        token = _current.set(stats)
+        profiler = _SampledProfiler() if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE else None
+        profiling = profiler is not None and profiler.start()
+        began = time.perf_counter()
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                # Streamed bodies may run more statements after this point, only the ones so far are in the headers
+                check_budget(stats, scope)
+                if QUERY_STATS_HEADERS:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-db-queries", str(stats.queries).encode()),
+                        (b"x-db-time-ms", f"{stats.seconds * 1000:.1f}".encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _current.reset(token)
+            if profiling:
+                profiler.stop(scope, (time.perf_counter() - began) * 1000)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_DB_QUERIES.observe(stats.queries, route=route)
+            REQUEST_DB_SECONDS.observe(stats.seconds, route=route)
@@ -1,11 +1,122 @@
+import functools
+import os
+import threading
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from fastembed import TextEmbedding
 
+MODEL_NAME = "BAAI/bge-large-en-v1.5"
 
-embeddings = TextEmbedding( model_name= "BAAI/bge-large-en-v1.5" )
-print(f"Embedding model: {embeddings.model}")
+# Tokens per chunk: bge-large reads at most 512, [CLS] and [SEP] included, and silently truncates the rest
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "510"))
+# Tokens repeated at the start of the next chunk
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "0"))
+# Local tokenizer.json to use instead of downloading MODEL_NAME's from the Hugging Face hub
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH")
 
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+# Loaded on first use: importing the app must not cost the model's load time and memory,
+# workers that never embed (auth-only replicas, EMBED_SOCKET clients) never load it
+_embeddings = None
+_embeddings_lock = threading.Lock()
 
+def get_embedding_model():
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                from fastembed import TextEmbedding
+                _embeddings = TextEmbedding( model_name= MODEL_NAME )
+                print(f"Embedding model: {_embeddings.model}")
+    return _embeddings
+
+
+def embedding_model_loaded():
+    return _embeddings is not None
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """The model's own tokenizer, loaded once, without truncation or padding so it measures true lengths."""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from tokenizers import Tokenizer
+                tokenizer = Tokenizer.from_file(TOKENIZER_PATH) if TOKENIZER_PATH else Tokenizer.from_pretrained(MODEL_NAME)
+                tokenizer.no_truncation()
+                tokenizer.no_padding()
+                _tokenizer = tokenizer
+    return _tokenizer
+
+
+# The splitter measures most pieces twice, once to find pieces that fit and again to merge them
+@functools.lru_cache(maxsize=4096)
+def token_length(text):
+    return len(get_tokenizer().encode(text, add_special_tokens=False))
+
+
+_text_splitter = None
+
+def get_text_splitter():
+    """Splits on paragraphs, lines, then words, into chunks that fill the model's token window."""
+    global _text_splitter
+    if _text_splitter is None:
+        _text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS, length_function=token_length
+        )
+    return _text_splitter
+
+
+# `from .rag import embeddings` / `text_splitter` keep working, they load the model or the tokenizer at that point
+def __getattr__(name):
+    if name == "embeddings":
+        return get_embedding_model()
+    if name == "text_splitter":
+        return get_text_splitter()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Characters buffered before splitting a stream of text, only the unfinished tail is carried over
+SPLIT_WINDOW = 16 * 1000
+
+def _spans(buffer, offset, chunks):
+    position = 0
+    for chunk in chunks:
+        start = buffer.find(chunk, position)
+        if start < 0:  # Not a verbatim substring, which the splitters in use never produce
+            yield None, None, chunk
+            continue
+        position = start + 1
+        yield offset + start, offset + start + len(chunk), chunk
+
+
+def iter_chunk_spans(pieces, splitter=None, window=SPLIT_WINDOW):
+    """Split a stream of text pieces incrementally, holding about `window` characters at a time.
+
+    Yields (start, end, chunk), the chunk's character offsets in the concatenated pieces.
+    """
+    splitter = splitter or get_text_splitter()
+    buffer = ""
+    offset = 0  # Position of the buffer in the whole text
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) < window:
+            continue
+        chunks = splitter.split_text(buffer)
+        if len(chunks) < 2:
+            continue
+        yield from _spans(buffer, offset, chunks[:-1])
+        # Keep the raw text of the last chunk, with its surrounding whitespace, so it can grow with the next piece
+        tail = buffer.rfind(chunks[-1])
+        buffer = buffer[tail:]
+        offset += tail
+    if buffer:
+        yield from _spans(buffer, offset, splitter.split_text(buffer))
+
+
+def iter_chunks(pieces, splitter=None, window=SPLIT_WINDOW):
+    """Split a stream of text pieces incrementally, holding about `window` characters at a time."""
+    for _, _, chunk in iter_chunk_spans(pieces, splitter, window):
+        yield chunk
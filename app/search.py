@@ -0,0 +1,267 @@
+import os
+
+from sqlalchemy import Integer, bindparam, cast, column, func, literal, select, true, union_all, values
+
+from .models import DBFile, TextEmbedding, EMBEDDING_FORMAT, embedding_type
+from .vector_index import binary_quantized, set_search_params, set_search_params_async
+
+# Closest chunks returned per query vector
+MATCHES_PER_VECTOR = 2
+# Distance threshold, adjust as needed
+MAX_DISTANCE = .8
+# With binary storage, candidates taken from the bit index per returned chunk before re-ranking at full precision
+BINARY_RERANK_FACTOR = int(os.getenv("BINARY_RERANK_FACTOR", "10"))
+
+# "vector", "hybrid" (lexical and vector lists fused), "lexical" (no model inference) or "auto"
+SEARCH_MODES = ("vector", "hybrid", "lexical", "auto")
+SEARCH_MODE = os.getenv("SEARCH_MODE", "vector")
+# In "auto" mode, queries of at most this many words use the lexical search only
+SHORT_QUERY_WORDS = int(os.getenv("SHORT_QUERY_WORDS", "3"))
+# Longer queries are left out of the lexical list of a hybrid search, trigram matching on long text is slow and unselective
+LEXICAL_MAX_CHARS = 256
+# Candidates per ranked list and chunks returned after reciprocal rank fusion
+CANDIDATES_PER_LIST = 50
+FUSED_MATCHES = 5
+# Rank offset of reciprocal rank fusion, 60 is the usual choice
+RRF_K = 60
+# Files kept per query vector by their summary embedding before chunks are searched, 0 to search every chunk of the account
+SUMMARY_TOP_FILES = int(os.getenv("SUMMARY_TOP_FILES", "20"))
+
+FILE_COLUMNS = (DBFile.id, DBFile.file_name, DBFile.file_size, DBFile.content_type, DBFile.uploaded_at, DBFile.status)
+
+
+def query_vectors(vectors, fmt=EMBEDDING_FORMAT):
+    """VALUES list of (query_index, query_vector), one row per query vector."""
+    vector_type = embedding_type(fmt)
+    return values(
+        column("query_index", Integer),
+        column("query_vector", vector_type),
+        name="queries",
+    ).data([
+        # Cast explicitly, an untyped parameter in VALUES would be resolved as text
+        (i, cast(bindparam(f"query_vector_{i}", vector, type_=vector_type), vector_type))
+        for i, vector in enumerate(vectors)
+    ])
+
+
+def top_files(email_account_id, queries, limit=SUMMARY_TOP_FILES):
+    """Ids of the account's files whose summary embedding is closest to any row of `queries`.
+
+    Summaries are means of unit vectors, shorter the more a file's chunks differ, so files are ranked
+    by direction (cosine distance). The account's files are few next to its chunks, they are scanned exactly.
+    """
+    distance = DBFile.summary_embedding.cosine_distance(queries.c.query_vector)
+    hits = (
+        select(DBFile.id)
+        .where(DBFile.email_account_id == email_account_id, DBFile.deleting.isnot(True))
+        .order_by(distance)  # Files without a summary yet come last
+        .limit(limit)
+        .lateral("file_hits")
+    )
+    return select(hits.c.id).select_from(queries).join(hits, true())
+
+
+def nearest_chunks(email_account_id, queries, limit, max_distance=None, fmt=EMBEDDING_FORMAT, files=None):
+    """LATERAL top-k of the account's chunks for each row of `queries`, closest first.
+
+    With binary storage the top-k is re-ranked from a larger candidate set found by Hamming
+    distance on the bit index. `files` (a select of file ids) restricts the search to those files.
+    """
+    chunks = TextEmbedding.__table__
+    if fmt == "binary":
+        # Candidates closest by Hamming distance on the bit index, re-ranked below at full precision
+        candidates = (
+            select(TextEmbedding.id, TextEmbedding.text, TextEmbedding.file_id, TextEmbedding.embedding,
+                   TextEmbedding.email_account_id)
+            .where(TextEmbedding.email_account_id == email_account_id)
+        )
+        if files is not None:
+            candidates = candidates.where(TextEmbedding.file_id.in_(files))
+        chunks = (
+            candidates
+            .order_by(binary_quantized(TextEmbedding.embedding).op("<~>")(func.binary_quantize(queries.c.query_vector)))
+            .limit(limit * BINARY_RERANK_FACTOR)
+            .lateral("candidates")
+        )
+
+    distance = chunks.c.embedding.l2_distance(queries.c.query_vector)
+    hits = (
+        select(
+            chunks.c.id,
+            chunks.c.text,
+            chunks.c.file_id,
+            distance.label("distance"),
+        )
+        .where(chunks.c.email_account_id == email_account_id)
+    )
+    if max_distance is not None:
+        hits = hits.where(distance <= max_distance)
+    if files is not None and fmt != "binary":
+        hits = hits.where(chunks.c.file_id.in_(files))
+    return (
+        hits
+        .order_by(distance)  # Order by smallest distance (most accurate matches)
+        .limit(limit)
+        .lateral("hits")
+    )
+
+
+def candidate_files(email_account_id, queries, top=SUMMARY_TOP_FILES):
+    """First stage of a search: the top files by summary embedding, as a CTE, or None to search every file."""
+    if not top:
+        return None
+    return select(top_files(email_account_id, queries, top).cte("top_files").c.id)
+
+
+def similar_chunks_query(email_account_id, vectors, limit=MATCHES_PER_VECTOR, max_distance=MAX_DISTANCE,
+                         fmt=EMBEDDING_FORMAT, top=SUMMARY_TOP_FILES):
+    """One statement that finds the closest chunks for every query vector, with their file joined in.
+
+    The query vectors are a VALUES list and each one drives a LATERAL top-k search, so the whole
+    search is a single round trip whatever the number of vectors. With `top` the chunks are only
+    searched within the files whose summary is closest to a query vector.
+    """
+    queries = query_vectors(vectors, fmt)
+    hits = nearest_chunks(email_account_id, queries, limit, max_distance, fmt, candidate_files(email_account_id, queries, top))
+
+    return (
+        select(
+            queries.c.query_index,
+            hits.c.text,
+            hits.c.distance,
+            *FILE_COLUMNS,
+        )
+        .select_from(queries)
+        .join(hits, true())
+        .join(DBFile, DBFile.id == hits.c.file_id)
+        .where(DBFile.deleting.isnot(True))
+        .order_by(queries.c.query_index, hits.c.distance)
+    )
+
+
+def lexical_candidates(email_account_id, query, limit=CANDIDATES_PER_LIST):
+    """The account's chunks containing words similar to `query`, ranked by pg_trgm word similarity.
+
+    `<%` is answered by the trigram GIN index on text, its cutoff is pg_trgm.word_similarity_threshold.
+    """
+    similarity = func.word_similarity(query, TextEmbedding.text)
+    ranked = (
+        select(TextEmbedding.id, func.row_number().over(order_by=similarity.desc()).label("rank"))
+        .where(TextEmbedding.email_account_id == email_account_id)
+        .where(literal(query).op("<%")(TextEmbedding.text))
+        .order_by(similarity.desc())
+        .limit(limit)
+        .subquery("lexical")
+    )
+    return select(ranked.c.id, ranked.c.rank)
+
+
+def semantic_candidates(email_account_id, vectors, limit=CANDIDATES_PER_LIST, fmt=EMBEDDING_FORMAT, top=SUMMARY_TOP_FILES):
+    """The closest chunks of every query vector, ranked per vector. No distance cutoff, fusion decides."""
+    queries = query_vectors(vectors, fmt)
+    hits = nearest_chunks(email_account_id, queries, limit, fmt=fmt, files=candidate_files(email_account_id, queries, top))
+    return (
+        select(
+            hits.c.id,
+            func.row_number().over(partition_by=queries.c.query_index, order_by=hits.c.distance).label("rank"),
+        )
+        .select_from(queries)
+        .join(hits, true())
+    )
+
+
+def fused_chunks_query(email_account_id, query=None, vectors=(), limit=FUSED_MATCHES,
+                       candidates=CANDIDATES_PER_LIST, fmt=EMBEDDING_FORMAT, top=SUMMARY_TOP_FILES):
+    """Reciprocal rank fusion of the lexical list and one list per query vector, in a single statement.
+
+    A chunk scores the sum of 1 / (RRF_K + rank) over the lists it appears in, so chunks found by
+    both kinds of search come first. Without vectors this is the lexical search alone.
+    """
+    lists = []
+    if query and (len(query) <= LEXICAL_MAX_CHARS or not len(vectors)):
+        lists.append(lexical_candidates(email_account_id, query, candidates))
+    if len(vectors):
+        lists.append(semantic_candidates(email_account_id, vectors, candidates, fmt, top))
+    if not lists:
+        raise ValueError("A search needs a query or at least one vector")
+
+    ranked = (union_all(*lists) if len(lists) > 1 else lists[0]).subquery("ranked")
+    score = func.sum(1.0 / (RRF_K + ranked.c.rank)).label("score")
+    fused = (
+        select(ranked.c.id, score)
+        .group_by(ranked.c.id)
+        .order_by(score.desc())
+        .limit(limit)
+        .subquery("fused")
+    )
+
+    return (
+        select(
+            TextEmbedding.text,
+            fused.c.score,
+            *FILE_COLUMNS,
+        )
+        .select_from(fused)
+        .join(TextEmbedding, TextEmbedding.id == fused.c.id)
+        .join(DBFile, DBFile.id == TextEmbedding.file_id)
+        .where(DBFile.deleting.isnot(True))
+        .order_by(fused.c.score.desc())
+    )
+
+
+def choose_search_mode(query, mode=None):
+    """Search mode for a query; "auto" sends short queries (product codes, names) to the lexical search."""
+    mode = mode or SEARCH_MODE
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+    if mode == "auto":
+        return "lexical" if len(query.split()) <= SHORT_QUERY_WORDS else "hybrid"
+    return mode
+
+
+def group_by_file(rows):
+    """Aggregate search rows into (files, {file_id: [snippets]}), files in order of first appearance."""
+    files = []
+    files_to_texts = {}
+    for row in rows:
+        if row.id not in files_to_texts:
+            files.append({
+                "id": row.id,
+                "file_name": row.file_name,
+                "file_size": row.file_size,
+                "content_type": row.content_type,
+                "uploaded_at": row.uploaded_at,
+                "status": row.status,
+            })
+            files_to_texts[row.id] = [row.text]
+        else:
+            files_to_texts[row.id].append(row.text)
+    return files, files_to_texts
+
+
+def most_similar_files(db, email_account_id, vectors, limit=MATCHES_PER_VECTOR, max_distance=MAX_DISTANCE, ef_search=None, top=SUMMARY_TOP_FILES):
+    if ef_search is not None:
+        set_search_params(db, ef_search=ef_search)
+    rows = db.execute(similar_chunks_query(email_account_id, vectors, limit, max_distance, top=top))
+    return group_by_file(rows)
+
+
+async def most_similar_files_async(db, email_account_id, vectors, limit=MATCHES_PER_VECTOR, max_distance=MAX_DISTANCE, ef_search=None, top=SUMMARY_TOP_FILES):
+    if ef_search is not None:
+        await set_search_params_async(db, ef_search=ef_search)
+    rows = await db.execute(similar_chunks_query(email_account_id, vectors, limit, max_distance, top=top))
+    return group_by_file(rows)
+
+
+def fused_files(db, email_account_id, query=None, vectors=(), limit=FUSED_MATCHES, ef_search=None, top=SUMMARY_TOP_FILES):
+    if ef_search is not None:
+        set_search_params(db, ef_search=ef_search)
+    rows = db.execute(fused_chunks_query(email_account_id, query, vectors, limit, top=top))
+    return group_by_file(rows)
+
+
+async def fused_files_async(db, email_account_id, query=None, vectors=(), limit=FUSED_MATCHES, ef_search=None, top=SUMMARY_TOP_FILES):
+    if ef_search is not None:
+        await set_search_params_async(db, ef_search=ef_search)
+    rows = await db.execute(fused_chunks_query(email_account_id, query, vectors, limit, top=top))
+    return group_by_file(rows)
@@ -1,15 +1,30 @@
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.utils import formataddr, formatdate, make_msgid
+import functools
 import os
 from fastapi import BackgroundTasks
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
 from dotenv import load_dotenv
 from .models import User 
+from .smtp_pool import get_pool
+from .mail_templates import TEMPLATE_FOLDER, template_cache
 load_dotenv()
 
 def set_conf( configuration):
-    if configuration["sender"] == "Dripity":
+    return _build_conf(
+        configuration["sender"] == "Dripity",
+        configuration.get("sender_email"),
+        configuration.get("sender_password"),
+        configuration["visible_tag"],
+    )
+
+
+# ConnectionConfig is a pydantic settings object, build it once per sender and reuse it
+@functools.lru_cache(maxsize=256)
+def _build_conf(from_dripity, sender_email, sender_password, visible_tag):
+    if from_dripity:
         
         conf = ConnectionConfig(
             MAIL_USERNAME=os.getenv("MAIL_ADDRESS"),
@@ -19,43 +34,55 @@ def set_conf( configuration):
             MAIL_SERVER=os.getenv("MAIL_SERVER"),
             MAIL_STARTTLS = True, # or False depending on your provider
             MAIL_SSL_TLS = False,
-            MAIL_FROM_NAME= configuration["visible_tag"],
+            MAIL_FROM_NAME= visible_tag,
             USE_CREDENTIALS=True,
-            TEMPLATE_FOLDER = os.path.join(os.path.dirname(__file__), "templates"),
+            TEMPLATE_FOLDER = TEMPLATE_FOLDER,
         )
 
     else:
         conf = ConnectionConfig(
-            MAIL_USERNAME=configuration["sender_email"],
-            MAIL_PASSWORD=configuration["sender_password"],
-            MAIL_FROM= configuration["sender_email"],
+            MAIL_USERNAME=sender_email,
+            MAIL_PASSWORD=sender_password,
+            MAIL_FROM= sender_email,
             MAIL_PORT= 587 ,
             MAIL_SERVER=os.getenv("MAIL_SERVER"),
             MAIL_STARTTLS = True, # or False depending on your provider
             MAIL_SSL_TLS = False,
-            MAIL_FROM_NAME= configuration["visible_tag"],
+            MAIL_FROM_NAME= visible_tag,
             USE_CREDENTIALS=True,
-            TEMPLATE_FOLDER = os.path.join(os.path.dirname(__file__), "templates"),
+            TEMPLATE_FOLDER = TEMPLATE_FOLDER,
         )
 
 
     return conf
 
 
+def build_message(conf: ConnectionConfig, recipient: str, subject: str, html: str):
+    message = MIMEMultipart("mixed")
+    message["Subject"] = subject
+    message["From"] = formataddr((conf.MAIL_FROM_NAME, conf.MAIL_FROM))
+    message["To"] = recipient
+    message["Date"] = formatdate(localtime=True)
+    message["Message-ID"] = make_msgid()
+    message.attach(MIMEText(html, "html", "utf-8"))
+    return message
 
 
-async def send_email_async(conf: ConnectionConfig, recipient:str , email_body: dict):
-    
-    message = MessageSchema(
-        subject=email_body["title"],
-        recipients=[recipient],
-        template_body=email_body,
-        subtype='html',
-    )
-    
-    fm = FastMail(conf)
+# Render the MIME message ahead of sending, the compiled template is cached in app/mail_templates.py
+def render_message(conf: ConnectionConfig, recipient: str, email_body: dict):
+    html = template_cache.render('email.html', email_body)
+    return build_message(conf, recipient, email_body["title"], html)
 
-    await fm.send_message(message, template_name='email.html')
+
+async def send_message_async(conf: ConnectionConfig, message):
+    if conf.SUPPRESS_SEND:
+        return
+    # Reuses a logged-in connection for this sender instead of a new SMTP handshake per message
+    await get_pool(conf).send_message(message)
+
+
+async def send_email_async(conf: ConnectionConfig, recipient:str , email_body: dict):
+    await send_message_async(conf, render_message(conf, recipient, email_body))
 
 
 
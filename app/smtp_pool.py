@@ -0,0 +1,167 @@
+import asyncio
+import os
+import time
+
+import aiosmtplib
+from fastapi_mail import ConnectionConfig
+
+from .metrics import SMTP_SEND_SECONDS, SMTP_CONNECTIONS_OPENED
+
+# Open connections per (server, username)
+SMTP_POOL_MAX_CONNECTIONS = int(os.getenv("SMTP_POOL_MAX_CONNECTIONS", "4"))
+# Idle connections older than this are closed instead of reused
+SMTP_POOL_MAX_IDLE = float(os.getenv("SMTP_POOL_MAX_IDLE", "60"))
+# Connections idle for longer than this are checked with NOOP before they are reused
+SMTP_POOL_KEEPALIVE_CHECK = float(os.getenv("SMTP_POOL_KEEPALIVE_CHECK", "10"))
+# Seconds between sweeps that close connections idle for SMTP_POOL_MAX_IDLE and forget unused pools
+SMTP_POOL_REAP_SECONDS = float(os.getenv("SMTP_POOL_REAP_SECONDS", "30"))
+
+
+class SMTPConnectionPool:
+    """Logged-in SMTP connections for one sender, reused across messages to skip the connect/STARTTLS/AUTH handshake."""
+
+    def __init__(self, conf: ConnectionConfig, max_connections=SMTP_POOL_MAX_CONNECTIONS, max_idle=SMTP_POOL_MAX_IDLE):
+        self.conf = conf
+        self.max_idle = max_idle
+        self._idle = []  # (client, last_used), most recently used last
+        self._slots = asyncio.Semaphore(max_connections)
+        self._sending = 0  # Messages being sent, counted before the first await so the reaper never drops a pool in use
+
+    async def _connect(self):
+        conf = self.conf
+        client = aiosmtplib.SMTP(
+            hostname=conf.MAIL_SERVER,
+            port=conf.MAIL_PORT,
+            use_tls=conf.MAIL_SSL_TLS,
+            start_tls=conf.MAIL_STARTTLS,
+            validate_certs=conf.VALIDATE_CERTS,
+            timeout=conf.TIMEOUT,
+        )
+        await client.connect()
+        if conf.USE_CREDENTIALS:
+            await client.login(conf.MAIL_USERNAME, conf.MAIL_PASSWORD.get_secret_value())
+        SMTP_CONNECTIONS_OPENED.inc()
+        return client
+
+    @staticmethod
+    async def _close(client):
+        try:
+            await client.quit()
+        except Exception:
+            client.close()
+
+    async def _acquire(self):
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                client, last_used = self._idle.pop()
+                idle_for = time.monotonic() - last_used
+                if idle_for > self.max_idle or not client.is_connected:
+                    await self._close(client)
+                    continue
+                if idle_for > SMTP_POOL_KEEPALIVE_CHECK:
+                    try:
+                        await client.noop()
+                    except aiosmtplib.SMTPException:
+                        client.close()
+                        continue
+                return client, True
+            return await self._connect(), False
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, client, reusable):
+        if reusable and client.is_connected:
+            self._idle.append((client, time.monotonic()))
+        else:
+            client.close()
+        self._slots.release()
+
+    async def send_message(self, message):
+        began = time.perf_counter()
+        self._sending += 1
+        try:
+            await self._send_message(message)
+        except BaseException:
+            SMTP_SEND_SECONDS.observe(time.perf_counter() - began, result="error")
+            raise
+        finally:
+            self._sending -= 1
+        SMTP_SEND_SECONDS.observe(time.perf_counter() - began, result="sent")
+
+    async def _send_message(self, message):
+        client, reused = await self._acquire()
+        try:
+            await client.send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:
+            self._release(client, False)
+            if not reused:
+                raise
+            # The server dropped an idle connection, retry once on a fresh one
+            client, _ = await self._acquire()
+            try:
+                await client.send_message(message)
+            except BaseException:
+                self._release(client, False)
+                raise
+        except BaseException:
+            self._release(client, False)
+            raise
+        self._release(client, True)
+
+    @property
+    def empty(self):
+        return not self._idle and not self._sending
+
+    async def reap(self):
+        """Close connections idle for longer than max_idle."""
+        now = time.monotonic()
+        expired = [client for client, last_used in self._idle if now - last_used > self.max_idle]
+        self._idle = [(client, last_used) for client, last_used in self._idle if now - last_used <= self.max_idle]
+        await asyncio.gather(*(self._close(client) for client in expired), return_exceptions=True)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(self._close(client) for client, _ in idle), return_exceptions=True)
+
+
+_pools = {}
+_reaper = None
+
+def get_pool(conf: ConnectionConfig):
+    key = (conf.MAIL_SERVER, conf.MAIL_PORT, conf.MAIL_USERNAME, conf.MAIL_PASSWORD.get_secret_value())
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = SMTPConnectionPool(conf)
+        _start_reaper()
+    return pool
+
+
+def _start_reaper():
+    global _reaper
+    if _reaper is None or _reaper.done():
+        _reaper = asyncio.create_task(_reap_pools())
+
+
+async def _reap_pools():
+    # Runs while there are pools, e.g. one-off verification senders are forgotten once their connection expires
+    while _pools:
+        await asyncio.sleep(SMTP_POOL_REAP_SECONDS)
+        for key, pool in list(_pools.items()):
+            try:
+                await pool.reap()
+            except Exception as e:
+                print(f"SMTP pool reaper failed: {str(e)}")
+                continue
+            # Checked after the awaits above, a message may have started on this pool meanwhile
+            if pool.empty and _pools.get(key) is pool:
+                del _pools[key]
+
+
+async def close_all_pools():
+    if _reaper is not None:
+        _reaper.cancel()
+    pools = list(_pools.values())
+    _pools.clear()
+    await asyncio.gather(*(pool.close() for pool in pools), return_exceptions=True)
@@ -0,0 +1,144 @@
+"""Extracted document text, stored once per file as a compressed blob (files.text_blob).
+
+The ingest worker compresses the text as it streams past the splitter; each chunk keeps the character
+offsets of its text in the document (text_embeddings.start_offset / end_offset). The encodings are HTTP
+content codings, so get_file can send the stored bytes as they are to clients that accept them:
+    zstd     when zstandard is installed
+    deflate  zlib otherwise
+"""
+import os
+import zlib
+
+from sqlalchemy import func, select, text
+
+from .db import engine
+from .models import DBFile
+
+try:
+    import zstandard
+except ImportError:  # Text is stored with zlib
+    zstandard = None
+
+# Compression level of new blobs, zstd 1-22 or zlib 1-9
+TEXT_COMPRESSION_LEVEL = int(os.getenv("TEXT_COMPRESSION_LEVEL", "9"))
+# Bytes read from the blob per query when a file is downloaded
+TEXT_STREAM_BUFFER = int(os.getenv("TEXT_STREAM_BUFFER", str(1024 * 1024)))
+
+
+def ensure_file_text():
+    """Add the text blob and chunk offset columns to an existing database. Files ingested before keep a NULL blob."""
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE files ADD COLUMN IF NOT EXISTS text_blob bytea"))
+        conn.execute(text("ALTER TABLE files ADD COLUMN IF NOT EXISTS text_encoding varchar"))
+        conn.execute(text("ALTER TABLE files ADD COLUMN IF NOT EXISTS text_length bigint"))
+        conn.execute(text("ALTER TABLE text_embeddings ADD COLUMN IF NOT EXISTS start_offset integer"))
+        conn.execute(text("ALTER TABLE text_embeddings ADD COLUMN IF NOT EXISTS end_offset integer"))
+        # Already compressed: stored out of line without pglz, so a range read only fetches the TOAST chunks it needs
+        conn.execute(text("ALTER TABLE files ALTER COLUMN text_blob SET STORAGE EXTERNAL"))
+
+
+class TextRecorder:
+    """Compresses the pieces of a document as they are passed through record()."""
+
+    def __init__(self, level=TEXT_COMPRESSION_LEVEL):
+        if zstandard is not None:
+            self.encoding = "zstd"
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self.encoding = "deflate"
+            self._compressor = zlib.compressobj(min(level, 9))
+        self._parts = []
+        self.length = 0  # UTF-8 bytes
+
+    def record(self, pieces):
+        for piece in pieces:
+            data = piece.encode("utf-8")
+            self.length += len(data)
+            self._parts.append(self._compressor.compress(data))
+            yield piece
+
+    def finish(self):
+        """The compressed document, once every piece went through record()."""
+        self._parts.append(self._compressor.flush())
+        return b"".join(self._parts)
+
+
+def decompressor(encoding):
+    """An object with decompress(block) and flush(), for a blob stored with `encoding`."""
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to read this file's text")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj()
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """Whether an Accept-Encoding header allows `encoding`; q=0 refuses it, "*" stands for any coding not listed."""
+    qualities = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.partition(";")
+        params = params.strip().lower()
+        try:
+            qualities[name.strip().lower()] = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            continue
+    return qualities.get(encoding, qualities.get("*", 0.0)) > 0
+
+
+def parse_range(header, size):
+    """(start, end) of a single "bytes=" Range header for a body of `size` bytes, end exclusive.
+
+    None when the header is missing, malformed or asks for several ranges: the whole body is sent.
+    Raises ValueError when the range cannot be satisfied (416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    if (first and not first.isdigit()) or (last and not last.isdigit()) or not (first or last):
+        return None
+    if not first:  # The last N bytes
+        if not int(last) or not size:
+            raise ValueError(f"Range {header} cannot be satisfied, the body has {size} bytes")
+        return max(size - int(last), 0), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(f"Range {header} cannot be satisfied, the body has {size} bytes")
+    return start, min(int(last) + 1, size) if last else size
+
+
+def blob_info_query(file_id):
+    return select(DBFile.text_encoding, DBFile.text_length, func.octet_length(DBFile.text_blob).label("blob_length")).where(
+        DBFile.id == file_id
+    )
+
+
+async def iter_blob(db, file_id, start=0, end=None, buffer=TEXT_STREAM_BUFFER):
+    """Bytes start..end (exclusive) of a file's stored blob, read TEXT_STREAM_BUFFER at a time."""
+    if end is None:
+        end = await db.scalar(select(func.octet_length(DBFile.text_blob)).where(DBFile.id == file_id))
+    while start < end:
+        size = min(buffer, end - start)
+        # substring() is 1-based
+        block = await db.scalar(select(func.substring(DBFile.text_blob, start + 1, size)).where(DBFile.id == file_id))
+        if not block:
+            return
+        yield block
+        start += len(block)
+
+
+async def iter_text(db, file_id, encoding, start=0, end=None, buffer=TEXT_STREAM_BUFFER):
+    """Bytes start..end (exclusive) of a file's decompressed UTF-8 text; a range is decompressed from the beginning."""
+    stream = decompressor(encoding)
+    position = 0
+    async for block in iter_blob(db, file_id, buffer=buffer):
+        data = stream.decompress(block)
+        block_start, position = position, position + len(data)
+        if data and position > start:
+            yield data[max(start - block_start, 0):None if end is None else end - block_start]
+        if end is not None and position >= end:
+            return
+    data = stream.flush()
+    if data and position + len(data) > start:
+        yield data[max(start - position, 0):None if end is None else end - position]
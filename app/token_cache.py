@@ -0,0 +1,197 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, status
+from jose import JWTError, jwt
+from sqlalchemy import delete, select
+
+from .models import TokenRevocation
+
+# Verified access tokens kept before the least recently used one is evicted
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+# Upper bound on how long a verified token is trusted without going back to refresh_tokens,
+# an entry never outlives the token's own exp claim
+TOKEN_CACHE_MAX_TTL = float(os.getenv("TOKEN_CACHE_MAX_TTL", "300"))
+# How often a process reads the logouts of the other processes; a revoked token may still be accepted
+# by another API worker for up to this long
+TOKEN_REVOCATION_SYNC_SECONDS = float(os.getenv("TOKEN_REVOCATION_SYNC_SECONDS", "2"))
+
+
+def _raw_token(access_token):
+    if access_token and access_token.lower().startswith("bearer "):
+        return access_token[7:].strip()
+    return access_token
+
+
+def token_key(access_token, user_id):
+    raw = _raw_token(access_token) or ""
+    return hashlib.sha256(f"{raw}\x00{user_id}".encode("utf-8")).hexdigest()
+
+
+def token_expiry(access_token):
+    """exp claim of an access token that refresh_tokens has already verified, None if it has none."""
+    try:
+        exp = jwt.get_unverified_claims(_raw_token(access_token)).get("exp")
+    except JWTError:
+        return None
+    return float(exp) if exp is not None else None
+
+
+class TokenCache:
+    """Bounded LRU cache of refresh_tokens results for access tokens that were verified recently.
+
+    Entries expire with the token, or after max_ttl, whichever comes first. Revoked tokens are
+    remembered until they expire so a logged out token is rejected without a database lookup.
+    The cache is per process: revocations are also written to token_revocations and each process
+    reads the unexpired rows at most every sync_seconds, which bounds how long a logout takes to
+    reach every worker.
+    """
+
+    def __init__(self, max_entries=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_MAX_TTL, sync_seconds=TOKEN_REVOCATION_SYNC_SECONDS):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.sync_seconds = sync_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (tokens, user_id, expires_at)
+        self._revoked = {}  # sha256 of the raw token -> exp
+        self._lock = threading.Lock()
+        self._synced_at = 0.0
+        self._applied = set()  # ids of the token_revocations rows already applied
+
+    @staticmethod
+    def _revocation_key(access_token):
+        return hashlib.sha256((_raw_token(access_token) or "").encode("utf-8")).hexdigest()
+
+    def is_revoked(self, access_token):
+        key = self._revocation_key(access_token)
+        with self._lock:
+            exp = self._revoked.get(key)
+            if exp is None:
+                return False
+            if exp < time.time():
+                del self._revoked[key]
+                return False
+            return True
+
+    def get(self, access_token, user_id):
+        key = token_key(access_token, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(entry[0])
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def put(self, access_token, user_id, tokens):
+        exp = token_expiry(access_token)
+        if exp is None:
+            return
+        expires_at = min(exp, time.time() + self.max_ttl)
+        with self._lock:
+            key = token_key(access_token, user_id)
+            self._entries[key] = (dict(tokens), str(user_id), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _revoke_key(self, key, exp):
+        now = time.time()
+        with self._lock:
+            self._revoked[key] = exp
+            # Expired tokens fail verification anyway, so they need not stay on the list
+            for key in [key for key, exp in self._revoked.items() if exp < now]:
+                del self._revoked[key]
+
+    def _drop_user(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[1] == user_id]:
+                del self._entries[key]
+
+    def revoke(self, access_token, db=None):
+        """Refuse an access token until it expires, in every process when `db` is given."""
+        key = self._revocation_key(access_token)
+        exp = token_expiry(access_token) or time.time() + self.max_ttl
+        self._revoke_key(key, exp)
+        if db is not None:
+            _record(db, TokenRevocation(token_hash=key, expires_at=datetime.datetime.fromtimestamp(exp)))
+
+    def revoke_user(self, user_id, db=None):
+        """Drop every cached token of a user, their next request goes through refresh_tokens again."""
+        self._drop_user(user_id)
+        if db is not None:
+            # Entries cached before now are gone from every cache after max_ttl, so the row is kept that long
+            expires_at = datetime.datetime.now() + datetime.timedelta(seconds=self.max_ttl)
+            _record(db, TokenRevocation(user_id=int(user_id), expires_at=expires_at))
+
+    def sync(self, db):
+        """Apply the revocations other processes wrote since the last call, at most every sync_seconds.
+
+        Every unexpired row is read, not only ids above the last one seen: ids are taken at insert time,
+        so a logout can commit after a row with a higher id. _record keeps the table small.
+        """
+        now = time.monotonic()
+        if now - self._synced_at < self.sync_seconds:
+            return
+        self._synced_at = now
+        rows = db.execute(
+            select(TokenRevocation).where(TokenRevocation.expires_at > datetime.datetime.now())
+        ).scalars().all()
+        for row in rows:
+            if row.id in self._applied:
+                continue
+            if row.token_hash is not None:
+                self._revoke_key(row.token_hash, row.expires_at.timestamp())
+            if row.user_id is not None:
+                self._drop_user(row.user_id)
+        self._applied = {row.id for row in rows}
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "revoked": len(self._revoked),
+        }
+
+
+def _record(db, revocation):
+    db.add(revocation)
+    db.execute(delete(TokenRevocation).where(TokenRevocation.expires_at < datetime.datetime.now()))
+    db.commit()
+
+
+token_cache = TokenCache()
+
+
+async def validate_tokens(header_params, db):
+    """refresh_tokens with a fast path: a recently verified, unexpired access token skips the database."""
+    from .auth import refresh_tokens
+
+    access_token, user_id = header_params.access_token, header_params.user_id
+    token_cache.sync(db)
+    if access_token and token_cache.is_revoked(access_token):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+
+    if access_token:
+        tokens = token_cache.get(access_token, user_id)
+        if tokens is not None:
+            return tokens
+
+    tokens = await refresh_tokens(header_params, db)
+    # When the access token was refreshed, the client sends the new one from now on
+    current_token = tokens.get("access_token") or access_token
+    if current_token:
+        token_cache.put(current_token, user_id, tokens)
+    return tokens
@@ -0,0 +1,523 @@
+"""Process-local vector search for hot accounts, in front of pgvector.
+
+An account's chunk vectors are held as one contiguous matrix, written once to VECTOR_CACHE_DIR and
+memory-mapped, so the API workers of a host share the same pages. The files' summary embeddings are
+held too, and a search runs the same two stages as the database: the SUMMARY_TOP_FILES files closest to
+any query vector by summary, then an exact top-k over their chunks. With SUMMARY_TOP_FILES=0, or an
+account with no more files than that, every chunk is searched with one matmul; with VECTOR_CACHE_HNSW=1
+and hnswlib installed, large accounts get a graph for that case instead, saved next to the vectors so one
+worker builds it per state. A graph whose recall on sampled rows falls under VECTOR_CACHE_HNSW_MIN_RECALL
+is dropped and the account stays on the matmul.
+
+The database stays the source of truth. A cached search fetches its texts together with the account's
+fingerprint (files holding chunks, their chunks, highest file id) and falls back to pgvector when the
+fingerprint no longer matches. Uploads and deletes in this process update the entry in place; changes
+made by other workers show up as a mismatch and the account is reloaded in the background.
+"""
+import asyncio
+import glob
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import func, select, true
+
+from .db import SessionLocal
+from .metrics import Counter, Gauge
+from .models import DBFile, TextEmbedding
+from .profiling import background_task
+from .search import FILE_COLUMNS, MATCHES_PER_VECTOR, MAX_DISTANCE, SUMMARY_TOP_FILES, group_by_file
+from .vector_index import HNSW_EF_CONSTRUCTION, HNSW_M
+
+try:
+    import hnswlib
+except ImportError:  # Every account is searched with a matmul
+    hnswlib = None
+
+# 0 to always search in the database
+VECTOR_CACHE = os.getenv("VECTOR_CACHE", "1") == "1"
+VECTOR_CACHE_DIR = os.getenv("VECTOR_CACHE_DIR", os.path.join(os.path.dirname(__file__), "vector_cache"))
+# Memory for all cached accounts together, least recently searched accounts are evicted first
+VECTOR_CACHE_MAX_BYTES = int(os.getenv("VECTOR_CACHE_MAX_BYTES", str(1024 ** 3)))
+# Larger accounts stay on pgvector
+VECTOR_CACHE_MAX_ROWS = int(os.getenv("VECTOR_CACHE_MAX_ROWS", "100000"))
+# "float32", or "float16" for half the memory; float16 rows are converted block by block for each search
+VECTOR_CACHE_DTYPE = os.getenv("VECTOR_CACHE_DTYPE", "float32")
+# 1 to search large accounts with an hnswlib graph (if installed) instead of an exact matmul
+VECTOR_CACHE_HNSW = os.getenv("VECTOR_CACHE_HNSW", "0") == "1"
+# Accounts with at least this many chunks get the graph
+VECTOR_CACHE_HNSW_MIN_ROWS = int(os.getenv("VECTOR_CACHE_HNSW_MIN_ROWS", "50000"))
+# Candidates kept while the graph is searched; the database's HNSW_EF_SEARCH is too low for a full account
+VECTOR_CACHE_HNSW_EF = int(os.getenv("VECTOR_CACHE_HNSW_EF", "400"))
+# Share of the exact top-k the graph must find on sampled rows, or the account is searched with a matmul
+VECTOR_CACHE_HNSW_MIN_RECALL = float(os.getenv("VECTOR_CACHE_HNSW_MIN_RECALL", "0.95"))
+# Seconds before an account found too large for the cache is counted again
+VECTOR_CACHE_RETRY_SECONDS = float(os.getenv("VECTOR_CACHE_RETRY_SECONDS", "600"))
+
+# float16 rows converted to float32 at a time
+_BLOCK_ROWS = 16384
+# Stored rows searched to measure a graph's recall, and neighbours compared for each
+_RECALL_SAMPLES = 200
+_RECALL_K = 10
+
+VECTOR_CACHE_LOOKUPS = Counter(
+    "vector_cache_lookups_total", "Vector searches by cache outcome (hit, miss, stale)", ("result",)
+)
+
+
+def _squared_norms(matrix):
+    return np.einsum("ij,ij->i", matrix, matrix, dtype=np.float32)
+
+
+def _dot(matrix, queries):
+    """matrix @ queries.T in float32, without converting a float16 matrix all at once."""
+    if matrix.dtype == np.float32:
+        return matrix @ queries.T
+    out = np.empty((len(matrix), len(queries)), dtype=np.float32)
+    for start in range(0, len(matrix), _BLOCK_ROWS):
+        out[start:start + _BLOCK_ROWS] = matrix[start:start + _BLOCK_ROWS].astype(np.float32) @ queries.T
+    return out
+
+
+def _unit(vectors):
+    """Rows scaled to length 1; zero rows become NaN and never rank."""
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def top_files(summary_ids, summaries, queries, top):
+    """Ids of the files whose summary is closest by cosine distance to any query, like search.top_files.
+
+    None when every file is kept. Files without a summary come last, as in the database.
+    """
+    if not top or len(summary_ids) <= top:
+        return None
+    distances = 1 - summaries @ _unit(queries).T
+    distances[np.isnan(distances)] = np.inf
+    closest = np.argpartition(distances, top - 1, axis=0)[:top]
+    return np.unique(summary_ids[closest])
+
+
+class AccountVectors:
+    """One account's chunk vectors: the memory-mapped rows it was loaded with plus rows appended since.
+
+    Arrays are replaced, never modified in place, so a search works on a consistent snapshot while
+    the ingest worker appends; mutations hold the cache lock.
+    """
+
+    def __init__(self, ids, file_ids, matrix, hnsw=None, summary_ids=None, summaries=None):
+        self.ids = ids
+        self.file_ids = file_ids
+        self.matrix = matrix
+        self.norms = _squared_norms(matrix)
+        self.alive = np.ones(len(ids), dtype=bool)
+        # Appended rows, kept apart so the mapped matrix is never copied
+        self.tail_ids = np.empty(0, dtype=np.int64)
+        self.tail_file_ids = np.empty(0, dtype=np.int64)
+        self.tail = np.empty((0, matrix.shape[1]), dtype=matrix.dtype)
+        self.tail_norms = np.empty(0, dtype=np.float32)
+        self.tail_alive = np.empty(0, dtype=bool)
+        self.hnsw = hnsw
+        # hnswlib may not be resized while it is searched
+        self._hnsw_lock = threading.Lock()
+        file_ids_present, rows = np.unique(file_ids, return_counts=True)
+        self.rows_per_file = dict(zip(file_ids_present.tolist(), rows.tolist()))
+        self._all_ids = ids
+        self._all_file_ids = file_ids
+        # Unit summary embedding of every file of the account, NaN rows for files without one
+        self.summary_ids = np.empty(0, dtype=np.int64) if summary_ids is None else summary_ids
+        self.summaries = np.empty((0, matrix.shape[1]), dtype=np.float32) if summaries is None else _unit(summaries)
+
+    def fingerprint(self):
+        """(files holding chunks, chunks, highest file id), as counted by the database."""
+        files = [file_id for file_id, rows in self.rows_per_file.items() if rows]
+        return len(files), sum(self.rows_per_file.values()), max(files, default=0)
+
+    @property
+    def nbytes(self):
+        size = self.matrix.nbytes + self.tail.nbytes + self.ids.nbytes * 2 + self.norms.nbytes + self.summaries.nbytes
+        if self.hnsw is not None:
+            size += self.hnsw.get_current_count() * (self.matrix.shape[1] * 4 + HNSW_M * 8)
+        return size
+
+    def set_summary(self, file_id, summary):
+        summary = _unit([summary])
+        rows = np.flatnonzero(self.summary_ids == file_id)
+        if len(rows):
+            summaries = self.summaries.copy()
+            summaries[rows[0]] = summary[0]
+            self.summaries = summaries
+        else:
+            self.summary_ids = np.append(self.summary_ids, np.int64(file_id))
+            self.summaries = np.concatenate([self.summaries, summary])
+
+    def append(self, file_id, ids, vectors, summary=None):
+        if summary is not None:
+            self.set_summary(file_id, summary)
+        vectors = np.asarray(vectors, dtype=self.matrix.dtype)
+        start = len(self.ids) + len(self.tail_ids)
+        self.tail_ids = np.concatenate([self.tail_ids, np.asarray(ids, dtype=np.int64)])
+        self.tail_file_ids = np.concatenate([self.tail_file_ids, np.full(len(ids), file_id, dtype=np.int64)])
+        self.tail = np.concatenate([self.tail, vectors])
+        self.tail_norms = np.concatenate([self.tail_norms, _squared_norms(vectors)])
+        self.tail_alive = np.concatenate([self.tail_alive, np.ones(len(ids), dtype=bool)])
+        self.rows_per_file[file_id] = self.rows_per_file.get(file_id, 0) + len(ids)
+        self._all_ids = None
+        self._all_file_ids = None
+        if self.hnsw is not None:
+            with self._hnsw_lock:
+                if self.hnsw.get_current_count() + len(ids) > self.hnsw.get_max_elements():
+                    self.hnsw.resize_index(2 * (self.hnsw.get_current_count() + len(ids)))
+                self.hnsw.add_items(vectors.astype(np.float32), np.arange(start, start + len(ids)))
+
+    def drop_files(self, file_ids):
+        file_ids = np.asarray(list(file_ids), dtype=np.int64)
+        dropped = np.isin(self.file_ids, file_ids) & self.alive
+        tail_dropped = np.isin(self.tail_file_ids, file_ids) & self.tail_alive
+        self.alive = self.alive & ~dropped
+        self.tail_alive = self.tail_alive & ~tail_dropped
+        for file_id in file_ids.tolist():
+            self.rows_per_file.pop(file_id, None)
+        kept = ~np.isin(self.summary_ids, file_ids)
+        self.summary_ids = self.summary_ids[kept]
+        self.summaries = self.summaries[kept]
+        if self.hnsw is not None:
+            with self._hnsw_lock:
+                for label in np.concatenate([np.flatnonzero(dropped), len(self.ids) + np.flatnonzero(tail_dropped)]):
+                    self.hnsw.mark_deleted(int(label))
+
+    def snapshot(self):
+        if self._all_ids is None:
+            self._all_ids = np.concatenate([self.ids, self.tail_ids])
+        if self._all_file_ids is None:
+            self._all_file_ids = np.concatenate([self.file_ids, self.tail_file_ids])
+        return (
+            self._all_ids,
+            (self.matrix, self.norms, self.alive, self.tail, self.tail_norms, self.tail_alive),
+            self.fingerprint(),
+            self._all_file_ids,
+            (self.summary_ids, self.summaries),
+        )
+
+    def search(self, rows, queries, limit, max_distance, top=SUMMARY_TOP_FILES):
+        """Chunk ids of the closest rows for each query, ordered by query then distance.
+
+        With `top`, only the chunks of the top files by summary are searched, as similar_chunks_query does.
+        """
+        ids, (matrix, norms, alive, tail, tail_norms, tail_alive), _, file_ids, (summary_ids, summaries) = rows
+        files = top_files(summary_ids, summaries, queries, top)
+        if files is not None:
+            labels, distances = _search_rows(
+                np.flatnonzero(np.isin(file_ids, files) & np.concatenate([alive, tail_alive])),
+                matrix, norms, tail, tail_norms, queries, limit,
+            )
+            return _hits(ids, labels, distances, max_distance)
+
+        live = int(alive.sum() + tail_alive.sum())
+        k = min(limit, live)
+        if k == 0:
+            return []
+
+        if self.hnsw is not None:
+            with self._hnsw_lock:
+                self.hnsw.set_ef(max(VECTOR_CACHE_HNSW_EF, k))
+                labels, distances = self.hnsw.knn_query(queries, k=k)
+            distances = np.sqrt(np.maximum(distances, 0))
+        else:
+            distances = np.concatenate([
+                norms[:, None] - 2 * _dot(matrix, queries),
+                tail_norms[:, None] - 2 * _dot(tail, queries),
+            ])
+            distances += _squared_norms(queries)[None, :]
+            distances[~np.concatenate([alive, tail_alive])] = np.inf
+            labels = np.argpartition(distances, k - 1, axis=0)[:k].T
+            distances = np.sqrt(np.maximum(np.take_along_axis(distances.T, labels, axis=1), 0))
+        return _hits(ids, labels, distances, max_distance)
+
+
+def _search_rows(rows, matrix, norms, tail, tail_norms, queries, limit):
+    """Exact top-k among the given row numbers (mapped rows first, then appended ones): (labels, distances)."""
+    k = min(limit, len(rows))
+    if k == 0:
+        return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+    head, rest = rows[rows < len(matrix)], rows[rows >= len(matrix)] - len(matrix)
+    distances = np.concatenate([
+        norms[head, None] - 2 * _dot(matrix[head], queries),
+        tail_norms[rest, None] - 2 * _dot(tail[rest], queries),
+    ])
+    distances += _squared_norms(queries)[None, :]
+    closest = np.argpartition(distances, k - 1, axis=0)[:k].T
+    distances = np.sqrt(np.maximum(np.take_along_axis(distances.T, closest, axis=1), 0))
+    return rows[closest], distances
+
+
+def _hits(ids, labels, distances, max_distance):
+    hits = []
+    for query_labels, query_distances in zip(labels, distances):
+        order = np.argsort(query_distances)
+        hits.extend(
+            int(ids[label]) for label, distance in zip(query_labels[order], query_distances[order])
+            # Rows the graph received after the snapshot are left out, the fingerprint is from before them
+            if label < len(ids) and (max_distance is None or distance <= max_distance)
+        )
+    return hits
+
+
+def _fingerprint_query(email_account_id):
+    return (
+        select(
+            func.count(DBFile.id).label("files"),
+            func.coalesce(func.sum(DBFile.chunks_done), 0).label("chunks"),
+            func.coalesce(func.max(DBFile.id), 0).label("max_file_id"),
+        )
+        .where(DBFile.email_account_id == email_account_id, DBFile.chunks_done > 0, DBFile.deleting.isnot(True))
+    )
+
+
+def _rows_query(email_account_id, chunk_ids):
+    """The chunks' texts and files, with the account's fingerprint; one row even when no chunk matched."""
+    fingerprint = _fingerprint_query(email_account_id).subquery("fingerprint")
+    hits = (
+        select(TextEmbedding.id.label("chunk_id"), TextEmbedding.text, *FILE_COLUMNS)
+        .join(DBFile, DBFile.id == TextEmbedding.file_id)
+        .where(TextEmbedding.id.in_(chunk_ids))
+        .subquery("hits")
+    )
+    return select(fingerprint, hits).select_from(fingerprint).outerjoin(hits, true())
+
+
+def _account_files(email_account_id, stem=None):
+    pattern = os.path.join(VECTOR_CACHE_DIR, f"account_{email_account_id}_{stem or '*'}")
+    return glob.glob(pattern + ".*.npy") + glob.glob(pattern + ".hnsw")
+
+
+def _write_npy(path, array):
+    # Written under a temporary name and renamed, so another worker never maps a partial file
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as out:
+        np.save(out, array)
+    os.replace(tmp, path)
+
+
+def build_graph(matrix, max_elements=None):
+    """An hnswlib graph over the rows of `matrix`, labelled by row number."""
+    hnsw = hnswlib.Index(space="l2", dim=matrix.shape[1])
+    hnsw.init_index(max_elements=max_elements or len(matrix), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+    for start in range(0, len(matrix), _BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + _BLOCK_ROWS], dtype=np.float32)
+        hnsw.add_items(block, np.arange(start, start + len(block)))
+    hnsw.set_ef(VECTOR_CACHE_HNSW_EF)
+    return hnsw
+
+
+def graph_recall(hnsw, matrix, samples=_RECALL_SAMPLES, k=_RECALL_K):
+    """Share of the exact top-k the graph returns, for stored rows used as queries."""
+    k = min(k, len(matrix))
+    rng = np.random.default_rng(0)
+    queries = np.asarray(matrix[np.sort(rng.choice(len(matrix), min(samples, len(matrix)), replace=False))], dtype=np.float32)
+    labels, _ = hnsw.knn_query(queries, k=k)
+    distances = _squared_norms(matrix)[:, None] - 2 * _dot(matrix, queries)
+    exact = np.argpartition(distances, k - 1, axis=0)[:k].T
+    return float(np.mean([len(set(found.tolist()) & set(rows.tolist())) / k for found, rows in zip(labels, exact)]))
+
+
+def load_account(email_account_id, dtype=VECTOR_CACHE_DTYPE):
+    """Read an account's vectors, or map them if another worker already wrote the same state.
+
+    Returns None when the account has no chunks or more than VECTOR_CACHE_MAX_ROWS.
+    """
+    db = SessionLocal()
+    try:
+        files, chunks, max_file_id = db.execute(_fingerprint_query(email_account_id)).one()
+        if not chunks or chunks > VECTOR_CACHE_MAX_ROWS:
+            return None
+        # Every file of the account is ranked by the first stage, as in search.top_files; few next to the chunks
+        summary_rows = db.execute(
+            select(DBFile.id, DBFile.summary_embedding)
+            .where(DBFile.email_account_id == email_account_id, DBFile.deleting.isnot(True))
+        ).all()
+        stem = f"{files}_{chunks}_{max_file_id}_{dtype}"
+        base = os.path.join(VECTOR_CACHE_DIR, f"account_{email_account_id}_{stem}")
+        if not os.path.exists(base + ".vectors.npy"):
+            rows = db.execute(
+                select(TextEmbedding.id, TextEmbedding.file_id, TextEmbedding.embedding)
+                .join(DBFile, DBFile.id == TextEmbedding.file_id)
+                .where(TextEmbedding.email_account_id == email_account_id, DBFile.deleting.isnot(True))
+                .order_by(TextEmbedding.id)
+            ).all()
+            os.makedirs(VECTOR_CACHE_DIR, exist_ok=True)
+            _write_npy(base + ".ids.npy", np.array([(row.id, row.file_id) for row in rows], dtype=np.int64).reshape(-1, 2))
+            _write_npy(base + ".vectors.npy", np.stack([
+                row.embedding.to_numpy() if hasattr(row.embedding, "to_numpy") else row.embedding for row in rows
+            ]).astype(dtype))
+            for path in _account_files(email_account_id):
+                if not path.startswith(base + "."):
+                    try:
+                        os.remove(path)  # An older state; workers still mapping it keep their pages
+                    except OSError:
+                        pass
+    finally:
+        db.close()
+
+    ids = np.load(base + ".ids.npy")
+    matrix = np.load(base + ".vectors.npy", mmap_mode="r")
+    hnsw = None
+    if VECTOR_CACHE_HNSW and hnswlib is not None and len(ids) >= VECTOR_CACHE_HNSW_MIN_ROWS:
+        hnsw = _load_graph(base + ".hnsw", matrix)
+    summaries = np.full((len(summary_rows), matrix.shape[1]), np.nan, dtype=np.float32)
+    for row, (_, summary) in enumerate(summary_rows):
+        if summary is not None:
+            summaries[row] = summary.to_numpy() if hasattr(summary, "to_numpy") else summary
+    summary_ids = np.array([file_id for file_id, _ in summary_rows], dtype=np.int64)
+    return AccountVectors(ids[:, 0].copy(), ids[:, 1].copy(), matrix, hnsw, summary_ids, summaries)
+
+
+def _load_graph(path, matrix):
+    """The graph saved for this state, built and saved first if no worker did; None when its recall is too low."""
+    if os.path.exists(path):
+        hnsw = hnswlib.Index(space="l2", dim=matrix.shape[1])
+        hnsw.load_index(path, max_elements=2 * len(matrix))
+        hnsw.set_ef(VECTOR_CACHE_HNSW_EF)
+    else:
+        hnsw = build_graph(matrix, max_elements=2 * len(matrix))
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        hnsw.save_index(tmp)
+        os.replace(tmp, path)
+    # Measured on every load, the threshold may have changed since the graph was saved
+    recall = graph_recall(hnsw, matrix)
+    if recall < VECTOR_CACHE_HNSW_MIN_RECALL:
+        print(f"Vector cache graph recall {recall:.3f} is under {VECTOR_CACHE_HNSW_MIN_RECALL}, searching with a matmul")
+        return None
+    return hnsw
+
+
+class VectorCache:
+    """LRU of AccountVectors bounded by VECTOR_CACHE_MAX_BYTES; accounts are loaded in the background on a miss."""
+
+    def __init__(self, max_bytes=VECTOR_CACHE_MAX_BYTES, enabled=VECTOR_CACHE):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._entries = OrderedDict()  # email_account_id -> AccountVectors, least recently used first
+        self._lock = threading.Lock()
+        self._loading = set()
+        self._skipped = {}  # email_account_id -> time it was found too large
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _lookup(self, email_account_id):
+        with self._lock:
+            entry = self._entries.get(email_account_id)
+            if entry is not None:
+                self._entries.move_to_end(email_account_id)
+                return entry, entry.snapshot()
+        return None, None
+
+    def _start_load(self, email_account_id):
+        if email_account_id in self._loading:
+            return
+        if time.monotonic() - self._skipped.get(email_account_id, -VECTOR_CACHE_RETRY_SECONDS) < VECTOR_CACHE_RETRY_SECONDS:
+            return
+        self._loading.add(email_account_id)
+        # Started from a search request, its statements are not that request's
+        task = background_task(self._load(email_account_id))
+        task.add_done_callback(_report_failure)
+
+    async def _load(self, email_account_id):
+        try:
+            entry = await asyncio.to_thread(load_account, email_account_id)
+        finally:
+            self._loading.discard(email_account_id)
+        if entry is None:
+            self._skipped[email_account_id] = time.monotonic()
+            return
+        with self._lock:
+            self._entries[email_account_id] = entry
+            self._evict()
+
+    def _evict(self):
+        total = sum(entry.nbytes for entry in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.nbytes
+
+    async def search(self, db, email_account_id, vectors, limit=MATCHES_PER_VECTOR, max_distance=MAX_DISTANCE, top=SUMMARY_TOP_FILES):
+        """(files, files_to_texts) like most_similar_files_async, or None when the database has to answer."""
+        if not self.enabled:
+            return None
+        entry, rows = self._lookup(email_account_id)
+        if entry is None:
+            self.misses += 1
+            VECTOR_CACHE_LOOKUPS.inc(result="miss")
+            self._start_load(email_account_id)
+            return None
+
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        chunk_ids = await asyncio.to_thread(entry.search, rows, queries, limit, max_distance, top)
+        result = (await db.execute(_rows_query(email_account_id, chunk_ids))).all()
+        if (result[0].files, result[0].chunks, result[0].max_file_id) != rows[2]:
+            # Another worker uploaded or deleted files since this entry was loaded
+            self.stale += 1
+            VECTOR_CACHE_LOOKUPS.inc(result="stale")
+            self.invalidate(email_account_id)
+            self._start_load(email_account_id)
+            return None
+
+        self.hits += 1
+        VECTOR_CACHE_LOOKUPS.inc(result="hit")
+        by_id = {row.chunk_id: row for row in result if row.chunk_id is not None}
+        return group_by_file(by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in by_id)
+
+    def add_chunks(self, email_account_id, file_id, ids, vectors, summary=None):
+        """Chunks just committed by the ingest worker, with the file's updated summary embedding."""
+        with self._lock:
+            entry = self._entries.get(email_account_id)
+            if entry is not None:
+                entry.append(file_id, ids, vectors, summary)
+                self._evict()
+
+    def drop_files(self, email_account_id, file_ids):
+        with self._lock:
+            entry = self._entries.get(email_account_id)
+            if entry is not None:
+                entry.drop_files(file_ids)
+
+    def invalidate(self, email_account_id, remove_files=False):
+        """Drop the account's entry; with remove_files, also its files in VECTOR_CACHE_DIR, once it has no chunks left."""
+        with self._lock:
+            self._entries.pop(email_account_id, None)
+        self._skipped.pop(email_account_id, None)
+        if remove_files:
+            for path in _account_files(email_account_id):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        total = self.hits + self.misses + self.stale
+        with self._lock:
+            size = sum(entry.nbytes for entry in self._entries.values())
+            entries = len(self._entries)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+def _report_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Vector cache load failed: {task.exception()}")
+
+
+vector_cache = VectorCache()
+
+Gauge("vector_cache_bytes", "Memory held by the vector cache, mapped pages included", callback=lambda: vector_cache.stats()["bytes"])
@@ -0,0 +1,212 @@
+import os
+
+from pgvector.sqlalchemy import BIT
+from sqlalchemy import cast, event, func, text
+
+from .db import engine, async_engine
+from .models import EMBEDDING_FORMAT, N_DIM
+
+# Operator class per distance metric, it must match the operator used by the queries
+# (most_relevant_files orders by l2_distance, i.e. <->)
+OPCLASSES = {
+    "l2": "vector_l2_ops",
+    "cosine": "vector_cosine_ops",
+    "ip": "vector_ip_ops",
+}
+INDEX_METRIC = os.getenv("INDEX_METRIC", "l2")
+
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+# Candidate list size while searching, higher gives better recall and slower queries
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+# pgvector >= 0.8 keeps scanning the graph until enough rows pass the email_account_id filter.
+# "strict_order" or "relaxed_order", empty for older pgvector versions
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "strict_order")
+# Minimum pg_trgm word similarity for a chunk to match a lexical search (pg_trgm's own default is 0.6)
+TRGM_WORD_SIMILARITY_THRESHOLD = os.getenv("TRGM_WORD_SIMILARITY_THRESHOLD", "0.6")
+# Accounts with more chunks than this get their own partial index
+ACCOUNT_INDEX_MIN_ROWS = int(os.getenv("ACCOUNT_INDEX_MIN_ROWS", "50000"))
+
+
+def index_name(metric=INDEX_METRIC, email_account_id=None, fmt=EMBEDDING_FORMAT):
+    label = {"vector": metric, "halfvec": f"halfvec_{metric}", "binary": "bit_hamming"}[fmt]
+    if email_account_id is None:
+        return f"text_embeddings_embedding_{label}_hnsw"
+    return f"text_embeddings_embedding_{label}_hnsw_account_{int(email_account_id)}"
+
+
+def index_target(metric=INDEX_METRIC, fmt=EMBEDDING_FORMAT):
+    """Indexed expression and operator class of the HNSW index for a storage format."""
+    if fmt == "binary":
+        # Hamming distance over the sign bits, search.py re-ranks the candidates at full precision
+        return f"(binary_quantize(embedding)::bit({N_DIM})) bit_hamming_ops"
+    if fmt == "halfvec":
+        return f"embedding {OPCLASSES[metric].replace('vector_', 'halfvec_', 1)}"
+    return f"embedding {OPCLASSES[metric]}"
+
+
+def binary_quantized(vector):
+    # Same expression as the binary index, so the planner can use it
+    return cast(func.binary_quantize(vector), BIT(N_DIM))
+
+
+def _execute_autocommit(sql):
+    # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(sql))
+
+
+def create_embedding_index(metric=INDEX_METRIC, email_account_id=None, concurrently=True,
+                           m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, fmt=EMBEDDING_FORMAT):
+    """Build an HNSW index over text_embeddings.embedding, optionally partial on one account.
+
+    A partial index holds only that account's rows, so a filtered search walks a graph in which
+    every candidate passes the filter.
+    """
+    if metric not in OPCLASSES:
+        raise ValueError(f"Unknown distance metric: {metric}")
+    sql = (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index_name(metric, email_account_id, fmt)} "
+        f"ON text_embeddings USING hnsw ({index_target(metric, fmt)}) "
+        f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+    )
+    if email_account_id is not None:
+        sql += f" WHERE email_account_id = {int(email_account_id)}"
+    _execute_autocommit(sql)
+
+
+def drop_embedding_index(metric=INDEX_METRIC, email_account_id=None, concurrently=True, fmt=EMBEDDING_FORMAT):
+    _execute_autocommit(
+        f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {index_name(metric, email_account_id, fmt)}"
+    )
+
+
+def index_exists(name):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+
+def ensure_indexes(concurrently=True):
+    """Create the shared HNSW index, the btree indexes used to filter chunks by account and file, and the listing indexes."""
+    _execute_autocommit(
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS text_embeddings_email_account_id "
+        "ON text_embeddings (email_account_id)"
+    )
+    _execute_autocommit(
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS text_embeddings_file_id "
+        "ON text_embeddings (file_id, id)"
+    )
+    # Trigram index of the lexical search
+    _execute_autocommit(
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS text_embeddings_text_trgm "
+        "ON text_embeddings USING gin (text gin_trgm_ops)"
+    )
+    # Listing indexes declared on the models, create_all does not add them to existing tables
+    _execute_autocommit(
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS ix_files_account_uploaded_at "
+        "ON files (email_account_id, uploaded_at, id)"
+    )
+    _execute_autocommit(
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS ix_email_accounts_user_date_added "
+        "ON email_accounts (user_id, date_added, id)"
+    )
+    create_embedding_index(concurrently=concurrently)
+
+
+def ensure_file_summaries(fmt=EMBEDDING_FORMAT):
+    """Add files.summary_embedding to an existing database and fill it in for files ingested before it existed."""
+    column_type = f"halfvec({N_DIM})" if fmt == "halfvec" else f"vector({N_DIM})"
+    _execute_autocommit(f"ALTER TABLE files ADD COLUMN IF NOT EXISTS summary_embedding {column_type}")
+    _execute_autocommit(
+        "UPDATE files SET summary_embedding = centroids.embedding "
+        "FROM (SELECT file_id, avg(embedding) AS embedding FROM text_embeddings "
+        "WHERE file_id IN (SELECT id FROM files WHERE summary_embedding IS NULL) GROUP BY file_id) centroids "
+        "WHERE files.id = centroids.file_id"
+    )
+
+
+def convert_embedding_storage(fmt=EMBEDDING_FORMAT):
+    """Rewrite text_embeddings.embedding and files.summary_embedding in the column type of `fmt` and rebuild the shared HNSW index.
+
+    The ALTER rewrites the whole table under an exclusive lock, run it in a maintenance window.
+    Per-account indexes are dropped and come back through ensure_account_index.
+    """
+    column_type = f"halfvec({N_DIM})" if fmt == "halfvec" else f"vector({N_DIM})"
+    with engine.connect() as conn:
+        names = conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'text_embeddings' AND indexdef LIKE '%USING hnsw%'"
+        )).scalars().all()
+    # An operator class of the old type would make the ALTER fail
+    for name in names:
+        _execute_autocommit(f'DROP INDEX IF EXISTS "{name}"')
+    _execute_autocommit(
+        f"ALTER TABLE text_embeddings ALTER COLUMN embedding TYPE {column_type} USING embedding::{column_type}"
+    )
+    _execute_autocommit(
+        f"ALTER TABLE files ALTER COLUMN summary_embedding TYPE {column_type} USING summary_embedding::{column_type}"
+    )
+    create_embedding_index(concurrently=False, fmt=fmt)
+
+
+def ensure_account_index(db, email_account_id):
+    """Give a large account its own partial HNSW index once it holds ACCOUNT_INDEX_MIN_ROWS chunks."""
+    if index_exists(index_name(INDEX_METRIC, email_account_id)):
+        return False
+    rows = db.execute(
+        text("SELECT count(*) FROM text_embeddings WHERE email_account_id = :id"), {"id": email_account_id}
+    ).scalar()
+    if rows < ACCOUNT_INDEX_MIN_ROWS:
+        return False
+    create_embedding_index(email_account_id=email_account_id)
+    return True
+
+
+def search_param_statements(ef_search=None, iterative_scan=None):
+    statements = []
+    if ef_search is not None:
+        statements.append((text("SELECT set_config('hnsw.ef_search', :value, true)"), {"value": str(int(ef_search))}))
+    if iterative_scan is not None:
+        statements.append((text("SELECT set_config('hnsw.iterative_scan', :value, true)"), {"value": iterative_scan}))
+    return statements
+
+
+def set_search_params(db, ef_search=None, iterative_scan=None):
+    """Override the HNSW search settings for the current transaction only."""
+    for statement, params in search_param_statements(ef_search, iterative_scan):
+        db.execute(statement, params)
+
+
+async def set_search_params_async(db, ef_search=None, iterative_scan=None):
+    for statement, params in search_param_statements(ef_search, iterative_scan):
+        await db.execute(statement, params)
+
+
+# Session defaults, applied once per pooled connection so searches need no extra round trip
+def apply_search_defaults(dbapi_connection, connection_record):
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute("SELECT set_config('hnsw.ef_search', %s, false)", (str(HNSW_EF_SEARCH),))
+        if HNSW_ITERATIVE_SCAN:
+            cursor.execute("SELECT set_config('hnsw.iterative_scan', %s, false)", (HNSW_ITERATIVE_SCAN,))
+        cursor.execute(
+            "SELECT set_config('pg_trgm.word_similarity_threshold', %s, false)", (TRGM_WORD_SIMILARITY_THRESHOLD,)
+        )
+    dbapi_connection.commit()
+
+
+event.listen(engine, "connect", apply_search_defaults)
+
+
+async def _apply_asyncpg_search_defaults(connection):
+    await connection.execute("SELECT set_config('hnsw.ef_search', $1, false)", str(HNSW_EF_SEARCH))
+    if HNSW_ITERATIVE_SCAN:
+        await connection.execute("SELECT set_config('hnsw.iterative_scan', $1, false)", HNSW_ITERATIVE_SCAN)
+    await connection.execute(
+        "SELECT set_config('pg_trgm.word_similarity_threshold', $1, false)", TRGM_WORD_SIMILARITY_THRESHOLD
+    )
+
+
+def apply_async_search_defaults(dbapi_connection, connection_record):
+    dbapi_connection.run_async(_apply_asyncpg_search_defaults)
+
+
+event.listen(async_engine.sync_engine, "connect", apply_async_search_defaults)
@@ -0,0 +1,118 @@
+"""Deleting every file of an account: the old per-file ORM loop vs. one cascading DELETE vs. deferred cleanup.
+
+Needs the Postgres database from app/db.py. Each scenario seeds its own throwaway user and account,
+500 files x 400 chunks (200k chunks) by default, and deletes them again.
+Run from the repo root: python -m benchmarks.bulk_delete [--files 500] [--chunks-per-file 400] [--skip-legacy]
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import numpy as np
+from sqlalchemy import delete, select
+
+from app.bulk_insert import bulk_insert_embeddings
+import app.cleanup as cleanup
+from app.cleanup import delete_account_files, run_cleanup
+from app.db import SessionLocal
+from app.models import User, EmailAccount, DBFile, TextEmbedding, N_DIM
+
+TEXT = "Our spring price sheet covers every product line we ship. " * 16
+
+
+def seed(files, chunks_per_file):
+    db = SessionLocal()
+    try:
+        tag = uuid.uuid4().hex[:8]
+        user = User(email=f"bench-{tag}@example.com", password="x", first_name="Bench", last_name="Mark")
+        db.add(user)
+        db.flush()
+        account = EmailAccount(user_id=user.id, email_address=f"bench-biz-{tag}@example.com")
+        db.add(account)
+        db.flush()
+        rng = np.random.default_rng(0)
+        for i in range(files):
+            file = DBFile(email_account_id=account.id, file_name=f"bench-{i}.pdf", file_size=100000,
+                          content_type="PDF", chunks_done=chunks_per_file)
+            db.add(file)
+            db.flush()
+            vectors = rng.standard_normal((chunks_per_file, N_DIM), dtype=np.float32)
+            bulk_insert_embeddings(db, [
+                {"filename": file.file_name, "text": TEXT, "embedding": vector,
+                 "email_account_id": account.id, "file_id": file.id}
+                for vector in vectors
+            ])
+        user.storage_used = files * 100000
+        db.commit()
+        return user.id, account.id
+    finally:
+        db.close()
+
+
+def drop_user(user_id):
+    db = SessionLocal()
+    try:
+        db.execute(delete(User).where(User.id == user_id))
+        db.commit()
+    finally:
+        db.close()
+
+
+def legacy_delete(account_id):
+    # What delete_all_files did before: one ORM delete and commit per file, chunks loaded and deleted one by one
+    db = SessionLocal()
+    try:
+        for file in db.scalars(select(DBFile).where(DBFile.email_account_id == account_id)).all():
+            for chunk in db.scalars(select(TextEmbedding).where(TextEmbedding.file_id == file.id)).all():
+                db.delete(chunk)
+            db.delete(file)
+            db.commit()
+    finally:
+        db.close()
+
+
+def set_based_delete(account_id, inline):
+    db = SessionLocal()
+    try:
+        cleanup.CLEANUP_INLINE_MAX_CHUNKS = float("inf") if inline else 0
+        account = db.get(EmailAccount, account_id)
+        return delete_account_files(db, account)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--chunks-per-file", type=int, default=400)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+    chunks = args.files * args.chunks_per_file
+    print(f"{args.files} files, {chunks} chunks")
+
+    if not args.skip_legacy:
+        user_id, account_id = seed(args.files, args.chunks_per_file)
+        start = time.perf_counter()
+        legacy_delete(account_id)
+        print(f"per-file ORM loop:      {time.perf_counter() - start:8.2f}s in the request")
+        drop_user(user_id)
+
+    user_id, account_id = seed(args.files, args.chunks_per_file)
+    start = time.perf_counter()
+    set_based_delete(account_id, inline=True)
+    print(f"one cascading DELETE:   {time.perf_counter() - start:8.2f}s in the request")
+    drop_user(user_id)
+
+    user_id, account_id = seed(args.files, args.chunks_per_file)
+    start = time.perf_counter()
+    set_based_delete(account_id, inline=False)
+    request = time.perf_counter() - start
+    start = time.perf_counter()
+    asyncio.run(run_cleanup())
+    print(f"deferred cleanup:       {request:8.2f}s in the request, {time.perf_counter() - start:.2f}s in the background")
+    drop_user(user_id)
+
+
+if __name__ == "__main__":
+    main()
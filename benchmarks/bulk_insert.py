@@ -0,0 +1,64 @@
+"""ORM add/flush vs bulk_insert_embeddings for 1k, 10k and 100k chunks.
+
+Needs the Postgres database from app/db.py. Everything runs in one transaction that is rolled back.
+Run from the repo root: python -m benchmarks.bulk_insert
+"""
+import time
+
+import numpy as np
+
+from app.bulk_insert import bulk_insert_embeddings
+from app.db import SessionLocal
+from app.models import User, EmailAccount, DBFile, TextEmbedding, N_DIM
+
+SIZES = (1000, 10000, 100000)
+TEXT = "Our spring price sheet covers every product line we ship. " * 16
+
+
+def make_rows(n, account_id, file_id):
+    vectors = np.random.default_rng(0).standard_normal((n, N_DIM), dtype=np.float32)
+    return [
+        {"filename": "bench.pdf", "text": TEXT, "embedding": vector, "email_account_id": account_id, "file_id": file_id}
+        for vector in vectors
+    ]
+
+
+def orm_insert(db, rows):
+    db.add_all([TextEmbedding(**row) for row in rows])
+    db.flush()
+
+
+def timed(db, fn, rows):
+    savepoint = db.begin_nested()
+    start = time.perf_counter()
+    fn(db, rows)
+    elapsed = time.perf_counter() - start
+    savepoint.rollback()
+    return elapsed
+
+
+def main():
+    db = SessionLocal()
+    try:
+        user = User(email="bench@example.com", password="x", first_name="Bench", last_name="Mark")
+        db.add(user)
+        db.flush()
+        account = EmailAccount(user_id=user.id, email_address="bench-biz@example.com")
+        db.add(account)
+        db.flush()
+        file = DBFile(email_account_id=account.id, file_name="bench.pdf", file_size=0, content_type="PDF")
+        db.add(file)
+        db.flush()
+
+        for n in SIZES:
+            rows = make_rows(n, account.id, file.id)
+            orm = timed(db, orm_insert, rows)
+            bulk = timed(db, bulk_insert_embeddings, rows)
+            print(f"{n:>7} chunks  orm {orm:7.2f}s ({n / orm:8.0f} rows/s)  bulk {bulk:7.2f}s ({n / bulk:8.0f} rows/s)  x{orm / bulk:.1f}")
+    finally:
+        db.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Throughput of the campaign dispatcher against a local aiosmtpd sink, no database needed.
+
+Run from the repo root: python -m benchmarks.campaign_send [recipients] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+from aiosmtpd.controller import Controller
+from fastapi_mail import ConnectionConfig
+
+import app.campaigns as campaigns
+from app.mail_templates import TEMPLATE_FOLDER, prepare_template
+
+HOST, PORT = "127.0.0.1", 8026
+TEMPLATE = {
+    "sub_title": "Our spring catalogue is out",
+    "message": "Hi {name}, take a look at what is new this season.",
+    "button_text": "See the catalogue",
+    "link": "https://example.com/catalogue",
+}
+
+
+class Sink:
+    received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        Sink.received += 1
+        return "250 OK"
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else campaigns.CAMPAIGN_SENDER_CONCURRENCY
+    # Lift the provider rate limit, this measures the dispatcher itself
+    campaigns.CAMPAIGN_RATE_PER_SECOND = campaigns.CAMPAIGN_RATE_BURST = 10 ** 6
+
+    conf = ConnectionConfig(
+        MAIL_USERNAME="bench", MAIL_PASSWORD="bench", MAIL_FROM="bench@example.com",
+        MAIL_PORT=PORT, MAIL_SERVER=HOST, MAIL_STARTTLS=False, MAIL_SSL_TLS=False,
+        MAIL_FROM_NAME="Bench", USE_CREDENTIALS=False, VALIDATE_CERTS=False, TEMPLATE_FOLDER=TEMPLATE_FOLDER,
+    )
+    template = prepare_template("email.html", {**TEMPLATE, "title": "Spring catalogue"}, ["message"])
+    recipients = [
+        (i, f"user{i}@example.com", "Spring catalogue", template.render({"message": TEMPLATE["message"].format(name=f"user{i}")}))
+        for i in range(count)
+    ]
+    failures = []
+
+    controller = Controller(Sink(), hostname=HOST, port=PORT)
+    controller.start()
+    try:
+        start = time.perf_counter()
+        await campaigns.dispatch(conf, recipients, lambda i, attempts, error: error and failures.append(error), concurrency)
+        elapsed = time.perf_counter() - start
+    finally:
+        controller.stop()
+
+    print(f"{count} recipients, concurrency={concurrency}: {elapsed:.2f}s  {count / elapsed:.1f} msg/s  "
+          f"failed={len(failures)}  sink received {Sink.received}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+"""Chunks/sec of the embedding service per batch size, plus event loop lag while it runs.
+
+Run from the repo root: python -m benchmarks.embed_batching
+"""
+import asyncio
+import time
+
+from app.embed_service import EmbeddingService
+
+CHUNKS = ["Our spring price sheet covers every product line we ship. " * 16] * 256
+
+
+async def loop_lag(stop, samples):
+    # Measures how late a 10ms sleep wakes up, i.e. how long the loop was blocked
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        samples.append(time.perf_counter() - start - 0.01)
+
+
+async def run(batch_size):
+    service = EmbeddingService(batch_size=batch_size)
+    await service.embed(CHUNKS[:batch_size])  # warm up
+
+    stop, samples = asyncio.Event(), []
+    lag_task = asyncio.create_task(loop_lag(stop, samples))
+    start = time.perf_counter()
+    await service.embed(CHUNKS)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await lag_task
+    service.shutdown()
+
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99)] if samples else 0.0
+    print(f"batch={batch_size:>3}  {len(CHUNKS) / elapsed:8.1f} chunks/s  loop lag p99={p99 * 1000:6.1f} ms")
+
+
+async def main():
+    for batch_size in (1, 8, 32, 64):
+        await run(batch_size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+"""Recall and latency of the two-stage search (files by summary embedding, then their chunks) against searching every chunk.
+
+Queries are random chunks of the account, embedded once. For each SUMMARY_TOP_FILES value the files returned are
+compared with the files of the full search: recall is the share of those files the two-stage search also returns.
+Needs the Postgres database from app/db.py with an account that has uploaded files.
+Run from the repo root: python -m benchmarks.file_recall <email_account_id> [samples]
+"""
+import asyncio
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app.db import AsyncSessionLocal
+from app.embed_service import embedding_service
+from app.models import DBFile, TextEmbedding
+from app.search import most_similar_files_async
+
+TOP_FILES = (5, 10, 20, 50, 100)
+# Chunks returned per query, more than the endpoint returns so recall is measured over several files
+MATCHES = 10
+
+
+async def run(db, email_account_id, vectors, top):
+    latencies, results = [], []
+    for vector in vectors:
+        start = time.perf_counter()
+        files, _ = await most_similar_files_async(db, email_account_id, [vector], MATCHES, max_distance=None, top=top)
+        latencies.append(time.perf_counter() - start)
+        results.append({file["id"] for file in files})
+    return np.array(latencies) * 1000, results
+
+
+async def main():
+    email_account_id = int(sys.argv[1])
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    async with AsyncSessionLocal() as db:
+        files = await db.scalar(select(func.count(DBFile.id)).where(DBFile.email_account_id == email_account_id))
+        chunks = (await db.scalars(
+            select(TextEmbedding.text)
+            .where(TextEmbedding.email_account_id == email_account_id)
+            .order_by(func.random())
+            .limit(samples)
+        )).all()
+    vectors = await embedding_service.embed(chunks)
+    print(f"{files} files, {len(chunks)} queries")
+
+    async with AsyncSessionLocal() as db:
+        ms, exact = await run(db, email_account_id, vectors, 0)
+        print(f"all chunks       p50={np.percentile(ms, 50):7.1f} ms  p95={np.percentile(ms, 95):7.1f} ms")
+        for top in TOP_FILES:
+            ms, found = await run(db, email_account_id, vectors, top)
+            recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact) if e])
+            print(f"top {top:<4} files   p50={np.percentile(ms, 50):7.1f} ms  p95={np.percentile(ms, 95):7.1f} ms  "
+                  f"file recall={recall:.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
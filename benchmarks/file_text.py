@@ -0,0 +1,67 @@
+"""Storage and download time of a file's text: the chunk rows (the old get_file) against the compressed blob.
+
+For every file of the account that has a stored blob: bytes of chunk text against bytes of blob, and the time to
+read the whole text both ways, compressed as stored and decompressed.
+Needs the Postgres database from app/db.py with an account that has uploaded files.
+Run from the repo root: python -m benchmarks.file_text <email_account_id>
+"""
+import asyncio
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app.db import AsyncSessionLocal
+from app.models import DBFile, TextEmbedding
+from app.text_store import iter_blob, iter_text
+
+
+async def timed(blocks):
+    start = time.perf_counter()
+    size = 0
+    async for block in blocks:
+        size += len(block)
+    return time.perf_counter() - start, size
+
+
+async def chunk_rows(db, file_id):
+    # What get_file streamed before the text was stored
+    rows = await db.stream_scalars(
+        select(TextEmbedding.text).where(TextEmbedding.file_id == file_id).order_by(TextEmbedding.id).execution_options(yield_per=500)
+    )
+    async for text in rows:
+        yield (text + "\n").encode("utf-8")
+
+
+async def main():
+    email_account_id = int(sys.argv[1])
+    async with AsyncSessionLocal() as db:
+        files = (await db.execute(
+            select(DBFile.id, DBFile.text_encoding, DBFile.text_length, func.octet_length(DBFile.text_blob).label("blob_length"))
+            .where(DBFile.email_account_id == email_account_id, DBFile.text_blob.isnot(None))
+        )).all()
+        chunk_bytes = await db.scalar(
+            select(func.coalesce(func.sum(func.octet_length(TextEmbedding.text)), 0))
+            .where(TextEmbedding.file_id.in_([file.id for file in files]))
+        )
+        print(f"{len(files)} files with stored text")
+        if not files:
+            return
+        print(f"chunk text {chunk_bytes / 2 ** 20:9.1f} MiB   text {sum(f.text_length for f in files) / 2 ** 20:9.1f} MiB   "
+              f"blobs {sum(f.blob_length for f in files) / 2 ** 20:9.1f} MiB ({files[0].text_encoding})")
+
+        results = {"chunk rows": [], "blob, encoded": [], "blob, decoded": []}
+        for file in files:
+            results["chunk rows"].append(await timed(chunk_rows(db, file.id)))
+            results["blob, encoded"].append(await timed(iter_blob(db, file.id)))
+            results["blob, decoded"].append(await timed(iter_text(db, file.id, file.text_encoding)))
+    for name, runs in results.items():
+        seconds = np.array([run[0] for run in runs]) * 1000
+        sent = sum(run[1] for run in runs)
+        print(f"{name:<14} p50={np.percentile(seconds, 50):8.1f} ms  p95={np.percentile(seconds, 95):8.1f} ms  "
+              f"total={seconds.sum() / 1000:7.2f}s  sent={sent / 2 ** 20:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+"""Latency and quality of the vector, hybrid and lexical search modes on short and longer queries.
+
+Queries are cut from random chunks of the account: 1-3 consecutive words ("short", like a product code
+or a name) and 25 consecutive words ("long"). A query is a hit when its source chunk is returned.
+Latency includes embedding the query (the query cache is bypassed).
+Needs the Postgres database from app/db.py with an account that has uploaded files.
+Run from the repo root: python -m benchmarks.hybrid_search <email_account_id> [samples]
+"""
+import asyncio
+import random
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app.db import AsyncSessionLocal
+from app.embed_service import embedding_service
+from app.models import TextEmbedding
+from app.search import fused_files_async, most_similar_files_async
+
+
+def cut_query(rng, text, words):
+    tokens = text.split()
+    start = rng.randrange(max(1, len(tokens) - words + 1))
+    return " ".join(tokens[start:start + words])
+
+
+async def search(db, email_account_id, mode, query):
+    if mode == "lexical":
+        return await fused_files_async(db, email_account_id, query)
+    vectors = await embedding_service.embed([query])
+    if mode == "hybrid":
+        return await fused_files_async(db, email_account_id, query, vectors)
+    return await most_similar_files_async(db, email_account_id, vectors)
+
+
+async def main():
+    email_account_id = int(sys.argv[1])
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rng = random.Random(0)
+
+    async with AsyncSessionLocal() as db:
+        chunks = (await db.scalars(
+            select(TextEmbedding.text)
+            .where(TextEmbedding.email_account_id == email_account_id)
+            .order_by(func.random())
+            .limit(samples)
+        )).all()
+    await embedding_service.embed(["warm up"])
+
+    for kind, words in (("short", None), ("long", 25)):
+        queries = [(cut_query(rng, text, words or rng.randint(1, 3)), text) for text in chunks]
+        for mode in ("vector", "hybrid", "lexical"):
+            latencies, hits = [], 0
+            async with AsyncSessionLocal() as db:
+                for query, source in queries:
+                    start = time.perf_counter()
+                    _, files_to_texts = await search(db, email_account_id, mode, query)
+                    latencies.append(time.perf_counter() - start)
+                    hits += any(source in texts for texts in files_to_texts.values())
+                    await db.rollback()
+            ms = np.array(latencies) * 1000
+            print(f"{kind:<5} {mode:<7} hit rate={hits / len(queries):.2f}  "
+                  f"p50={np.percentile(ms, 50):7.1f} ms  p95={np.percentile(ms, 95):7.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+"""N concurrent clients against one endpoint of a running server: requests/s and latency percentiles.
+
+Auth headers are taken from the environment (ACCESS_TOKEN, REFRESH_TOKEN, USER_ID).
+Run from the repo root, e.g.:
+    python -m benchmarks.load_test POST http://localhost:8000/app/dashboard/1 --clients 50 --seconds 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import numpy as np
+
+
+async def client(http, method, url, body, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await http.request(method, url, json=body)
+            if response.status_code >= 500:
+                errors.append(response.status_code)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - start)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("method")
+    parser.add_argument("url")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--body", help="JSON request body")
+    args = parser.parse_args()
+
+    headers = {
+        "Authorization": os.getenv("ACCESS_TOKEN", ""),
+        "X-Refresh-Token": os.getenv("REFRESH_TOKEN", ""),
+        "X-User-ID": os.getenv("USER_ID", ""),
+    }
+    body = json.loads(args.body) if args.body else None
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60) as http:
+        start = time.perf_counter()
+        deadline = start + args.seconds
+        await asyncio.gather(*(
+            client(http, args.method, args.url, body, deadline, latencies, errors) for _ in range(args.clients)
+        ))
+        elapsed = time.perf_counter() - start
+
+    ms = np.array(latencies) * 1000
+    print(f"{args.clients} clients, {len(latencies)} requests in {elapsed:.1f}s: {len(latencies) / elapsed:.1f} req/s, "
+          f"p50={np.percentile(ms, 50):.1f} ms  p95={np.percentile(ms, 95):.1f} ms  p99={np.percentile(ms, 99):.1f} ms  "
+          f"errors={len(errors)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+"""Cost of recording a metric: counter inc, histogram observe and Histogram.time(), single threaded and from 8 threads.
+
+Compared against the print() per chunk the ingest path used to do (written to /dev/null here).
+Run from the repo root: python -m benchmarks.metrics_overhead [iterations]   (default: 200000)
+"""
+import os
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+
+from app.metrics import Counter, Histogram, registry
+
+THREADS = 8
+
+counter = Counter("bench_counter_total", "Benchmark counter", ("stage",))
+histogram = Histogram("bench_seconds", "Benchmark histogram", ("stage",))
+
+
+def timed():
+    with histogram.time(stage="embed"):
+        pass
+
+
+CASES = {
+    "counter.inc": lambda: counter.inc(stage="embed"),
+    "histogram.observe": lambda: histogram.observe(0.012, stage="embed"),
+    "histogram.time()": timed,
+    "print (old per chunk)": lambda: print(1024),
+}
+
+
+def run(fn, iterations):
+    for _ in range(iterations):
+        fn()
+
+
+def bench(fn, iterations, threads):
+    per_thread = iterations // threads
+    workers = [threading.Thread(target=run, args=(fn, per_thread)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (per_thread * threads)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        results = [(name, bench(fn, iterations, 1), bench(fn, iterations, THREADS)) for name, fn in CASES.items()]
+    for name, single, threaded in results:
+        print(f"{name:<22} {single * 1e9:8.0f} ns/op   {threaded * 1e9:8.0f} ns/op with {THREADS} threads")
+
+    start = time.perf_counter()
+    text = registry.render()
+    print(f"render /metrics: {(time.perf_counter() - start) * 1000:.2f} ms, {len(text)} bytes")
+
+
+if __name__ == "__main__":
+    main()
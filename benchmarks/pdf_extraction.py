@@ -0,0 +1,36 @@
+"""Serial vs process-pool PDF text extraction.
+
+Run from the repo root: python -m benchmarks.pdf_extraction contract.pdf [workers ...]
+"""
+import os
+import sys
+import time
+
+from app.extract_text import iter_pdf_text_serial, iter_pdf_text_parallel, pdf_page_count
+
+
+def timed(pages):
+    start = time.perf_counter()
+    texts = list(pages)
+    return time.perf_counter() - start, texts
+
+
+def main():
+    path = sys.argv[1]
+    worker_counts = [int(w) for w in sys.argv[2:]] or [2, 4, os.cpu_count() or 4]
+    page_count = pdf_page_count(path)
+    print(f"{path}: {page_count} pages")
+
+    serial, expected = timed(iter_pdf_text_serial(path))
+    print(f"serial      {serial:7.2f}s  {page_count / serial:7.1f} pages/s")
+
+    for workers in worker_counts:
+        # First run starts the pool's processes, time the second
+        list(iter_pdf_text_parallel(path, workers))
+        elapsed, texts = timed(iter_pdf_text_parallel(path, workers))
+        assert texts == expected, "parallel extraction changed the page order or text"
+        print(f"workers={workers:<3} {elapsed:7.2f}s  {page_count / elapsed:7.1f} pages/s  x{serial / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Per-vector search with lazy file loads vs the single-statement search, for a 10-chunk query.
+
+Needs the Postgres database from app/db.py with an account that has uploaded files.
+Run from the repo root: python -m benchmarks.relevance_search <email_account_id>
+"""
+import statistics
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import event, select
+
+from app.db import SessionLocal, engine
+from app.models import TextEmbedding, N_DIM
+from app.search import most_similar_files
+
+RUNS = 50
+QUERY_CHUNKS = 10
+
+query_count = 0
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_queries(*args):
+    global query_count
+    query_count += 1
+
+
+def per_vector_search(db, email_account_id, vectors):
+    files, files_to_texts = [], {}
+    for vector in vectors:
+        closest = db.scalars(
+            select(TextEmbedding)
+            .where(TextEmbedding.embedding.l2_distance(vector) <= .8)
+            .where(TextEmbedding.email_account_id == email_account_id)
+            .order_by(TextEmbedding.embedding.l2_distance(vector))
+            .limit(2)
+        )
+        for emb in closest:
+            if emb.file_id not in files_to_texts:
+                files.append(emb.file.__get_json__())
+                files_to_texts[emb.file_id] = [emb.text]
+            else:
+                files_to_texts[emb.file_id].append(emb.text)
+    return files, files_to_texts
+
+
+def measure(name, fn, email_account_id):
+    global query_count
+    latencies, queries = [], []
+    rng = np.random.default_rng(0)
+    for _ in range(RUNS):
+        vectors = rng.standard_normal((QUERY_CHUNKS, N_DIM), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        db = SessionLocal()
+        query_count = 0
+        start = time.perf_counter()
+        fn(db, email_account_id, vectors)
+        latencies.append(time.perf_counter() - start)
+        queries.append(query_count)
+        db.close()
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{name:<12} queries={max(queries):>3}  p50={p50:7.1f} ms  p95={p95:7.1f} ms")
+
+
+def main():
+    email_account_id = int(sys.argv[1])
+    measure("per-vector", per_vector_search, email_account_id)
+    measure("lateral", most_similar_files, email_account_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Messages/sec of one FastMail connection per message vs the pooled send_email_async.
+
+Starts a local aiosmtpd sink, no mail leaves the machine.
+Run from the repo root: python -m benchmarks.smtp_send [messages] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+from aiosmtpd.controller import Controller
+from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
+
+from app.send_mail import TEMPLATE_FOLDER, send_email_async
+
+HOST, PORT = "127.0.0.1", 8025
+EMAIL_BODY = {
+    "title": "Verify your business email works!",
+    "sub_title": "Click on the button below or copy the link to your browser to verify your email",
+    "message": "https://example.com/verify_email/123456/1",
+    "button_text": "Verify",
+    "visible_tag": "Bench's Dripity",
+    "link": "https://example.com/verify_email/123456/1",
+}
+
+
+class Sink:
+    received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        Sink.received += 1
+        return "250 OK"
+
+
+conf = ConnectionConfig(
+    MAIL_USERNAME="bench",
+    MAIL_PASSWORD="bench",
+    MAIL_FROM="bench@example.com",
+    MAIL_PORT=PORT,
+    MAIL_SERVER=HOST,
+    MAIL_STARTTLS=False,
+    MAIL_SSL_TLS=False,
+    MAIL_FROM_NAME="Bench",
+    USE_CREDENTIALS=False,
+    VALIDATE_CERTS=False,
+    TEMPLATE_FOLDER=TEMPLATE_FOLDER,
+)
+
+
+async def fastmail_send(recipient):
+    message = MessageSchema(subject=EMAIL_BODY["title"], recipients=[recipient], template_body=EMAIL_BODY, subtype="html")
+    await FastMail(conf).send_message(message, template_name="email.html")
+
+
+async def pooled_send(recipient):
+    await send_email_async(conf=conf, recipient=recipient, email_body=EMAIL_BODY)
+
+
+async def run(name, send, messages, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with limit:
+            await send(f"user{i}@example.com")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(messages)))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<9} {messages} messages in {elapsed:6.2f}s  {messages / elapsed:8.1f} msg/s")
+
+
+async def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    controller = Controller(Sink(), hostname=HOST, port=PORT)
+    controller.start()
+    try:
+        await run("fastmail", fastmail_send, messages, concurrency)
+        await run("pooled", pooled_send, messages, concurrency)
+    finally:
+        controller.stop()
+    print(f"sink received {Sink.received} messages")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
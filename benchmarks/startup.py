@@ -0,0 +1,61 @@
+"""Import time and worker RSS: import only, import + in-process model warm-up, import + model server warm-up.
+
+Each case runs in a fresh interpreter. Before lazy loading, the import alone loaded the model.
+Run from the repo root: python -m benchmarks.startup [module]   (default: app.app)
+"""
+import os
+import subprocess
+import sys
+import time
+
+SOCKET = "/tmp/emailauto-embed-bench.sock"
+
+CHILD = """
+import asyncio, resource, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+imported = time.perf_counter() - start
+if sys.argv[2] == "1":
+    from app.embed_service import embedding_service
+    asyncio.run(embedding_service.warm_up())
+ready = time.perf_counter() - start
+rss = next(int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmRSS"))
+print(f"{imported:.2f} {ready:.2f} {rss / 1024:.0f}")
+"""
+
+
+def run(module, warm_up, env=None):
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD, module, "1" if warm_up else "0"],
+        env={**os.environ, **(env or {})}, text=True,
+    )
+    imported, ready, rss = output.split()[-3:]
+    return float(imported), float(ready), float(rss)
+
+
+def report(name, result):
+    imported, ready, rss = result
+    print(f"{name:<28} import={imported:6.2f}s  ready={ready:6.2f}s  rss={rss:7.0f} MB")
+
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else "app.app"
+    report("import only", run(module, False, {"EMBED_SOCKET": ""}))
+    report("warm-up in process", run(module, True, {"EMBED_SOCKET": ""}))
+
+    if os.path.exists(SOCKET):
+        os.remove(SOCKET)
+    server = subprocess.Popen([sys.executable, "-m", "app.model_server", "--socket", SOCKET])
+    try:
+        while not os.path.exists(SOCKET):
+            if server.poll() is not None:
+                raise RuntimeError("Model server exited")
+            time.sleep(0.2)
+        report("warm-up via model server", run(module, True, {"EMBED_SOCKET": SOCKET}))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Table and index size, recall@k against exact float32 search and p50/p99 latency for each EMBEDDING_FORMAT.
+
+Loads clustered random vectors into a scratch table (dropped at the end) in the database from app/db.py,
+once per format: vector, halfvec and binary (bit index + full precision re-rank).
+Run from the repo root: python -m benchmarks.storage_formats [rows]   (default: 200000)
+"""
+import io
+import struct
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from app.bulk_insert import _vector_field
+from app.db import engine
+from app.models import N_DIM
+from app.search import BINARY_RERANK_FACTOR
+from app.vector_index import HNSW_M, HNSW_EF_CONSTRUCTION
+
+K = 10
+QUERIES = 200
+LOAD_BATCH = 20000
+
+FORMATS = {
+    # column type, COPY element type, index target, query
+    "vector": (
+        f"vector({N_DIM})", ">f4", "embedding vector_l2_ops",
+        "SELECT id FROM bench_formats ORDER BY embedding <-> CAST(:q AS vector) LIMIT :k",
+    ),
+    "halfvec": (
+        f"halfvec({N_DIM})", ">f2", "embedding halfvec_l2_ops",
+        "SELECT id FROM bench_formats ORDER BY embedding <-> CAST(:q AS halfvec) LIMIT :k",
+    ),
+    "binary": (
+        f"vector({N_DIM})", ">f4", f"(binary_quantize(embedding)::bit({N_DIM})) bit_hamming_ops",
+        f"SELECT id FROM (SELECT id, embedding FROM bench_formats "
+        f"ORDER BY binary_quantize(embedding)::bit({N_DIM}) <~> binary_quantize(CAST(:q AS vector)) "
+        f"LIMIT :k * {BINARY_RERANK_FACTOR}) candidates ORDER BY embedding <-> CAST(:q AS vector) LIMIT :k",
+    ),
+}
+
+
+def clustered_vectors(rng, n, centers):
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.3 * rng.standard_normal((n, N_DIM), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load(conn, vectors, dtype):
+    cursor = conn.connection.cursor()
+    for start in range(0, len(vectors), LOAD_BATCH):
+        stream = io.BytesIO()
+        stream.write(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+        for vector in vectors[start:start + LOAD_BATCH]:
+            stream.write(struct.pack(">h", 1) + _vector_field(vector, dtype))
+        stream.write(struct.pack(">h", -1))
+        stream.seek(0)
+        cursor.copy_expert("COPY bench_formats (embedding) FROM STDIN WITH (FORMAT binary)", stream)
+    cursor.close()
+
+
+def bench(fmt, vectors, queries, exact):
+    column_type, dtype, target, query = FORMATS[fmt]
+    with engine.connect() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS bench_formats"))
+        conn.execute(text(f"CREATE TABLE bench_formats (id serial PRIMARY KEY, embedding {column_type})"))
+        conn.commit()
+        load(conn, vectors, dtype)
+        conn.commit()
+
+        start = time.perf_counter()
+        conn.execute(text(
+            f"CREATE INDEX ON bench_formats USING hnsw ({target}) "
+            f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+        ))
+        conn.commit()
+        built = time.perf_counter() - start
+        table_mb, index_mb = conn.execute(text(
+            "SELECT pg_table_size('bench_formats') / 1048576.0, pg_indexes_size('bench_formats') / 1048576.0"
+        )).one()
+
+        results, latencies = [], []
+        for q in queries:
+            literal = "[" + ",".join(f"{x:.6f}" for x in q) + "]"
+            start = time.perf_counter()
+            ids = conn.execute(text(query), {"q": literal, "k": K}).scalars().all()
+            latencies.append(time.perf_counter() - start)
+            results.append(set(ids))
+        ms = np.array(latencies) * 1000
+        recall = np.mean([len(r & e) / K for r, e in zip(results, exact)])
+        print(f"  {fmt:<8} table={table_mb:8.1f} MB  index={index_mb:8.1f} MB  built in {built:6.1f}s  "
+              f"recall@{K}={recall:.3f}  p50={np.percentile(ms, 50):7.2f} ms  p99={np.percentile(ms, 99):7.2f} ms")
+
+        conn.execute(text("DROP TABLE bench_formats"))
+        conn.commit()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((256, N_DIM), dtype=np.float32)
+    vectors = clustered_vectors(rng, rows, centers)
+    queries = clustered_vectors(rng, QUERIES, centers)
+
+    # Ground truth from exact float32 search, ids follow the load order
+    exact = []
+    for q in queries:
+        distances = np.linalg.norm(vectors - q, axis=1)
+        exact.append(set((np.argpartition(distances, K)[:K] + 1).tolist()))
+
+    print(f"{rows} rows")
+    for fmt in FORMATS:
+        bench(fmt, vectors, queries, exact)
+
+
+if __name__ == "__main__":
+    main()
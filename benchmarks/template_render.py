@@ -0,0 +1,48 @@
+"""Render throughput of email.html: fresh environment per message (the old FastMail path),
+cached compiled template, and a prepared template that only fills per-recipient slots.
+
+Run from the repo root: python -m benchmarks.template_render [messages]
+"""
+import sys
+import time
+
+from jinja2 import Environment, FileSystemLoader
+
+from app.mail_templates import TEMPLATE_FOLDER, prepare_template, template_cache
+
+SHARED = {
+    "title": "Spring catalogue",
+    "sub_title": "Our spring catalogue is out",
+    "button_text": "See the catalogue",
+    "link": "https://example.com/catalogue",
+}
+
+
+def fresh_environment(i):
+    env = Environment(loader=FileSystemLoader(TEMPLATE_FOLDER))
+    return env.get_template("email.html").render(**SHARED, message=f"Hi user{i}, take a look.")
+
+
+def cached_template(i):
+    return template_cache.render("email.html", {**SHARED, "message": f"Hi user{i}, take a look."})
+
+
+prepared = prepare_template("email.html", SHARED, ["message"])
+
+def prepared_template(i):
+    return prepared.render({"message": f"Hi user{i}, take a look."})
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    assert fresh_environment(1) == cached_template(1) == prepared_template(1)
+    for name, render in (("fresh env", fresh_environment), ("cached", cached_template), ("prepared", prepared_template)):
+        start = time.perf_counter()
+        for i in range(messages):
+            render(i)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<10} {messages / elapsed:10.0f} renders/s")
+
+
+if __name__ == "__main__":
+    main()
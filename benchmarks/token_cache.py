@@ -0,0 +1,45 @@
+"""Token validations/sec: verifying the JWT on every request vs. the verified-token cache.
+
+This measures the in-process part only. For the end-to-end numbers, run the load test against
+/app/see_files before and after, e.g.:
+    python -m benchmarks.load_test GET http://localhost:8000/app/see_files/1 --clients 50 --seconds 20
+
+Run from the repo root: python -m benchmarks.token_cache
+"""
+import time
+
+from jose import jwt
+
+from app.token_cache import TokenCache
+
+SECRET_KEY = "benchmark-secret"
+USERS = 1000
+LOOKUPS = 200000
+
+
+def main():
+    exp = int(time.time()) + 3600
+    tokens = [(f"Bearer {jwt.encode({'sub': str(i), 'exp': exp}, SECRET_KEY, algorithm='HS256')}", str(i))
+              for i in range(USERS)]
+
+    start = time.perf_counter()
+    for i in range(LOOKUPS // 20):
+        token, _ = tokens[i % USERS]
+        jwt.decode(token[7:], SECRET_KEY, algorithms=["HS256"])
+    elapsed = time.perf_counter() - start
+    print(f"jwt.decode per request:  {LOOKUPS // 20 / elapsed:>10.0f} validations/s (before the user lookup)")
+
+    cache = TokenCache()
+    for token, user_id in tokens:
+        cache.put(token, user_id, {"access_token": token, "user_id": int(user_id)})
+    start = time.perf_counter()
+    for i in range(LOOKUPS):
+        token, user_id = tokens[i % USERS]
+        if not cache.is_revoked(token):
+            cache.get(token, user_id)
+    elapsed = time.perf_counter() - start
+    print(f"verified-token cache:    {LOOKUPS / elapsed:>10.0f} validations/s, {cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Latency of vector searches answered by the in-process vector cache (app/vector_cache.py) against pgvector.
+
+With an account id, random chunks of the account are embedded once and searched through both paths; agreement is
+the share of the database's chunks the cache also returns (below 1 only when the database uses an approximate index).
+Needs the Postgres database from app/db.py with an account that has uploaded files.
+Run from the repo root: python -m benchmarks.vector_cache <email_account_id> [samples]
+With --synthetic, only the in-memory search is timed on random vectors, no database needed:
+    python -m benchmarks.vector_cache --synthetic [rows]
+"""
+import asyncio
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app.db import AsyncSessionLocal
+from app.embed_service import embedding_service
+from app.models import TextEmbedding
+from app.search import MATCHES_PER_VECTOR, SUMMARY_TOP_FILES, most_similar_files_async
+from app.vector_cache import (
+    VECTOR_CACHE_HNSW_EF, VECTOR_CACHE_HNSW_MIN_RECALL, AccountVectors, VectorCache, build_graph, graph_recall, hnswlib,
+    load_account,
+)
+
+DIMENSIONS = 384
+
+
+def percentiles(ms):
+    return f"p50={np.percentile(ms, 50):7.2f} ms  p95={np.percentile(ms, 95):7.2f} ms"
+
+
+def chunk_texts(files_to_texts):
+    return {text for texts in files_to_texts.values() for text in texts}
+
+
+
+async def compare(email_account_id, samples):
+    async with AsyncSessionLocal() as db:
+        chunks = (await db.scalars(
+            select(TextEmbedding.text)
+            .where(TextEmbedding.email_account_id == email_account_id)
+            .order_by(func.random())
+            .limit(samples)
+        )).all()
+    vectors = await embedding_service.embed(chunks)
+
+    cache = VectorCache(enabled=True)
+    start = time.perf_counter()
+    entry = await asyncio.to_thread(load_account, email_account_id)
+    if entry is None:
+        print("Account has no chunks or is over VECTOR_CACHE_MAX_ROWS")
+        return
+    cache._entries[email_account_id] = entry
+    print(f"{len(entry.ids)} chunks loaded in {time.perf_counter() - start:.2f}s, {entry.nbytes / 2 ** 20:.1f} MiB")
+
+    database, cached, agreement = [], [], []
+    async with AsyncSessionLocal() as db:
+        for vector in vectors:
+            start = time.perf_counter()
+            _, expected = await most_similar_files_async(db, email_account_id, [vector])
+            database.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            _, found = await cache.search(db, email_account_id, [vector])
+            cached.append(time.perf_counter() - start)
+            if expected:
+                agreement.append(len(chunk_texts(found) & chunk_texts(expected)) / len(chunk_texts(expected)))
+    print(f"pgvector      {percentiles(np.array(database) * 1000)}")
+    print(f"vector cache  {percentiles(np.array(cached) * 1000)}  agreement={np.mean(agreement):.3f}  "
+          f"hit rate={cache.stats()['hit_rate']:.3f}")
+
+
+def time_search(entry, queries, top=0):
+    rows = entry.snapshot()
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(set(entry.search(rows, query[None, :], MATCHES_PER_VECTOR, None, top)))
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000, results
+
+
+def synthetic(rows, samples=200):
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((rows, DIMENSIONS), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    # Queries near stored rows, like a question close to a passage
+    queries = matrix[rng.integers(0, rows, samples)] + 0.05 * rng.standard_normal((samples, DIMENSIONS), dtype=np.float32)
+    ids = np.arange(rows, dtype=np.int64)
+    file_ids = ids // 50
+
+    exact_ms, exact = time_search(AccountVectors(ids, file_ids, matrix), queries)
+    print(f"{rows} rows, {DIMENSIONS} dimensions")
+    print(f"matmul float32  {percentiles(exact_ms)}  {matrix.nbytes / 2 ** 20:7.1f} MiB")
+    half = matrix.astype(np.float16)
+    ms, found = time_search(AccountVectors(ids, file_ids, half), queries)
+    recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+    print(f"matmul float16  {percentiles(ms)}  {half.nbytes / 2 ** 20:7.1f} MiB  recall={recall:.3f}")
+    # Two-stage search of the default settings, each file summarised by the mean of its rows
+    summary_ids = np.unique(file_ids)
+    summaries = np.stack([matrix[file_ids == file_id].mean(axis=0) for file_id in summary_ids])
+    ms, _ = time_search(AccountVectors(ids, file_ids, matrix, None, summary_ids, summaries), queries, SUMMARY_TOP_FILES)
+    print(f"top {SUMMARY_TOP_FILES} files     {percentiles(ms)}  of {len(summary_ids)} files")
+
+    if hnswlib is None:
+        print("hnswlib is not installed, graph search skipped")
+        return
+    start = time.perf_counter()
+    hnsw = build_graph(matrix)
+    built = time.perf_counter() - start
+    sampled = graph_recall(hnsw, matrix)
+    ms, found = time_search(AccountVectors(ids, file_ids, matrix, hnsw), queries)
+    recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+    print(f"hnswlib ef={VECTOR_CACHE_HNSW_EF} {percentiles(ms)}  built in {built:.1f}s  recall={recall:.3f}  "
+          f"sampled recall={sampled:.3f} ({'kept' if sampled >= VECTOR_CACHE_HNSW_MIN_RECALL else 'dropped, matmul'})")
+
+
+def main():
+    if sys.argv[1] == "--synthetic":
+        synthetic(int(sys.argv[2]) if len(sys.argv) > 2 else 50000)
+    else:
+        asyncio.run(compare(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 200))
+
+
+if __name__ == "__main__":
+    main()
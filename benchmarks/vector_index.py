@@ -0,0 +1,93 @@
+"""Recall@k against exact search and p50/p99 latency of the HNSW index, per ef_search.
+
+Loads clustered random vectors into a scratch table (dropped at the end) in the database from app/db.py.
+Run from the repo root: python -m benchmarks.vector_index [rows ...]   (default: 100000 1000000)
+"""
+import io
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from app.db import engine
+from app.models import N_DIM
+from app.vector_index import HNSW_M, HNSW_EF_CONSTRUCTION
+
+K = 10
+QUERIES = 200
+EF_SEARCH = (40, 100, 200)
+LOAD_BATCH = 20000
+
+
+def clustered_vectors(rng, n, centers):
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.3 * rng.standard_normal((n, N_DIM), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load(conn, rng, rows, centers):
+    cursor = conn.connection.cursor()
+    for start in range(0, rows, LOAD_BATCH):
+        vectors = clustered_vectors(rng, min(LOAD_BATCH, rows - start), centers)
+        buffer = io.StringIO("".join("[" + ",".join(f"{x:.6f}" for x in v) + "]\n" for v in vectors))
+        cursor.copy_expert("COPY bench_vectors (embedding) FROM STDIN", buffer)
+    cursor.close()
+
+
+def run_queries(conn, queries):
+    results, latencies = [], []
+    for q in queries:
+        literal = "[" + ",".join(f"{x:.6f}" for x in q) + "]"
+        start = time.perf_counter()
+        ids = conn.execute(
+            text("SELECT id FROM bench_vectors ORDER BY embedding <-> CAST(:q AS vector) LIMIT :k"),
+            {"q": literal, "k": K},
+        ).scalars().all()
+        latencies.append(time.perf_counter() - start)
+        results.append(set(ids))
+    return results, np.array(latencies) * 1000
+
+
+def bench(rows):
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((256, N_DIM), dtype=np.float32)
+    queries = clustered_vectors(rng, QUERIES, centers)
+
+    with engine.connect() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS bench_vectors"))
+        conn.execute(text(f"CREATE TABLE bench_vectors (id serial PRIMARY KEY, embedding vector({N_DIM}))"))
+        conn.commit()
+        load(conn, rng, rows, centers)
+        conn.commit()
+
+        start = time.perf_counter()
+        conn.execute(text(
+            f"CREATE INDEX ON bench_vectors USING hnsw (embedding vector_l2_ops) "
+            f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+        ))
+        conn.commit()
+        print(f"{rows} rows: index built in {time.perf_counter() - start:.1f}s")
+
+        conn.execute(text("SET enable_indexscan = off"))
+        exact, exact_ms = run_queries(conn, queries)
+        conn.execute(text("SET enable_indexscan = on"))
+        print(f"  exact        p50={np.percentile(exact_ms, 50):8.2f} ms  p99={np.percentile(exact_ms, 99):8.2f} ms")
+
+        for ef_search in EF_SEARCH:
+            conn.execute(text(f"SET hnsw.ef_search = {ef_search}"))
+            approx, approx_ms = run_queries(conn, queries)
+            recall = np.mean([len(a & e) / K for a, e in zip(approx, exact)])
+            print(f"  ef_search={ef_search:<3} recall@{K}={recall:.3f}  "
+                  f"p50={np.percentile(approx_ms, 50):8.2f} ms  p99={np.percentile(approx_ms, 99):8.2f} ms")
+
+        conn.execute(text("DROP TABLE bench_vectors"))
+        conn.commit()
+
+
+def main():
+    for rows in [int(r) for r in sys.argv[1:]] or [100000, 1000000]:
+        bench(rows)
+
+
+if __name__ == "__main__":
+    main()